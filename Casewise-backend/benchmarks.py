@@ -0,0 +1,272 @@
+"""Micro-benchmarks for hot request paths.
+
+Run from this directory:
+
+    python benchmarks.py            # every section
+    python benchmarks.py auth       # one section
+
+Nothing here touches MongoDB or OpenAI; each section exercises the in-process
+code that runs on every request.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+import timeit
+from datetime import datetime, timedelta
+
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+
+import main
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
+from fastapi.security import HTTPAuthorizationCredentials
+
+
+def report(label: str, seconds_per_call: float):
+    print(f"  {label:<44} {seconds_per_call * 1e6:9.2f} µs/call")
+
+
+def report_throughput(label: str, seconds_per_call: float):
+    print(f"  {label:<44} {seconds_per_call * 1e6:9.2f} µs/request {1 / seconds_per_call:10.0f} requests/s")
+
+
+def measure(fn, number: int) -> float:
+    """Best-of-five seconds per call"""
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def legacy_decode_jwt_token(token: str) -> dict:
+    """decode_jwt_token as it was before JWTVerifier, kept for comparison"""
+    header_encoded, payload_encoded, signature_encoded = token.split('.')
+    payload_padded = payload_encoded + '=' * (4 - len(payload_encoded) % 4)
+    payload = json.loads(base64.urlsafe_b64decode(payload_padded))
+    message = f"{header_encoded}.{payload_encoded}"
+    expected_signature = hmac.new(main.SECRET_KEY.encode(), message.encode(), hashlib.sha256).digest()
+    expected_signature_encoded = base64.urlsafe_b64encode(expected_signature).decode().rstrip('=')
+    if signature_encoded != expected_signature_encoded:
+        raise ValueError("Invalid signature")
+    if 'exp' in payload and datetime.utcnow().timestamp() > payload['exp']:
+        raise ValueError("Token expired")
+    return payload
+
+
+def bench_auth(number: int):
+    """Per-request authentication cost"""
+    token = main.create_access_token({"sub": "0123456789abcdef01234567"}, timedelta(hours=1))
+    cold = main.JWTVerifier(main.SECRET_KEY, max_entries=0)
+    warm = main.JWTVerifier(main.SECRET_KEY)
+    warm.verify(token)
+
+    report("legacy decode_jwt_token", measure(lambda: legacy_decode_jwt_token(token), number))
+    report("JWTVerifier, full verification (miss)", measure(lambda: cold.verify(token), number))
+    report("JWTVerifier, verified-token cache hit", measure(lambda: warm.verify(token), number))
+
+    # The whole dependency once both the token and the principal are cached
+    user_id = "0123456789abcdef01234567"
+    main.principal_cache.set(user_id, {"_id": user_id, "id": user_id, "role": "user"})
+    main.jwt_verifier.verify(token)
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    loop = asyncio.new_event_loop()
+    try:
+        report(
+            "get_current_user, all cached",
+            measure(lambda: loop.run_until_complete(main.get_current_user(credentials)), number // 10),
+        )
+    finally:
+        loop.close()
+
+
+async def asgi_request(app, method: str, path: str, headers: list):
+    """Drive one request through an ASGI app in-process, discarding the response"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "headers": headers,
+        "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+def measure_asgi(app, method: str, path: str, headers: list, number: int) -> float:
+    """Best-of-five seconds per in-process request"""
+    async def run_batch():
+        started = time.perf_counter()
+        for _ in range(number):
+            await asgi_request(app, method, path, headers)
+        return time.perf_counter() - started
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run_batch())  # builds the middleware stack
+        return min(loop.run_until_complete(run_batch()) for _ in range(5)) / number
+    finally:
+        loop.close()
+
+
+def ping_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ping")
+    def ping():
+        return {"status": "ok"}
+
+    return app
+
+
+def legacy_cors_app() -> FastAPI:
+    """The three CORS layers as they were before CORSHeadersMiddleware, kept for comparison"""
+    app = ping_app()
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=[
+            "https://casewise-beta.vercel.app", "http://localhost:3000", "http://localhost:3001",
+            "http://127.0.0.1:3000", "http://127.0.0.1:3001", "http://localhost:8000", "http://127.0.0.1:8000"
+        ],
+        allow_credentials=True,
+        allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH", "HEAD"],
+        allow_headers=[
+            "Accept", "Accept-Language", "Content-Language", "Content-Type", "Authorization",
+            "X-Requested-With", "Origin", "Access-Control-Request-Method", "Access-Control-Request-Headers",
+            "Cache-Control", "Pragma", "Expires", "X-Google-Auth-User"
+        ],
+        expose_headers=[
+            "Content-Length", "Content-Type", "Date", "Server",
+            "Access-Control-Allow-Origin", "Access-Control-Allow-Credentials", "X-Request-ID"
+        ],
+        max_age=3600
+    )
+
+    @app.middleware("http")
+    async def cors_handler(request: Request, call_next):
+        allowed_origins = [
+            "https://casewise-beta.vercel.app", "http://localhost:3000", "http://localhost:3001",
+            "http://127.0.0.1:3000", "http://127.0.0.1:3001",
+        ]
+        origin = request.headers.get("origin")
+        main.cors_logger.debug("🌐 CORS: %s %s from origin %s", request.method, request.url.path, origin)
+        if origin and origin in allowed_origins:
+            allowed_origin = origin
+        else:
+            allowed_origin = "https://casewise-beta.vercel.app"
+            if origin:
+                main.cors_logger.warning("⚠️ CORS: Unknown origin: %s, defaulting to production frontend", origin)
+        if request.method == "OPTIONS":
+            response = Response()
+            response.headers["Access-Control-Allow-Origin"] = allowed_origin
+            response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS, PATCH, HEAD"
+            response.headers["Access-Control-Allow-Headers"] = "Accept, Accept-Language, Content-Language, Content-Type, Authorization, X-Requested-With, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, Cache-Control, Pragma, Expires, X-Google-Auth-User"
+            response.headers["Access-Control-Allow-Credentials"] = "true"
+            response.headers["Access-Control-Max-Age"] = "3600"
+            return response
+        response = await call_next(request)
+        response.headers["Access-Control-Allow-Origin"] = allowed_origin
+        response.headers["Access-Control-Allow-Credentials"] = "true"
+        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS, PATCH, HEAD"
+        response.headers["Access-Control-Allow-Headers"] = "Accept, Accept-Language, Content-Language, Content-Type, Authorization, X-Requested-With, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, Cache-Control, Pragma, Expires, X-Google-Auth-User"
+        return response
+
+    @app.options("/{path:path}")
+    async def options_handler(path: str, request: Request):
+        return Response(status_code=200)
+
+    return app
+
+
+def bench_cors(number: int):
+    """CORS overhead per request, preflight and simple GET"""
+    number = max(1, number // 10)
+    plain = ping_app()
+    legacy = legacy_cors_app()
+    current = ping_app()
+    current.add_middleware(main.CORSHeadersMiddleware)
+
+    origin = [(b"origin", b"http://localhost:3000")]
+    preflight = origin + [(b"access-control-request-method", b"POST"), (b"access-control-request-headers", b"authorization")]
+
+    report("no CORS, GET", measure_asgi(plain, "GET", "/ping", origin, number))
+    report("legacy three-layer CORS, GET", measure_asgi(legacy, "GET", "/ping", origin, number))
+    report("CORSHeadersMiddleware, GET", measure_asgi(current, "GET", "/ping", origin, number))
+    report("legacy three-layer CORS, preflight", measure_asgi(legacy, "OPTIONS", "/ping", preflight, number))
+    report("CORSHeadersMiddleware, preflight", measure_asgi(current, "OPTIONS", "/ping", preflight, number))
+
+
+def legacy_middleware_app() -> FastAPI:
+    """main.app's routes behind the @app.middleware("http") exception handler it used to have"""
+    app = FastAPI(routes=main.app.routes)
+
+    @app.middleware("http")
+    async def catch_exceptions_middleware(request: Request, call_next):
+        try:
+            return await call_next(request)
+        except Exception as e:
+            main.logger.exception("ERROR: Unhandled exception: %s", e)
+            return Response(
+                content=f'{{"detail": "Internal server error: {str(e)}"}}',
+                status_code=500,
+                headers={"Content-Type": "application/json"}
+            )
+
+    app.add_middleware(main.CORSHeadersMiddleware)
+    app.add_middleware(main.RequestIdMiddleware)
+    return app
+
+
+def bench_middleware(number: int):
+    """Full-stack throughput, http middleware vs pure ASGI (MongoDB replaced by a constant)"""
+    number = max(1, number // 10)
+    user_id = "0123456789abcdef01234567"
+    token = main.create_access_token({"sub": user_id}, timedelta(hours=1))
+    main.principal_cache.set(user_id, {"_id": user_id, "id": user_id, "role": "user"})
+
+    async def count_for_user(user_id, unread_only=False):
+        return 3
+
+    main.notification_repository.count_for_user = count_for_user
+
+    headers = [(b"origin", b"http://localhost:3000")]
+    authorized = headers + [(b"authorization", f"Bearer {token}".encode())]
+    legacy = legacy_middleware_app()
+
+    report_throughput("http middleware, /health", measure_asgi(legacy, "GET", "/health", headers, number))
+    report_throughput("pure ASGI, /health", measure_asgi(main.app, "GET", "/health", headers, number))
+    report_throughput(
+        "http middleware, /notifications/unread-count",
+        measure_asgi(legacy, "GET", "/notifications/unread-count", authorized, number)
+    )
+    report_throughput(
+        "pure ASGI, /notifications/unread-count",
+        measure_asgi(main.app, "GET", "/notifications/unread-count", authorized, number)
+    )
+
+
+BENCHMARKS = {
+    "auth": bench_auth,
+    "cors": bench_cors,
+    "middleware": bench_middleware,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sections", nargs="*", metavar="section", help=f"any of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("-n", "--number", type=int, default=20000, help="calls per timing run")
+    args = parser.parse_args()
+    unknown = set(args.sections) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown section(s): {', '.join(sorted(unknown))}")
+    for name in args.sections or BENCHMARKS:
+        print(f"{name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name](args.number)
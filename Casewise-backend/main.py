@@ -1,18 +1,26 @@
 from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from datetime import datetime, timedelta
-from typing import Optional, List
+from typing import Optional, List, Literal
 from contextlib import asynccontextmanager
 import hashlib
+import math
 import os
 import re
 from dotenv import load_dotenv
 import pymongo      
+import gridfs
 from bson import ObjectId
 from pydantic import BaseModel, Field, EmailStr, field_validator
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI
+import httpx
+import asyncio
+import contextvars
+import random
+from email.utils import parsedate_to_datetime
 import io
 import mimetypes
 # import jwt  # Temporarily disabled due to library conflicts
@@ -21,16 +29,141 @@ import hmac
 import hashlib
 import json
 import re
-from typing import List, Dict, Optional
-from google.oauth2 import id_token
-from google.auth.transport import requests
+from typing import Any, List, Dict, Optional
+from google.auth import jwt as google_jwt
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import secrets
+import tempfile
 import string
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+load_dotenv()
+
+# Logging: request handlers only put records on a queue; a listener thread formats and writes them
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Per-logger levels, e.g. "casewise.cors=DEBUG,casewise.llm=WARNING"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# "text" for humans, "json" for one JSON object per line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Fraction of DEBUG records kept, overridable per logger, e.g. "casewise.cors=0.01"
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+LOG_DEBUG_SAMPLE_RATES = os.getenv("LOG_DEBUG_SAMPLE_RATES", "")
+
+# Correlates every record logged while serving a request (or running a job)
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+def parse_logger_settings(spec: str) -> Dict[str, str]:
+    """Parse "logger=value,logger=value" into a dict"""
+    settings = {}
+    for item in spec.split(","):
+        name, sep, value = item.partition("=")
+        if sep and name.strip():
+            settings[name.strip()] = value.strip()
+    return settings
+
+class RequestContextFilter(logging.Filter):
+    """Stamps records with the current request id and samples DEBUG records"""
+
+    def __init__(self, default_rate: float, rates: Dict[str, float]):
+        super().__init__()
+        self.default_rate = default_rate
+        self.rates = rates
+        self.resolved = {}
+
+    def sample_rate(self, logger_name: str) -> float:
+        rate = self.resolved.get(logger_name)
+        if rate is None:
+            rate = self.default_rate
+            name = logger_name
+            while name:
+                if name in self.rates:
+                    rate = self.rates[name]
+                    break
+                name = name.rpartition(".")[0]
+            self.resolved[logger_name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG:
+            rate = self.sample_rate(record.name)
+            if rate < 1.0 and random.random() >= rate:
+                return False
+        record.request_id = request_id_var.get()
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that defers all formatting to the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve arguments now (they may be mutated after the call) but leave layout to the formatter
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JSONLogFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure_logging() -> logging.handlers.QueueListener:
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JSONLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(name)s [%(request_id)s] %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter(
+        LOG_DEBUG_SAMPLE_RATE,
+        {name: float(rate) for name, rate in parse_logger_settings(LOG_DEBUG_SAMPLE_RATES).items()}
+    ))
+
+    root = logging.getLogger("casewise")
+    root.setLevel(LOG_LEVEL)
+    root.handlers = [queue_handler]
+    root.propagate = False
+    for name, level in parse_logger_settings(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
+logger = logging.getLogger("casewise")
+auth_logger = logging.getLogger("casewise.auth")
+cors_logger = logging.getLogger("casewise.cors")
+documents_logger = logging.getLogger("casewise.documents")
+jobs_logger = logging.getLogger("casewise.jobs")
+llm_logger = logging.getLogger("casewise.llm")
+
 # Try to import PDF processing libraries
 PDF_AVAILABLE = False
 PDF_LIBRARY = None
@@ -39,20 +172,34 @@ try:
     import pypdf
     PDF_AVAILABLE = True
     PDF_LIBRARY = "pypdf"
-    print("pypdf available for PDF processing")
+    logger.info("pypdf available for PDF processing")
 except ImportError:
     try:
         import PyPDF2
         PDF_AVAILABLE = True
         PDF_LIBRARY = "PyPDF2"
-        print("PyPDF2 available for PDF processing")
+        logger.info("PyPDF2 available for PDF processing")
     except ImportError:
         PDF_AVAILABLE = False
         PDF_LIBRARY = None
-        print("No PDF processing library available - PDF processing will use fallback content")
+        logger.info("No PDF processing library available - PDF processing will use fallback content")
 
+# scikit-learn tokenizes documents for context retrieval; a regex tokenizer is used without it
+try:
+    from sklearn.feature_extraction.text import CountVectorizer
+    SKLEARN_AVAILABLE = True
+except ImportError:
+    SKLEARN_AVAILABLE = False
+    logger.info("scikit-learn not available - context retrieval will use a basic tokenizer")
+
+# Pillow renders profile image thumbnails; without it every size is served the original image
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+    logger.info("Pillow not available - profile images will be served without thumbnails")
 
-load_dotenv()
 
 class PDFContentExtractor:
     """Enhanced PDF content extractor for medical cases and MCQs"""
@@ -70,44 +217,39 @@ class PDFContentExtractor:
     def extract_text_from_pdf(self, pdf_content: bytes) -> Dict[str, any]:
         """Extract text and structure from PDF"""
         try:
-            pdf_reader = pypdf.PdfReader(io.BytesIO(pdf_content))
-            
-            result = {
-                "full_text": "",
-                "pages": [],
-                "total_pages": len(pdf_reader.pages),
-                "detected_cases": [],
-                "detected_mcqs": [],
-                "has_cases": False,
-                "has_mcqs": False
-            }
-            
-            # Extract text from each page
-            for page_num, page in enumerate(pdf_reader.pages):
-                page_text = page.extract_text()
-                
-                if page_text.strip():
-                    result["full_text"] += f"\n--- Page {page_num + 1} ---\n"
-                    result["full_text"] += page_text
-                    
-                    result["pages"].append({
-                        "page_number": page_num + 1,
-                        "text": page_text,
-                        "char_count": len(page_text)
-                    })
-            
-            # Detect cases and MCQs
-            result["detected_cases"] = self.detect_cases(result["full_text"])
-            result["detected_mcqs"] = self.detect_mcqs(result["full_text"])
-            
-            result["has_cases"] = len(result["detected_cases"]) > 0
-            result["has_mcqs"] = len(result["detected_mcqs"]) > 0
-            
-            return result
-            
+            pages = extract_pdf_page_range(pdf_content)
+            return self.analyze_pages(pages, len(pages))
         except Exception as e:
             raise Exception(f"PDF extraction failed: {str(e)}")
     
+    def analyze_pages(self, pages: List[Dict[str, any]], total_pages: int) -> Dict[str, any]:
+        """Assemble extracted pages in order and detect cases and MCQs"""
+        result = {
+            "full_text": pdf_pages_to_text(pages),
+            "pages": [
+                {
+                    "page_number": page["page_number"],
+                    "text": page["text"],
+                    "char_count": page["char_count"]
+                }
+                for page in pages if page["text"].strip()
+            ],
+            "total_pages": total_pages,
+            "detected_cases": [],
+            "detected_mcqs": [],
+            "has_cases": False,
+            "has_mcqs": False
+        }
+        
+        # Detect cases and MCQs
+        result["detected_cases"] = self.detect_cases(result["full_text"])
+        result["detected_mcqs"] = self.detect_mcqs(result["full_text"])
+        
+        result["has_cases"] = len(result["detected_cases"]) > 0
+        result["has_mcqs"] = len(result["detected_mcqs"]) > 0
+        
+        return result
+    
     def detect_cases(self, text: str) -> List[Dict[str, str]]:
         """Detect medical cases in text"""
         cases = []
@@ -225,6 +367,208 @@ class PDFContentExtractor:
         matches = sum(1 for indicator in case_indicators if indicator in text_lower)
         return matches >= 3
 
+# Uploads are streamed to disk in chunks so a request never holds the whole file in memory
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+
+class SpooledUpload:
+    """An uploaded file copied to a temp file, with its size and SHA-256 computed while copying"""
+    
+    def __init__(self, path: str, size: int, sha256: str):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+    
+    def read_text(self) -> str:
+        """Decode the file as UTF-8"""
+        with open(self.path, "r", encoding="utf-8") as f:
+            return f.read()
+    
+    def cleanup(self):
+        """Delete the temp file"""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+async def spool_upload(file: UploadFile, max_bytes: Optional[int] = None) -> SpooledUpload:
+    """Copy an upload to a size-capped temp file one chunk at a time, hashing as it goes"""
+    max_bytes = max_bytes or UPLOAD_MAX_BYTES
+    hasher = hashlib.sha256()
+    size = 0
+    spool = tempfile.NamedTemporaryFile(prefix="casewise-upload-", delete=False)
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            # Clients can omit or understate the size, so enforce the cap on the bytes actually received
+            if size > max_bytes:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"File size exceeds {max_bytes // (1024 * 1024)}MB limit"
+                )
+            hasher.update(chunk)
+            spool.write(chunk)
+        spool.close()
+    except BaseException:
+        spool.close()
+        os.unlink(spool.name)
+        raise
+    return SpooledUpload(spool.name, size, hasher.hexdigest())
+
+# PDF page extraction runs in worker processes so large uploads neither block the event loop nor hold the GIL
+PDF_EXTRACTION_WORKERS = max(1, int(os.getenv("PDF_EXTRACTION_WORKERS", str(min(4, os.cpu_count() or 1)))))
+# Smaller PDFs are extracted in a thread; shipping them to worker processes costs more than it saves
+PDF_PARALLEL_MIN_PAGES = max(1, int(os.getenv("PDF_PARALLEL_MIN_PAGES", "16")))
+
+pdf_process_pool = None
+
+def get_pdf_process_pool() -> ProcessPoolExecutor:
+    """Process pool for PDF extraction, created on first use"""
+    global pdf_process_pool
+    if pdf_process_pool is None:
+        # spawn rather than fork: the server process already runs threads (Mongo, httpx, job workers)
+        pdf_process_pool = ProcessPoolExecutor(
+            max_workers=PDF_EXTRACTION_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return pdf_process_pool
+
+def warm_pdf_process_pool():
+    """Start the PDF workers ahead of the first large upload; each worker imports this module once"""
+    if PDF_AVAILABLE and PDF_EXTRACTION_WORKERS > 1:
+        pool = get_pdf_process_pool()
+        for _ in range(PDF_EXTRACTION_WORKERS):
+            pool.submit(os.getpid)
+
+def shutdown_pdf_process_pool():
+    """Stop the PDF worker processes"""
+    global pdf_process_pool
+    if pdf_process_pool is not None:
+        pdf_process_pool.shutdown(wait=False, cancel_futures=True)
+        pdf_process_pool = None
+
+def open_pdf_source(source):
+    """Binary stream for a PDF given as bytes or as a file path; paths stay file-backed"""
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    return open(source, "rb")
+
+def open_pdf_reader(stream):
+    """PdfReader from whichever PDF library is installed"""
+    if PDF_LIBRARY == "pypdf":
+        return pypdf.PdfReader(stream)
+    return PyPDF2.PdfReader(stream)
+
+def count_pdf_pages(source) -> int:
+    """Number of pages in a PDF"""
+    with open_pdf_source(source) as stream:
+        return len(open_pdf_reader(stream).pages)
+
+def extract_pdf_page_range(source, start: int = 0, end: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Extract pages [start, end) with the time each page took; runs inside PDF worker processes"""
+    with open_pdf_source(source) as stream:
+        reader = open_pdf_reader(stream)
+        end = len(reader.pages) if end is None else min(end, len(reader.pages))
+        pages = []
+        for page_num in range(start, end):
+            started = time.perf_counter()
+            page_text = reader.pages[page_num].extract_text() or ""
+            pages.append({
+                "page_number": page_num + 1,
+                "text": page_text,
+                "char_count": len(page_text),
+                "seconds": round(time.perf_counter() - started, 4)
+            })
+    return pages
+
+async def extract_pdf_pages(source) -> Dict[str, Any]:
+    """Extract all pages of a PDF, sharded across the PDF process pool for large files.
+
+    source is the PDF bytes or, preferably, a file path: workers then open the
+    file themselves instead of receiving a copy of the bytes per shard.
+
+    Returns the pages in page order along with the page count, the number of
+    workers and shards used and the total wall-clock time.
+    """
+    started = time.perf_counter()
+    total_pages = await asyncio.to_thread(count_pdf_pages, source)
+    workers = min(PDF_EXTRACTION_WORKERS, total_pages)
+    pages = None
+    shards = 1
+    
+    if workers > 1 and total_pages >= PDF_PARALLEL_MIN_PAGES:
+        # Two shards per worker evens out pages that are much slower than others
+        shard_size = math.ceil(total_pages / (workers * 2))
+        ranges = [(start, min(start + shard_size, total_pages)) for start in range(0, total_pages, shard_size)]
+        loop = asyncio.get_running_loop()
+        try:
+            pool = get_pdf_process_pool()
+            shard_results = await asyncio.gather(*[
+                loop.run_in_executor(pool, extract_pdf_page_range, source, start, end)
+                for start, end in ranges
+            ])
+            pages = [page for shard in shard_results for page in shard]
+            shards = len(ranges)
+        except (BrokenProcessPool, OSError) as e:
+            documents_logger.warning("⚠️ PDF process pool unavailable, extracting in a thread: %s", e)
+            shutdown_pdf_process_pool()
+            workers = 1
+    else:
+        workers = 1
+    
+    if pages is None:
+        pages = await asyncio.to_thread(extract_pdf_page_range, source)
+    
+    return {
+        "pages": pages,
+        "total_pages": total_pages,
+        "workers": workers,
+        "shards": shards,
+        "seconds": round(time.perf_counter() - started, 4)
+    }
+
+def pdf_pages_to_text(pages: List[Dict[str, Any]]) -> str:
+    """Join extracted pages into document text with page markers, skipping blank pages"""
+    return "".join(
+        f"\n--- Page {page['page_number']} ---\n{page['text']}"
+        for page in pages if page["text"].strip()
+    )
+
+def pdf_extraction_timing(extraction: Dict[str, Any]) -> Dict[str, Any]:
+    """Timing fields recorded in a document's extraction_metadata"""
+    return {
+        "total_pages": extraction["total_pages"],
+        "extraction_seconds": extraction["seconds"],
+        "extraction_workers": extraction["workers"],
+        "extraction_shards": extraction["shards"],
+        "page_timings": [
+            {"page_number": page["page_number"], "seconds": page["seconds"], "char_count": page["char_count"]}
+            for page in extraction["pages"]
+        ]
+    }
+
+def extract_docx_text(source) -> str:
+    """Paragraph and table text of a DOCX file; blocking, so callers run it in a thread"""
+    import docx
+    doc = docx.Document(source)
+    content_str = ""
+
+    for paragraph in doc.paragraphs:
+        if paragraph.text.strip():
+            content_str += paragraph.text + "\n"
+
+    # Also extract text from tables
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                if cell.text.strip():
+                    content_str += cell.text + " "
+            content_str += "\n"
+    return content_str
+
 MONGODB_URL = os.getenv("MONGODB_URL")
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 SECRET_KEY = os.getenv("SECRET_KEY")
@@ -232,123 +576,1609 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 ALGORITHM = "HS256"
 
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "200"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "50"))
+# Max sections of one /ai/auto-generate request that may call the model at the same time
+AUTO_GENERATE_MAX_CONCURRENCY = max(1, int(os.getenv("AUTO_GENERATE_MAX_CONCURRENCY", "4")))
+
+# Error categories the retry engine understands
+RETRYABLE_LLM_ERRORS = {"rate_limit", "timeout", "connection", "server"}
+
+class RetryExhaustedError(Exception):
+    """Raised when a retry policy gives up on a retryable failure"""
+    
+    def __init__(self, last_error: Exception, attempts: int, category: str):
+        super().__init__(str(last_error))
+        self.last_error = last_error
+        self.attempts = attempts
+        self.category = category
+
+def classify_llm_error(error: Exception) -> str:
+    """Classify an LLM call failure as rate_limit, timeout, connection, server, parse or fatal"""
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    # APITimeoutError subclasses APIConnectionError, so check it first
+    if isinstance(error, (openai.APITimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    if isinstance(error, openai.APIStatusError):
+        return "server" if error.status_code >= 500 else "fatal"
+    # json.JSONDecodeError and pydantic's ValidationError are both ValueErrors
+    if isinstance(error, (ValueError, KeyError)):
+        return "parse"
+    return "fatal"
+
+def get_retry_after_seconds(error: Exception) -> Optional[float]:
+    """Read the Retry-After hint from an API error response, if there is one"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    
+    retry_after_ms = response.headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    
+    retry_after = response.headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # Retry-After may also be an HTTP date
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RetryPolicy:
+    """Async retry policy with jittered exponential backoff and a total deadline budget"""
+    
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 16.0,
+        deadline: Optional[float] = None,
+        retry_on: set = RETRYABLE_LLM_ERRORS
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_on = retry_on
+    
+    def compute_delay(self, attempt: int, error: Exception) -> float:
+        """Full-jitter exponential backoff, never shorter than the server's Retry-After"""
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+        retry_after = get_retry_after_seconds(error)
+        if retry_after is not None:
+            return max(retry_after, backoff)
+        return backoff
+    
+    async def run(self, operation, description: str = "LLM call"):
+        """Await operation() until it succeeds, fails fatally or the budget runs out"""
+        started_at = time.monotonic()
+        attempt = 0
+        
+        while True:
+            attempt += 1
+            try:
+                if self.deadline is None:
+                    return await operation()
+                remaining = self.deadline - (time.monotonic() - started_at)
+                if remaining <= 0:
+                    raise asyncio.TimeoutError(f"{description} exceeded its {self.deadline:.0f}s deadline")
+                return await asyncio.wait_for(operation(), timeout=remaining)
+            except Exception as e:
+                category = classify_llm_error(e)
+                if category not in self.retry_on:
+                    raise
+                if attempt >= self.max_attempts:
+                    llm_logger.error("❌ %s failed after %s attempts (%s): %s", description, attempt, category, e)
+                    raise RetryExhaustedError(e, attempt, category) from e
+                
+                delay = self.compute_delay(attempt, e)
+                if self.deadline is not None and (time.monotonic() - started_at) + delay >= self.deadline:
+                    llm_logger.error("❌ %s out of retry budget after %s attempts (%s): %s", description, attempt, category, e)
+                    raise RetryExhaustedError(e, attempt, category) from e
+                
+                llm_logger.warning("🔄 %s failed (%s) on attempt %s/%s, retrying in %.1fs: %s", description, category, attempt, self.max_attempts, delay, e)
+                await asyncio.sleep(delay)
+
+# Transport-level retries shared by every LLM call site
+LLM_RETRY_POLICY = RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=16.0, deadline=300.0)
+# Concept generation also retries unparseable or incomplete model output
+CONCEPT_RETRY_POLICY = RetryPolicy(
+    max_attempts=6,
+    base_delay=1.0,
+    max_delay=16.0,
+    deadline=600.0,
+    retry_on=RETRYABLE_LLM_ERRORS | {"parse"}
+)
+# For call sites that wrap the gateway in their own retry policy
+NO_RETRY_POLICY = RetryPolicy(max_attempts=1)
+
+class LLMGateway:
+    """Shared async OpenAI client with a connection-pooled HTTP transport"""
+    
+    def __init__(
+        self,
+        api_key: str,
+        max_connections: int = 200,
+        max_keepalive_connections: int = 50,
+        retry_policy: RetryPolicy = LLM_RETRY_POLICY
+    ):
+        # One pooled HTTP client for the whole process so concurrent completions
+        # reuse keep-alive connections instead of opening a socket per request
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections
+            ),
+            timeout=httpx.Timeout(120.0, connect=10.0)
+        )
+        # Retries are owned by RetryPolicy so they honour our deadline budget
+        self.client = AsyncOpenAI(api_key=api_key, http_client=self.http_client, max_retries=0)
+        self.retry_policy = retry_policy
+    
+    async def chat_completion(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        retry_policy: Optional[RetryPolicy] = None,
+        **options
+    ):
+        """Run a chat completion without blocking the event loop"""
+        policy = retry_policy or self.retry_policy
+        return await policy.run(
+            lambda: self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                **options
+            ),
+            description=f"{model} completion"
+        )
+    
+    async def stream_chat_completion(self, model: str, messages: list, retry_policy: RetryPolicy = None, **options):
+        """Yield content deltas of a streamed chat completion as they arrive.
+
+        Only opening the stream is retried; once tokens have been forwarded a
+        failure propagates to the caller.
+        """
+        policy = retry_policy or self.retry_policy
+        stream = await policy.run(
+            lambda: self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                **options
+            ),
+            description=f"{model} stream"
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+    
+    async def list_models(self):
+        """List the models available to the configured API key"""
+        return await self.client.models.list()
+    
+    async def aclose(self):
+        """Close the pooled HTTP client"""
+        await self.client.close()
+
 # Configure OpenAI AI
-openai_client = None
+llm_gateway = None
 if OPENAI_API_KEY:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    llm_gateway = LLMGateway(
+        api_key=OPENAI_API_KEY,
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS
+    )
 
-# Simple password hashing with SHA-256
-security = HTTPBearer()
+# Generation result cache
+LLM_CACHE_BACKENDS = [b.strip() for b in os.getenv("LLM_CACHE_BACKENDS", "memory,mongo").split(",") if b.strip()]
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "512"))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Bump a template's version whenever its prompt or post-processing changes so old entries stop matching
+PROMPT_TEMPLATE_VERSIONS = {
+    "case_titles": 2,
+    "mcqs": 2,
+    "concepts": 1
+}
+
+def normalize_cache_text(text: Optional[str]) -> str:
+    """Collapse whitespace and case so trivially different inputs share a cache entry"""
+    return " ".join(text.split()).lower() if text else ""
+
+def document_content_hash(document: dict) -> str:
+    """SHA-256 of a document's extracted text"""
+    return document.get("content_hash") or hashlib.sha256(document.get("content", "").encode("utf-8")).hexdigest()
+
+class InMemoryLRUCacheBackend:
+    """Per-process LRU cache with expiry"""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int = LLM_CACHE_MAX_ENTRIES, ttl_seconds: int = LLM_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+
+    async def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: dict, template: str):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+class MongoCacheBackend:
+    """Shared cache in the llm_response_cache collection; a TTL index on expires_at evicts entries"""
+
+    name = "mongo"
+
+    def __init__(self, ttl_seconds: int = LLM_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+
+    async def get(self, key: str):
+        entry = await llm_cache_repository.find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}})
+        return entry["value"] if entry else None
+
+    async def set(self, key: str, value: dict, template: str):
+        now = datetime.utcnow()
+        await llm_cache_repository.update_one(
+            {"_id": key},
+            {"$set": {
+                "value": value,
+                "template": template,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=self.ttl_seconds)
+            }},
+            upsert=True
+        )
 
+LLM_CACHE_BACKEND_TYPES = {
+    InMemoryLRUCacheBackend.name: InMemoryLRUCacheBackend,
+    MongoCacheBackend.name: MongoCacheBackend
+}
 
-client = None
-db = None
+class LLMResponseCache:
+    """Content-addressed cache of validated generation results.
 
-def connect_to_mongodb():
-    global client, db
-    try:
-        client = pymongo.MongoClient(MONGODB_URL)
-        db = client[DATABASE_NAME]
-        
-        client.server_info()
-        print(f"Connected to MongoDB: {DATABASE_NAME}")
+    Keys hash the prompt template version, model, normalized inputs and the
+    document content hash. Backends are consulted in order and a hit in a
+    slower backend is copied into the faster ones.
+    """
+
+    def __init__(self, backends: list):
+        self.backends = backends
+        self.counters = defaultdict(lambda: {"hits": 0, "misses": 0, "bypassed": 0, "stored": 0})
+
+    def make_key(self, template: str, model: str, inputs: dict, content_hash: str) -> str:
+        material = json.dumps({
+            "template": template,
+            "version": PROMPT_TEMPLATE_VERSIONS[template],
+            "model": model,
+            "inputs": inputs,
+            "content_hash": content_hash
+        }, sort_keys=True, default=str)
+        return f"{template}:{hashlib.sha256(material.encode('utf-8')).hexdigest()}"
+
+    async def get(self, key: str, template: str, bypass: bool = False):
+        """Return the cached value or None; bypass skips the lookup but still counts the request"""
+        if bypass:
+            self.counters[template]["bypassed"] += 1
+            return None
+        for position, backend in enumerate(self.backends):
+            try:
+                value = await backend.get(key)
+            except Exception as e:
+                llm_logger.warning("⚠️ LLM cache backend '%s' read failed: %s", backend.name, e)
+                continue
+            if value is not None:
+                for faster in self.backends[:position]:
+                    try:
+                        await faster.set(key, value, template)
+                    except Exception as e:
+                        llm_logger.warning("⚠️ LLM cache backend '%s' write failed: %s", faster.name, e)
+                self.counters[template]["hits"] += 1
+                llm_logger.info("💾 LLM cache hit for %s (%s)", template, backend.name)
+                return value
+        self.counters[template]["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: dict, template: str):
+        for backend in self.backends:
+            try:
+                await backend.set(key, value, template)
+            except Exception as e:
+                llm_logger.warning("⚠️ LLM cache backend '%s' write failed: %s", backend.name, e)
+        self.counters[template]["stored"] += 1
+
+    def stats(self) -> dict:
+        templates = {}
+        for template, counts in self.counters.items():
+            lookups = counts["hits"] + counts["misses"]
+            templates[template] = {**counts, "hit_rate": round(counts["hits"] / lookups, 4) if lookups else 0.0}
+        return {"backends": [backend.name for backend in self.backends], "templates": templates}
+
+llm_response_cache = LLMResponseCache(
+    [LLM_CACHE_BACKEND_TYPES[name]() for name in LLM_CACHE_BACKENDS]
+)
+
+class SingleFlight:
+    """Coalesce concurrent identical generations into one upstream call.
+
+    The first caller for a key starts the work as its own task; callers that
+    arrive while it is running await the same task, so a disconnecting client
+    never cancels the work for the others.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+        self.counters = defaultdict(lambda: {"leaders": 0, "coalesced": 0})
+
+    async def run(self, key: str, template: str, operation):
+        task = self.in_flight.get(key)
+        if task is None:
+            self.counters[template]["leaders"] += 1
+            task = asyncio.ensure_future(operation())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.counters[template]["coalesced"] += 1
+            llm_logger.info("🔗 Joined in-flight %s generation", template)
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        templates = {}
+        for template, counts in self.counters.items():
+            requests_seen = counts["leaders"] + counts["coalesced"]
+            templates[template] = {
+                **counts,
+                "coalescing_rate": round(counts["coalesced"] / requests_seen, 4) if requests_seen else 0.0
+            }
+        return {"in_flight": len(self.in_flight), "templates": templates}
+
+generation_flights = SingleFlight()
+
+# Context retrieval: page/section-aware chunks ranked with BM25
+RETRIEVAL_CHUNK_TOKENS = int(os.getenv("RETRIEVAL_CHUNK_TOKENS", "128"))
+BM25_K1 = 1.5
+BM25_B = 0.75
+PAGE_MARKER_PATTERN = re.compile(r"^--- Page (\d+) ---$", re.MULTILINE)
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"(?<=[.!?])\s+")
+TERM_PATTERN = r"(?u)\b[a-zA-Z][a-zA-Z0-9\-]+\b"
+
+if SKLEARN_AVAILABLE:
+    analyze_terms = CountVectorizer(token_pattern=TERM_PATTERN, stop_words="english").build_analyzer()
+else:
+    def analyze_terms(text: str) -> List[str]:
+        return [term for term in re.findall(TERM_PATTERN, text.lower()) if len(term) > 1]
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English text)"""
+    return (len(text) + 3) // 4
+
+def is_section_heading(line: str) -> bool:
+    """Heuristic for headings in extracted PDF/DOCX text"""
+    stripped = line.strip()
+    if not stripped or len(stripped) > 80 or stripped.endswith((".", ",", ";")):
+        return False
+    words = stripped.split()
+    if len(words) > 10:
+        return False
+    if stripped.isupper() or re.match(r"^(\d+(\.\d+)*|[IVX]+)[.)]?\s+\w", stripped):
+        return True
+    return stripped.endswith(":") or all(word[0].isupper() for word in words if word[0].isalpha())
+
+def split_document_units(text: str):
+    """Yield (start, end, page, is_heading) line-level units, splitting overlong lines on sentences"""
+    page = None
+    max_chars = RETRIEVAL_CHUNK_TOKENS * 4
+    for match in re.finditer(r"[^\n]+", text):
+        line = match.group(0)
+        marker = PAGE_MARKER_PATTERN.match(line)
+        if marker:
+            page = int(marker.group(1))
+            continue
+        if not line.strip():
+            continue
+        if len(line) <= max_chars:
+            yield match.start(), match.end(), page, is_section_heading(line)
+            continue
+        piece_start = match.start()
+        for boundary in SENTENCE_BOUNDARY_PATTERN.finditer(line):
+            boundary_end = match.start() + boundary.start()
+            if boundary_end - piece_start >= max_chars:
+                yield piece_start, boundary_end, page, False
+                piece_start = match.start() + boundary.end()
+        while match.end() - piece_start > max_chars:
+            yield piece_start, piece_start + max_chars, page, False
+            piece_start += max_chars
+        if piece_start < match.end():
+            yield piece_start, match.end(), page, False
+
+def chunk_document_text(text: str) -> List[dict]:
+    """Split text into chunks of about RETRIEVAL_CHUNK_TOKENS that never cross a page and start at headings"""
+    chunks = []
+    current = None
+    section = None
+    for start, end, page, heading in split_document_units(text):
+        if heading:
+            section = text[start:end].strip().rstrip(":")
+        starts_new = (
+            current is None
+            or page != current["page"]
+            or (heading and current["end"] > current["start"])
+            or estimate_tokens(text[current["start"]:end]) > RETRIEVAL_CHUNK_TOKENS
+        )
+        if starts_new:
+            if current:
+                chunks.append(current)
+            current = {"index": len(chunks), "page": page, "section": section, "start": start, "end": end}
+        else:
+            current["end"] = end
+    if current:
+        chunks.append(current)
+    return chunks
+
+DOCUMENT_INDEX_VERSION = 1
+
+def clean_document_content(content):
+    """Remove metadata and non-medical content from document."""
+    if not content:
+        return ""
+    
+    lines = content.split('\n')
+    cleaned_lines = []
+    skip_section = False
+    
+    # Keywords that indicate metadata sections to skip
+    metadata_indicators = [
+        "author:", "authors:", "publication:", "published:", "journal:",
+        "copyright", "doi:", "isbn:", "issn:", "reference", "citation",
+        "bibliography", "acknowledgment", "affiliation", "institution:",
+        "university:", "department:", "page", "chapter", "section",
+        "abstract:", "keywords:", "corresponding author"
+    ]
+    
+    for line in lines:
+        line_lower = line.lower().strip()
         
-        db.users.create_index("email", unique=True)
-        db.users.create_index("username", unique=True)
-        db.documents.create_index("uploaded_by")
-        db.documents.create_index("uploaded_at")
-        db.chats.create_index("user_id")
-        db.chats.create_index("updated_at")
-        db.chat_messages.create_index("chat_id")
-        db.chat_messages.create_index("timestamp")
-        db.generated_cases.create_index("chat_id")
-        db.generated_cases.create_index("document_id")
-        db.generated_mcqs.create_index("chat_id")
-        db.generated_mcqs.create_index("document_id")
-        db.generated_concepts.create_index("chat_id")
-        db.generated_concepts.create_index("document_id")
+        # Skip lines that are clearly metadata
+        if any(indicator in line_lower for indicator in metadata_indicators):
+            # Check if it's actually metadata (not a medical term)
+            if any(term in line_lower for term in ["author", "publication", "journal", "copyright", 
+                                                   "doi", "isbn", "issn", "reference", "citation",
+                                                   "bibliography", "acknowledgment", "affiliation"]):
+                skip_section = True
+                continue
         
-        # Create admin user if it doesn't exist
-        create_admin_user()
+        # Skip empty lines if we're in a metadata section
+        if skip_section and not line.strip():
+            continue
+        
+        # Reset skip flag if we hit a new substantial line (likely medical content)
+        if skip_section and len(line.strip()) > 20 and not any(indicator in line_lower for indicator in metadata_indicators):
+            skip_section = False
+        
+        if not skip_section:
+            cleaned_lines.append(line)
+    
+    cleaned = '\n'.join(cleaned_lines)
+    
+    # Remove common metadata patterns
+    import re
+    # Remove lines with email patterns
+    cleaned = re.sub(r'[\w\.-]+@[\w\.-]+\.\w+', '', cleaned)
+    # Remove lines with URL patterns
+    cleaned = re.sub(r'https?://\S+', '', cleaned)
+    # Remove lines that are just numbers (likely page numbers)
+    cleaned = re.sub(r'^\s*\d+\s*$', '', cleaned, flags=re.MULTILINE)
+    
+    return cleaned.strip()
+
+def prepare_index_text(content: str) -> str:
+    """Cleaned text the chunk index is built from"""
+    cleaned = clean_document_content(content)
+    # If cleaning removed too much, index the original text instead
+    if len(cleaned.strip()) < 100 and len(content) > 500:
+        documents_logger.warning("WARNING: Document cleaning removed too much content. Indexing original text.")
+        return content
+    return cleaned
+
+class DocumentChunkIndex:
+    """BM25 index over a document's chunks.
+
+    Scoring only needs the postings of the query terms plus per-chunk lengths,
+    and chunk text is fetched through `load_texts` for the chunks selected, so
+    an index loaded from Mongo never reads the whole document.
+    """
+
+    def __init__(self, chunk_tokens: List[int], chunk_lengths: List[int], postings: Dict[str, list], load_texts):
+        self.chunk_tokens = chunk_tokens
+        self.chunk_lengths = chunk_lengths
+        self.average_length = (sum(chunk_lengths) / len(chunk_lengths)) if chunk_lengths else 0.0
+        self.postings = postings
+        self.load_texts = load_texts
+
+    @classmethod
+    def build(cls, text: str) -> "DocumentChunkIndex":
+        """Chunk and index text in memory; the result also carries what save() persists"""
+        chunks = chunk_document_text(text)
+        chunk_texts = [text[chunk["start"]:chunk["end"]] for chunk in chunks]
+        chunk_terms = None
+        if SKLEARN_AVAILABLE and chunk_texts:
+            vectorizer = CountVectorizer(analyzer=analyze_terms)
+            try:
+                counts = vectorizer.fit_transform(chunk_texts).tocsr()
+                vocabulary = vectorizer.get_feature_names_out()
+                chunk_terms = [
+                    {str(vocabulary[col]): int(value) for col, value in zip(
+                        counts.indices[counts.indptr[row]:counts.indptr[row + 1]],
+                        counts.data[counts.indptr[row]:counts.indptr[row + 1]]
+                    )}
+                    for row in range(len(chunk_texts))
+                ]
+            except ValueError:
+                # Every chunk was empty after stop-word removal
+                chunk_terms = [{} for _ in chunk_texts]
+        if chunk_terms is None:
+            chunk_terms = []
+            for chunk_text in chunk_texts:
+                terms = defaultdict(int)
+                for term in analyze_terms(chunk_text):
+                    terms[term] += 1
+                chunk_terms.append(dict(terms))
+
+        postings = defaultdict(list)
+        for position, terms in enumerate(chunk_terms):
+            for term, tf in terms.items():
+                postings[term].append([position, tf])
+
+        index = cls(
+            chunk_tokens=[estimate_tokens(chunk_text) for chunk_text in chunk_texts],
+            chunk_lengths=[sum(terms.values()) for terms in chunk_terms],
+            postings=dict(postings),
+            load_texts=lambda positions: {position: chunk_texts[position] for position in positions}
+        )
+        index.chunks = chunks
+        index.chunk_texts = chunk_texts
+        index.chunk_terms = chunk_terms
+        return index
+
+    def save(self, document_id: str, content_hash: str):
+        """Persist a built index: a header in document_indexes and one document_chunks entry per chunk.
+
+        Chunks are written under a new generation and the header is switched to it last, so a
+        concurrent load always sees one complete generation. Generation ids are ObjectId strings,
+        which order by creation; an older save never replaces a newer one.
+        """
+        now = datetime.utcnow()
+        generation = str(ObjectId())
+        if self.chunks:
+            db.document_chunks.insert_many([
+                {
+                    "document_id": document_id,
+                    "generation": generation,
+                    "index": position,
+                    "page": chunk["page"],
+                    "section": chunk["section"],
+                    "start": chunk["start"],
+                    "end": chunk["end"],
+                    "token_count": self.chunk_tokens[position],
+                    "terms": self.chunk_terms[position],
+                    "text": self.chunk_texts[position]
+                }
+                for position, chunk in enumerate(self.chunks)
+            ])
+        header = {
+            "version": DOCUMENT_INDEX_VERSION,
+            "generation": generation,
+            "content_hash": content_hash,
+            "chunk_count": len(self.chunks),
+            "chunk_tokens": self.chunk_tokens,
+            "chunk_lengths": self.chunk_lengths,
+            "postings": self.postings,
+            "postings_inline": True,
+            "created_at": now
+        }
+        older = {"_id": document_id, "$or": [{"generation": {"$lt": generation}}, {"generation": {"$exists": False}}]}
+        try:
+            try:
+                db.document_indexes.replace_one(older, header, upsert=True)
+            except pymongo.errors.DocumentTooLarge:
+                # Huge vocabularies don't fit one BSON document; postings are then read from the chunks' terms
+                header.update({"postings": {}, "postings_inline": False})
+                db.document_indexes.replace_one(older, header, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            # A newer generation is already live; this one was never visible
+            db.document_chunks.delete_many({"document_id": document_id, "generation": generation})
+            return
         
+        # Readers have moved to the new header; drop the generations it replaced
+        db.document_chunks.delete_many({
+            "document_id": document_id,
+            "$or": [{"generation": {"$lt": generation}}, {"generation": {"$exists": False}}]
+        })
+
+    @classmethod
+    def load(cls, document_id: str, query: Optional[str]) -> Optional["DocumentChunkIndex"]:
+        """Load the persisted index with postings for the query terms only"""
+        terms = sorted(set(analyze_terms(query or "")))
+        projection = {"version": 1, "generation": 1, "chunk_tokens": 1, "chunk_lengths": 1, "postings_inline": 1}
+        projection.update({f"postings.{term}": 1 for term in terms})
+        header = db.document_indexes.find_one({"_id": document_id}, projection)
+        if header is None or header.get("version") != DOCUMENT_INDEX_VERSION:
+            return None
+        # Indexes saved before generations existed have none; their chunks lack the field too
+        chunk_query = {"document_id": document_id, "generation": header.get("generation")}
+
+        postings = header.get("postings", {})
+        if terms and not header.get("postings_inline", True):
+            postings = defaultdict(list)
+            matching_chunks = db.document_chunks.find(
+                {**chunk_query, "$or": [{f"terms.{term}": {"$exists": True}} for term in terms]},
+                {"index": 1, **{f"terms.{term}": 1 for term in terms}}
+            )
+            for chunk in matching_chunks:
+                for term, tf in chunk.get("terms", {}).items():
+                    postings[term].append([chunk["index"], tf])
+
+        def load_texts(positions):
+            return {
+                chunk["index"]: chunk["text"]
+                for chunk in db.document_chunks.find(
+                    {**chunk_query, "index": {"$in": list(positions)}},
+                    {"index": 1, "text": 1}
+                )
+            }
+
+        return cls(header["chunk_tokens"], header["chunk_lengths"], postings, load_texts)
+
+    def score(self, query: Optional[str]) -> List[float]:
+        """BM25 score of every chunk for the query"""
+        total = len(self.chunk_tokens)
+        scores = [0.0] * total
+        for term in set(analyze_terms(query or "")):
+            term_postings = self.postings.get(term)
+            if not term_postings:
+                continue
+            idf = math.log(1 + (total - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            for position, tf in term_postings:
+                length_norm = 1 - BM25_B + BM25_B * self.chunk_lengths[position] / (self.average_length or 1)
+                scores[position] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+        return scores
+
+    def select(self, query: Optional[str], token_budget: int) -> List[tuple]:
+        """(position, max_chars) of the top-ranked chunks that fit the token budget, in document order.
+
+        Without a query (or with no matching terms) chunks are sampled evenly
+        across the whole document instead of taking only its opening pages.
+        max_chars is None unless the single best chunk had to be truncated.
+        """
+        total = len(self.chunk_tokens)
+        if not total:
+            return []
+        scores = self.score(query)
+        if any(scores):
+            ranked = sorted(
+                (position for position in range(total) if scores[position] > 0),
+                key=lambda position: -scores[position]
+            )
+        else:
+            average_tokens = max(1, sum(self.chunk_tokens) // total)
+            wanted = max(1, token_budget // average_tokens)
+            stride = max(1.0, total / wanted)
+            ranked = sorted({int(n * stride) for n in range(wanted) if int(n * stride) < total})
+
+        selected = []
+        used_tokens = 0
+        for position in ranked:
+            if used_tokens + self.chunk_tokens[position] > token_budget:
+                continue
+            selected.append((position, None))
+            used_tokens += self.chunk_tokens[position]
+        if not selected:
+            # The best chunk alone is over budget: keep its beginning
+            selected.append((ranked[0], token_budget * 4))
+        return sorted(selected)
+
+    def context(self, query: Optional[str], token_budget: int) -> str:
+        """Prompt-ready text of the selected chunks"""
+        selected = self.select(query, token_budget)
+        texts = self.load_texts([position for position, _ in selected])
+        return "\n\n".join(
+            texts.get(position, "")[:max_chars].strip() for position, max_chars in selected
+        )
+
+# Recently used in-memory indexes, keyed by content hash, for documents without a stored index
+document_index_cache = OrderedDict()
+DOCUMENT_INDEX_CACHE_SIZE = 32
+
+def get_document_index(text: str) -> DocumentChunkIndex:
+    """Build (or reuse) an in-memory chunk index for text"""
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    index = document_index_cache.get(key)
+    if index is None:
+        index = DocumentChunkIndex.build(text)
+        document_index_cache[key] = index
+        while len(document_index_cache) > DOCUMENT_INDEX_CACHE_SIZE:
+            document_index_cache.popitem(last=False)
+    else:
+        document_index_cache.move_to_end(key)
+    return index
+
+def index_document(blob_id: str, content: str) -> DocumentChunkIndex:
+    """Clean, chunk and index a blob's text and persist the artifact under its id"""
+    started = time.perf_counter()
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    index = DocumentChunkIndex.build(prepare_index_text(content))
+    index.save(blob_id, content_hash)
+    index_metadata = {
+        "content_hash": content_hash,
+        "index_version": DOCUMENT_INDEX_VERSION,
+        "chunk_count": len(index.chunks)
+    }
+    db.document_blobs.update_one({"_id": blob_id}, {"$set": index_metadata})
+    documents_logger.info("📚 Indexed document %s: %s chunks in %.2fs", blob_id, len(index.chunks), time.perf_counter() - started)
+    return index
+
+def load_document_index(document: dict, query: Optional[str] = None) -> DocumentChunkIndex:
+    """Stored chunk index for a resolved document, building it first for blobs not indexed yet"""
+    blob_id = document.get("blob_id")
+    if blob_id is None:
+        # Failed extractions keep their placeholder text inline and are never indexed
+        return get_document_index(prepare_index_text(read_document_text(document)))
+    if document.get("index_version") == DOCUMENT_INDEX_VERSION:
+        index = DocumentChunkIndex.load(blob_id, query)
+        if index is not None:
+            return index
+    content = read_document_text(document)
+    try:
+        return index_document(blob_id, content)
     except Exception as e:
-        print(f"Failed to connect to MongoDB: {e}")
-        raise
+        documents_logger.warning("⚠️ Could not persist chunk index for document %s: %s", blob_id, e)
+        return get_document_index(prepare_index_text(content))
+
+async def select_document_context(document: dict, query: Optional[str], token_budget: int) -> str:
+    """Most relevant parts of a document for the query, within token_budget"""
+    # Index lookups mix Mongo reads with scoring, so they run on a worker thread with the sync client
+    return await asyncio.to_thread(
+        lambda: load_document_index(document, query).context(query, token_budget)
+    )
 
-def create_admin_user():
-    """Create a default admin user if it doesn't exist"""
+# Content-addressed document storage: each distinct uploaded file is extracted, stored and indexed once
+# in document_blobs (keyed by the SHA-256 of its bytes); per-user documents reference it by blob_id.
+# The text itself is kept in GridFS, so lookups only move metadata and large books aren't bound by
+# the 16MB document limit
+DOCUMENT_TEXT_BUCKET = "document_text"
+DOCUMENT_BLOB_FIELDS = ("content_hash", "text_file_id", "text_length", "index_version", "chunk_count", "extraction_metadata")
+# Hot lookups skip the inline text that documents stored before blobs existed still carry
+DOCUMENT_METADATA_PROJECTION = {"content": 0}
+
+def document_text_store() -> gridfs.GridFS:
+    """GridFS bucket holding document text"""
+    return gridfs.GridFS(db, collection=DOCUMENT_TEXT_BUCKET)
+
+def store_document_blob(blob_id: str, content_type: str, size: int, content: str, extraction_metadata: dict) -> dict:
+    """Store extracted text under blob_id and return the blob record"""
+    existing = db.document_blobs.find_one({"_id": blob_id}, DOCUMENT_METADATA_PROJECTION)
+    if existing:
+        return existing
+    
+    text_file_id = document_text_store().put(content.encode("utf-8"), content_type="text/plain; charset=utf-8")
+    blob = {
+        "_id": blob_id,
+        "text_file_id": text_file_id,
+        "text_length": len(content),
+        "content_hash": hashlib.sha256(content.encode("utf-8")).hexdigest(),
+        "content_type": content_type,
+        "size": size,
+        "extraction_metadata": extraction_metadata,
+        "ref_count": 0,
+        "created_at": datetime.utcnow()
+    }
     try:
-        if db is None:
-            return
-            
-        # Check if admin user already exists
-        admin_user = db.users.find_one({"email": "admin@casewise.com"})
-        if admin_user:
-            print("✅ Admin user already exists")
-            return
-            
-        # Create admin user
-        admin_password = "admin123"
-        hashed_password = hash_password(admin_password)
-        
-        admin_user_data = {
-            "email": "admin@casewise.com",
-            "username": "admin",
-            "full_name": "System Administrator",
-            "hashed_password": hashed_password,
-            "role": "admin",
-            "is_active": True,
-            "status": "active",
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
+        db.document_blobs.insert_one(blob)
+    except pymongo.errors.DuplicateKeyError:
+        # The same file finished processing in a concurrent upload; keep the copy already stored
+        document_text_store().delete(text_file_id)
+        return db.document_blobs.find_one({"_id": blob_id}, DOCUMENT_METADATA_PROJECTION)
+    return blob
+
+def link_document_blob(blob_id: str):
+    """Count one more document referencing a blob"""
+    db.document_blobs.update_one(
+        {"_id": blob_id},
+        {"$inc": {"ref_count": 1}, "$set": {"last_linked_at": datetime.utcnow()}}
+    )
+
+def migrate_inline_document_text(document: dict):
+    """Move the inline text of a document stored before blobs existed into a blob keyed by the text's hash"""
+    stored = db.documents.find_one({"_id": document["_id"]}, {"content": 1, "extraction_metadata": 1})
+    content = (stored or {}).get("content") or ""
+    encoded = content.encode("utf-8")
+    blob = store_document_blob(
+        hashlib.sha256(encoded).hexdigest(),
+        document.get("content_type"),
+        len(encoded),
+        content,
+        (stored or {}).get("extraction_metadata", {})
+    )
+    result = db.documents.update_one(
+        {"_id": document["_id"], "blob_id": {"$exists": False}},
+        {
+            "$set": {"blob_id": blob["_id"], "content_hash": blob["content_hash"]},
+            "$unset": {"content": "", "index_version": "", "chunk_count": ""}
         }
-        
-        result = db.users.insert_one(admin_user_data)
-        print(f"✅ Admin user created with ID: {result.inserted_id}")
-        print("📧 Admin credentials: admin@casewise.com / admin123")
-        
-    except Exception as e:
-        print(f"❌ Failed to create admin user: {e}")
+    )
+    if result.modified_count == 0:
+        # A concurrent read migrated the document first and already counted its reference
+        migrated = db.documents.find_one({"_id": document["_id"]}, {"blob_id": 1})
+        document["blob_id"] = (migrated or {}).get("blob_id", blob["_id"])
+        return
+    link_document_blob(blob["_id"])
+    document["blob_id"] = blob["_id"]
+    documents_logger.info("📦 Moved inline text of document %s to blob %s", document['_id'], blob['_id'][:12])
+
+def migrate_inline_blob_text(blob_id: str) -> Optional[dict]:
+    """Move text an older blob kept inline into GridFS"""
+    blob = db.document_blobs.find_one({"_id": blob_id}, {"content": 1})
+    content = (blob or {}).get("content") or ""
+    text_file_id = document_text_store().put(content.encode("utf-8"), content_type="text/plain; charset=utf-8")
+    return db.document_blobs.find_one_and_update(
+        {"_id": blob_id},
+        {"$set": {"text_file_id": text_file_id, "text_length": len(content)}, "$unset": {"content": ""}},
+        projection=DOCUMENT_METADATA_PROJECTION,
+        return_document=pymongo.ReturnDocument.AFTER
+    )
 
-def get_database():
-    return db
+async def resolve_document(document: Optional[dict]) -> Optional[dict]:
+    """Fill in a document's derived fields (but not its text) from its blob"""
+    if not document:
+        return document
+    if document.get("extraction_failed"):
+        # Placeholder text stays inline on the document, out of the shared blobs
+        return document
+    if not document.get("blob_id"):
+        await asyncio.to_thread(migrate_inline_document_text, document)
+    blob = await document_blob_repository.get(document["blob_id"])
+    if blob and "text_file_id" not in blob:
+        blob = await asyncio.to_thread(migrate_inline_blob_text, blob["_id"])
+    if blob:
+        document.update({field: blob[field] for field in DOCUMENT_BLOB_FIELDS if field in blob})
+    return document
+
+def decode_document_text(data: bytes, max_chars: Optional[int] = None) -> str:
+    """Decode text read from GridFS; a character cut at the end of a partial read is dropped"""
+    if max_chars is None:
+        return data.decode("utf-8")
+    return data.decode("utf-8", errors="ignore")[:max_chars]
+
+def read_document_text(document: dict, max_chars: Optional[int] = None) -> str:
+    """A resolved document's text from GridFS, or only its first max_chars characters (for worker threads)"""
+    if document.get("extraction_failed"):
+        content = (db.documents.find_one({"_id": document["_id"]}, {"content": 1}) or {}).get("content") or ""
+        return content if max_chars is None else content[:max_chars]
+    if not document.get("text_file_id"):
+        return ""
+    text_file = document_text_store().get(document["text_file_id"])
+    # A UTF-8 character is at most 4 bytes
+    return decode_document_text(text_file.read() if max_chars is None else text_file.read(max_chars * 4), max_chars)
+
+async def fetch_document_text(document: dict, max_chars: Optional[int] = None) -> str:
+    """Async read_document_text for request handlers"""
+    if document.get("extraction_failed"):
+        stored = await document_repository.find_one({"_id": document["_id"]}, {"content": 1})
+        content = (stored or {}).get("content") or ""
+        return content if max_chars is None else content[:max_chars]
+    if not document.get("text_file_id"):
+        return ""
+    with pymongo.timeout(MONGODB_OPERATION_TIMEOUT_SECONDS):
+        text_file = await gridfs.AsyncGridFS(async_db, collection=DOCUMENT_TEXT_BUCKET).get(document["text_file_id"])
+        data = await text_file.read() if max_chars is None else await text_file.read(max_chars * 4)
+    return decode_document_text(data, max_chars)
+
+async def document_text_preview(document: dict, max_chars: int = 200) -> str:
+    """Opening characters of a resolved document, with an ellipsis when there is more"""
+    preview = await fetch_document_text(document, max_chars)
+    return preview + "..." if document.get("text_length", 0) > max_chars else preview
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Startup
-    connect_to_mongodb()
-    yield
-    # Shutdown
-    if client:
-        client.close()
-        print("MongoDB connection closed")
 
-class UserSignup(BaseModel):
-    """Schema for user signup"""
-    email: EmailStr
-    username: str = Field(..., min_length=3, max_length=50)
-    password: str = Field(..., min_length=6)
-    full_name: Optional[str] = Field(None, max_length=100)
-    
-    @field_validator('password')
-    @classmethod
-    def validate_password_length(cls, v):
-        # Allow longer passwords - we'll truncate them in hash_password function
-        if len(v) < 6:
-            raise ValueError('Password must be at least 6 characters long')
-        return v
+# Simple password hashing with SHA-256
+security = HTTPBearer()
 
-class UserLogin(BaseModel):
-    """Schema for user login"""
-    email: EmailStr
-    password: str
-    remember_me: Optional[bool] = False
 
-class GoogleAuthRequest(BaseModel):
-    """Schema for Google OAuth authentication"""
-    id_token: str
+client = None
+db = None
+# Request handlers use the async client below; the synchronous one serves startup work and the
+# document indexing code, which runs in worker threads
+async_client = None
+async_db = None
+
+# Connection pool sizing and the time budget of a single database operation
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "5"))
+MONGODB_OPERATION_TIMEOUT_SECONDS = float(os.getenv("MONGODB_OPERATION_TIMEOUT_SECONDS", "10"))
+
+class MongoRepository:
+    """Async access to one collection; every operation is bounded by the repository timeout"""
+
+    collection_name = None
+
+    def __init__(self, collection_name: Optional[str] = None, timeout: Optional[float] = None):
+        self.collection_name = collection_name or self.collection_name
+        self.timeout = timeout or MONGODB_OPERATION_TIMEOUT_SECONDS
+
+    @property
+    def collection(self):
+        return async_db[self.collection_name]
+
+    async def find_one(self, query: dict, projection: Optional[dict] = None, **kwargs) -> Optional[dict]:
+        with pymongo.timeout(self.timeout):
+            return await self.collection.find_one(query, projection, **kwargs)
+
+    async def find_many(self, query: dict, projection: Optional[dict] = None, sort: Optional[list] = None,
+                        skip: int = 0, limit: int = 0) -> List[dict]:
+        with pymongo.timeout(self.timeout):
+            cursor = self.collection.find(query, projection, sort=sort, skip=skip, limit=limit)
+            return await cursor.to_list()
+
+    async def count(self, query: dict) -> int:
+        with pymongo.timeout(self.timeout):
+            return await self.collection.count_documents(query)
+
+    async def insert(self, document: dict) -> str:
+        """Insert a document (which gains its _id) and return the id as a string"""
+        with pymongo.timeout(self.timeout):
+            result = await self.collection.insert_one(document)
+        return str(result.inserted_id)
 
-class Token(BaseModel):
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        with pymongo.timeout(self.timeout):
+            return await self.collection.update_one(query, update, upsert=upsert)
+
+    async def update_many(self, query: dict, update: dict):
+        with pymongo.timeout(self.timeout):
+            return await self.collection.update_many(query, update)
+
+    async def find_one_and_update(self, query: dict, update: dict, **kwargs) -> Optional[dict]:
+        with pymongo.timeout(self.timeout):
+            return await self.collection.find_one_and_update(query, update, **kwargs)
+
+    async def delete_one(self, query: dict):
+        with pymongo.timeout(self.timeout):
+            return await self.collection.delete_one(query)
+
+    async def delete_many(self, query: dict):
+        with pymongo.timeout(self.timeout):
+            return await self.collection.delete_many(query)
+
+    async def aggregate(self, pipeline: list) -> List[dict]:
+        with pymongo.timeout(self.timeout):
+            cursor = await self.collection.aggregate(pipeline)
+            return await cursor.to_list()
+
+# Difficulty levels tracked in a user's difficulty_counts
+MCQ_DIFFICULTY_BUCKETS = ("easy", "moderate", "hard")
+
+class UserRepository(MongoRepository):
+    """Queries on the users collection"""
+
+    collection_name = "users"
+
+    async def get_by_id(self, user_id: str, projection: Optional[dict] = None) -> Optional[dict]:
+        return await self.find_one({"_id": ObjectId(user_id)}, projection)
+
+    async def get_by_email(self, email: str, role: Optional[str] = None) -> Optional[dict]:
+        query = {"email": email}
+        if role:
+            query["role"] = role
+        return await self.find_one(query)
+
+    async def get_by_username(self, username: str) -> Optional[dict]:
+        return await self.find_one({"username": username})
+
+    async def create(self, user_doc: dict) -> str:
+        return await self.insert(user_doc)
+
+    async def update_fields(self, user_id: str, fields: dict):
+        return await self.update_one({"_id": ObjectId(user_id)}, {"$set": fields})
+
+    async def record_mcq_completion(self, user_id: str, correct: int, total: int,
+                                    difficulty: Optional[str] = None) -> Optional[dict]:
+        """Add a quiz result to the user's MCQ totals in one atomic update and return the new totals"""
+        increments = {
+            "mcq_attempted": total,
+            "total_questions_correct": correct,
+            "total_questions_attempted": total
+        }
+        if difficulty in MCQ_DIFFICULTY_BUCKETS:
+            increments[f"difficulty_counts.{difficulty}"] = total
+        return await self.find_one_and_update(
+            {"_id": ObjectId(user_id)},
+            {"$inc": increments, "$set": {"updated_at": datetime.now()}},
+            projection={field: 1 for field in ("mcq_attempted", "total_questions_correct", "total_questions_attempted")},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+    async def set_profile_image(self, user_id: str, image_id: str) -> Optional[dict]:
+        """Point the user at a stored profile image; returns the user as it was before, or None"""
+        return await self.find_one_and_update(
+            {"_id": ObjectId(user_id)},
+            {"$set": {"profile_image_id": image_id, "updated_at": datetime.utcnow()},
+             "$unset": {"profile_image_url": ""}},
+            projection={"profile_image_id": 1}
+        )
+
+    async def list_page(self, skip: int, limit: int, projection: Optional[dict] = None) -> List[dict]:
+        return await self.find_many({}, projection, skip=skip, limit=limit)
+
+    async def list_page_with_stats(self, skip: int, limit: int, projection: dict) -> List[dict]:
+        """A page of users, each with its user_stats rollup joined in by _id, in one query"""
+        return await self.aggregate([
+            {"$sort": {"_id": 1}},
+            {"$skip": skip},
+            {"$limit": limit},
+            {"$project": projection},
+            {"$addFields": {"user_id": {"$toString": "$_id"}}},
+            {"$lookup": {"from": "user_stats", "localField": "user_id", "foreignField": "_id", "as": "stats"}}
+        ])
+
+class DocumentRepository(MongoRepository):
+    """Queries on per-user document records; text is never loaded, see read_document_text"""
+
+    collection_name = "documents"
+
+    async def get_for_user(self, document_id: str, user_id: str) -> Optional[dict]:
+        """A user's document with its blob fields resolved, or None"""
+        document = await self.find_one(
+            {"_id": ObjectId(document_id), "uploaded_by": user_id},
+            DOCUMENT_METADATA_PROJECTION
+        )
+        return await resolve_document(document)
+
+    async def get_by_id(self, document_id: str, projection: Optional[dict] = None) -> Optional[dict]:
+        return await self.find_one({"_id": ObjectId(document_id)}, projection or DOCUMENT_METADATA_PROJECTION)
+
+    async def exists_for_user(self, document_id: str, user_id: str) -> bool:
+        return await self.find_one({"_id": ObjectId(document_id), "uploaded_by": user_id}, {"_id": 1}) is not None
+
+    async def create(self, document_doc: dict) -> str:
+        return await self.insert(document_doc)
+
+class DocumentBlobRepository(MongoRepository):
+    """Queries on content-addressed document blobs"""
+
+    collection_name = "document_blobs"
+
+    async def get(self, blob_id: str) -> Optional[dict]:
+        return await self.find_one({"_id": blob_id}, DOCUMENT_METADATA_PROJECTION)
+
+    async def update_fields(self, blob_id: str, fields: dict):
+        return await self.update_one({"_id": blob_id}, {"$set": fields})
+
+    async def link(self, blob_id: str):
+        """Count one more document referencing a blob"""
+        return await self.update_one(
+            {"_id": blob_id},
+            {"$inc": {"ref_count": 1}, "$set": {"last_linked_at": datetime.utcnow()}}
+        )
+
+class ChatRepository(MongoRepository):
+    """Queries on chat sessions"""
+
+    collection_name = "chats"
+
+    async def get_by_id(self, chat_id: str) -> Optional[dict]:
+        return await self.find_one({"_id": ObjectId(chat_id)})
+
+    async def get_for_user(self, chat_id: str, user_id: str) -> Optional[dict]:
+        return await self.find_one({"_id": ObjectId(chat_id), "user_id": user_id})
+
+    async def list_for_user(self, user_id: str) -> List[dict]:
+        return await self.find_many({"user_id": user_id}, sort=[("updated_at", -1)])
+
+    async def find_context_chat(self, user_id: str, document_id: Optional[str], **context) -> Optional[dict]:
+        """The user's chat for a document and the given case/concept/parent context, if one exists"""
+        query = {"user_id": user_id, "document_id": document_id}
+        query.update({field: value for field, value in context.items() if value})
+        return await self.find_one(query)
+
+    async def create(self, chat_doc: dict) -> str:
+        return await self.insert(chat_doc)
+
+    async def update_fields(self, chat_id: str, fields: dict):
+        return await self.update_one({"_id": ObjectId(chat_id)}, {"$set": fields})
+
+    async def record_message(self, chat_id: str):
+        """Bump a chat's message count and activity time after a message exchange"""
+        return await self.update_one(
+            {"_id": ObjectId(chat_id)},
+            {"$inc": {"message_count": 1}, "$set": {"updated_at": datetime.utcnow()}}
+        )
+
+    async def delete(self, chat_id: str):
+        return await self.delete_one({"_id": ObjectId(chat_id)})
+
+class ChatMessageRepository(MongoRepository):
+    """Queries on chat messages"""
+
+    collection_name = "chat_messages"
+
+    async def list_for_chat(self, chat_id: str) -> List[dict]:
+        return await self.find_many({"chat_id": chat_id}, sort=[("timestamp", 1)])
+
+    async def recent_for_chat(self, chat_id: str, limit: int) -> List[dict]:
+        """The last `limit` messages of a chat, newest first"""
+        return await self.find_many({"chat_id": chat_id}, sort=[("timestamp", -1)], limit=limit)
+
+    async def create(self, message_doc: dict) -> str:
+        return await self.insert(message_doc)
+
+    async def delete_for_chat(self, chat_id: str):
+        return await self.delete_many({"chat_id": chat_id})
+
+class GeneratedContentRepository(MongoRepository):
+    """Queries on one of the generated_cases / generated_mcqs / generated_concepts collections"""
+
+    async def list_for_chat(self, chat_id: str) -> List[dict]:
+        return await self.find_many({"chat_id": chat_id})
+
+    async def find_by_title(self, title: str, document_id: Optional[str] = None) -> Optional[dict]:
+        """The item with this title, preferring one generated from document_id"""
+        if document_id:
+            item = await self.find_one({"title": title, "document_id": document_id})
+            if item:
+                return item
+        return await self.find_one({"title": title})
+
+    async def create(self, content_doc: dict) -> str:
+        return await self.insert(content_doc)
+
+    async def delete_for_chat(self, chat_id: str):
+        return await self.delete_many({"chat_id": chat_id})
+
+    async def delete_for_case(self, chat_id: str, case_title: str):
+        return await self.delete_many({"chat_id": chat_id, "case_title": case_title})
+
+class NotificationRepository(MongoRepository):
+    """Queries on user notifications"""
+
+    collection_name = "notifications"
+
+    def _user_query(self, user_id: str, unread_only: bool = False) -> dict:
+        query = {"user_id": user_id}
+        if unread_only:
+            query["is_read"] = False
+        return query
+
+    async def list_for_user(self, user_id: str, unread_only: bool, skip: int, limit: int) -> List[dict]:
+        return await self.find_many(
+            self._user_query(user_id, unread_only), sort=[("created_at", -1)], skip=skip, limit=limit
+        )
+
+    async def count_for_user(self, user_id: str, unread_only: bool = False) -> int:
+        return await self.count(self._user_query(user_id, unread_only))
+
+    async def create(self, notification_doc: dict) -> str:
+        return await self.insert(notification_doc)
+
+    async def mark_read(self, notification_id: str, user_id: str):
+        return await self.update_one(
+            {"_id": ObjectId(notification_id), "user_id": user_id},
+            {"$set": {"is_read": True}}
+        )
+
+    async def mark_all_read(self, user_id: str):
+        return await self.update_many(self._user_query(user_id, unread_only=True), {"$set": {"is_read": True}})
+
+class PasswordResetTokenRepository(MongoRepository):
+    """Queries on password reset tokens"""
+
+    collection_name = "password_reset_tokens"
+
+    async def create(self, token_doc: dict) -> str:
+        return await self.insert(token_doc)
+
+    async def get_valid(self, token: str) -> Optional[dict]:
+        return await self.find_one({"token": token, "used": False, "expires_at": {"$gt": datetime.utcnow()}})
+
+    async def mark_used(self, token_id):
+        return await self.update_one({"_id": token_id}, {"$set": {"used": True, "used_at": datetime.utcnow()}})
+
+# Activity events further apart than this belong to separate sessions
+USER_SESSION_IDLE_SECONDS = int(os.getenv("USER_SESSION_IDLE_SECONDS", "1800"))
+
+def session_gap_seconds(previous: Optional[datetime], current: datetime) -> float:
+    """Time between two activity events that counts as time spent, 0 across a session break"""
+    if not isinstance(previous, datetime):
+        return 0
+    gap = (current - previous).total_seconds()
+    return gap if 0 < gap <= USER_SESSION_IDLE_SECONDS else 0
+
+def session_duration_seconds(timestamps: list) -> float:
+    """Total time spent across activity timestamps grouped into sessions"""
+    ordered = sorted(t for t in timestamps if isinstance(t, datetime))
+    return sum(session_gap_seconds(previous, current) for previous, current in zip(ordered, ordered[1:]))
+
+def format_time_spent(seconds: float) -> str:
+    """Dashboard label for a duration, such as 45 mins or 2h 5m"""
+    time_spent_minutes = int(seconds // 60)
+    if time_spent_minutes < 60:
+        return f"{time_spent_minutes} mins"
+    return f"{time_spent_minutes // 60}h {time_spent_minutes % 60}m"
+
+# A stats backfill not finished within this long is assumed dead and may be claimed again
+USER_STATS_BACKFILL_CLAIM_SECONDS = 300
+# /admin/users rebuilds at most this many missing rollups per page load
+ADMIN_USERS_BACKFILL_LIMIT = 5
+
+class UserStatsRepository(MongoRepository):
+    """Per-user activity rollups, kept current with atomic increments as activity happens.
+
+    Users whose activity predates the rollups are backfilled from the source
+    collections the first time their stats are read.
+    """
+
+    collection_name = "user_stats"
+
+    async def record_activity(self, user_id: str, **counters):
+        """Count one activity event, e.g. record_activity(user_id, message_count=1)"""
+        now = datetime.utcnow()
+        update = {"$max": {"last_active_at": now}}
+        if counters:
+            update["$inc"] = counters
+        previous = await self.find_one_and_update(
+            {"_id": user_id}, update,
+            projection={"last_active_at": 1}, upsert=True, return_document=pymongo.ReturnDocument.BEFORE
+        )
+        # The event extends the current session by the time since the previous one
+        gap = session_gap_seconds((previous or {}).get("last_active_at"), now)
+        if gap:
+            await self.update_one({"_id": user_id}, {"$inc": {"time_spent_seconds": gap}})
+
+    async def backfill(self, user_id: str, user: Optional[dict] = None) -> dict:
+        """Rebuild a user's stats from their documents, chats and messages, once.
+
+        The backfill is claimed before anything is read. Activity up to the last event the stats had
+        recorded at the claim is counted from the source collections (and replaces the increments
+        recorded so far); increments recorded after the claim are kept on top. Bounding the sources
+        by the last recorded event rather than by the claim time keeps an item whose increment was
+        still in flight at the claim from being counted twice.
+        """
+        claimed_at = datetime.utcnow()
+        claim_id = secrets.token_hex(8)
+        try:
+            claimed = await self.find_one_and_update(
+                {
+                    "_id": user_id,
+                    "backfilled_at": {"$exists": False},
+                    "$or": [
+                        {"backfill_claimed_at": {"$exists": False}},
+                        # A backfill that died part way is taken over
+                        {"backfill_claimed_at": {"$lt": claimed_at - timedelta(seconds=USER_STATS_BACKFILL_CLAIM_SECONDS)}}
+                    ]
+                },
+                {"$set": {"backfill_claim": claim_id, "backfill_claimed_at": claimed_at}},
+                upsert=True, return_document=pymongo.ReturnDocument.BEFORE
+            )
+        except pymongo.errors.DuplicateKeyError:
+            # Already backfilled, or another request is backfilling right now
+            return await self.find_one({"_id": user_id})
+        before_claim = claimed or {}
+        # Every increment recorded before the claim was made at or before this moment; users with no
+        # recorded activity only have items from before the rollups existed
+        cutoff = before_claim.get("last_active_at") or claimed_at
+        
+        documents, chats = await asyncio.gather(
+            document_repository.find_many({"uploaded_by": user_id, "uploaded_at": {"$lte": cutoff}}, {"uploaded_at": 1}),
+            chat_repository.find_many({"user_id": user_id}, {"created_at": 1, "updated_at": 1})
+        )
+        messages = await chat_message_repository.find_many(
+            {"chat_id": {"$in": [str(chat["_id"]) for chat in chats]}, "timestamp": {"$lte": cutoff}}, {"timestamp": 1}
+        ) if chats else []
+        chats = [chat for chat in chats if not (isinstance(chat.get("created_at"), datetime) and chat["created_at"] > cutoff)]
+        
+        timestamps = [document.get("uploaded_at") for document in documents]
+        timestamps += [chat.get(field) for chat in chats for field in ("created_at", "updated_at")]
+        timestamps += [message.get("timestamp") for message in messages]
+        if user:
+            timestamps.append(user.get("updated_at") or user.get("created_at"))
+        activity = [t for t in timestamps if isinstance(t, datetime) and t <= cutoff]
+        
+        counted = {
+            "document_count": len(documents),
+            "chat_count": len(chats),
+            "message_count": len(messages),
+            "time_spent_seconds": session_duration_seconds(activity),
+        }
+        # Fold in as increments so activity recorded since the claim is not overwritten
+        update = {
+            "$inc": {field: value - before_claim.get(field, 0) for field, value in counted.items()},
+            "$set": {"backfilled_at": datetime.utcnow()},
+            "$unset": {"backfill_claim": "", "backfill_claimed_at": ""}
+        }
+        if activity:
+            update["$max"] = {"last_active_at": max(activity)}
+        return await self.find_one_and_update(
+            {"_id": user_id, "backfill_claim": claim_id}, update,
+            return_document=pymongo.ReturnDocument.AFTER
+        ) or await self.find_one({"_id": user_id})
+
+    async def get(self, user_id: str, user: Optional[dict] = None) -> dict:
+        stats = await self.find_one({"_id": user_id})
+        if stats is None or "backfilled_at" not in stats:
+            stats = await self.backfill(user_id, user)
+        return stats or {}
+
+    async def adjust(self, user_id: str, **counters):
+        """Apply counter changes that are not activity, such as deletions"""
+        return await self.update_one({"_id": user_id}, {"$inc": counters})
+
+# MCQ scores are kept as a histogram of bins this wide; the last bin holds perfect scores
+MCQ_SCORE_BIN_WIDTH = 10
+MCQ_TREND_GRANULARITIES = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+def mcq_period_start(timestamp: datetime, granularity: str) -> datetime:
+    """Start of the UTC day, or of the ISO week (Monday), containing timestamp"""
+    day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - timedelta(days=day.weekday()) if granularity == "week" else day
+
+class MCQAttemptRepository(MongoRepository):
+    """Append-only log of completed MCQ quizzes"""
+
+    collection_name = "mcq_attempts"
+
+    async def create(self, attempt_doc: dict) -> str:
+        return await self.insert(attempt_doc)
+
+    async def delete_for_user(self, user_id: str):
+        return await self.delete_many({"user_id": user_id})
+
+class MCQAttemptBucketRepository(MongoRepository):
+    """Daily and weekly per-user rollups of MCQ attempts, so trends never scan the attempt log"""
+
+    collection_name = "mcq_attempt_buckets"
+
+    async def add(self, attempt: dict):
+        """Fold one attempt into its day and week buckets"""
+        score_bin = min(attempt["score"], 100) // MCQ_SCORE_BIN_WIDTH
+        increments = {
+            "attempts": 1,
+            "questions": attempt["total"],
+            "correct": attempt["correct"],
+            f"score_bins.{score_bin}": 1
+        }
+        if attempt.get("difficulty") in MCQ_DIFFICULTY_BUCKETS:
+            increments[f"difficulty.{attempt['difficulty']}.questions"] = attempt["total"]
+            increments[f"difficulty.{attempt['difficulty']}.correct"] = attempt["correct"]
+        
+        async def add_to(granularity: str):
+            period_start = mcq_period_start(attempt["timestamp"], granularity)
+            await self.update_one(
+                {"_id": f"{attempt['user_id']}:{granularity}:{period_start:%Y-%m-%d}"},
+                {"$inc": increments, "$setOnInsert": {
+                    "user_id": attempt["user_id"],
+                    "granularity": granularity,
+                    "period_start": period_start
+                }},
+                upsert=True
+            )
+        
+        await asyncio.gather(*[add_to(granularity) for granularity in MCQ_TREND_GRANULARITIES])
+
+    async def list_for_user(self, user_id: str, granularity: str, since: datetime) -> List[dict]:
+        return await self.find_many(
+            {"user_id": user_id, "granularity": granularity, "period_start": {"$gte": since}},
+            sort=[("period_start", 1)]
+        )
+
+    async def delete_for_user(self, user_id: str):
+        return await self.delete_many({"user_id": user_id})
+
+class ProfileImageRepository(MongoRepository):
+    """Profile images stored as binary apart from user records.
+
+    Each upload gets a fresh unguessable id and is never modified, so it can be
+    cached indefinitely. Thumbnails are sibling records with _id "<image_id>_<size>".
+    """
+
+    collection_name = "profile_images"
+
+    async def create(self, image_doc: dict) -> str:
+        return await self.insert(image_doc)
+
+    async def get_rendition(self, image_id: str, size: Optional[int] = None) -> Optional[dict]:
+        """The thumbnail of this size if one was rendered, otherwise the original"""
+        if size:
+            thumbnail = await self.find_one({"_id": f"{image_id}_{size}"})
+            if thumbnail:
+                return thumbnail
+        return await self.find_one({"_id": image_id})
+
+    async def delete_image(self, image_id: str):
+        return await self.delete_many({"image_id": image_id})
+
+user_repository = UserRepository()
+document_repository = DocumentRepository()
+document_blob_repository = DocumentBlobRepository()
+chat_repository = ChatRepository()
+chat_message_repository = ChatMessageRepository()
+generated_case_repository = GeneratedContentRepository("generated_cases")
+generated_mcq_repository = GeneratedContentRepository("generated_mcqs")
+generated_concept_repository = GeneratedContentRepository("generated_concepts")
+notification_repository = NotificationRepository()
+password_reset_token_repository = PasswordResetTokenRepository()
+user_stats_repository = UserStatsRepository()
+mcq_attempt_repository = MCQAttemptRepository()
+mcq_attempt_bucket_repository = MCQAttemptBucketRepository()
+profile_image_repository = ProfileImageRepository()
+generation_job_repository = MongoRepository("generation_jobs")
+llm_cache_repository = MongoRepository("llm_response_cache")
+
+def connect_to_mongodb():
+    global client, db, async_client, async_db
+    try:
+        client = pymongo.MongoClient(MONGODB_URL, maxPoolSize=MONGODB_MAX_POOL_SIZE)
+        db = client[DATABASE_NAME]
+        async_client = pymongo.AsyncMongoClient(
+            MONGODB_URL,
+            maxPoolSize=MONGODB_MAX_POOL_SIZE,
+            minPoolSize=MONGODB_MIN_POOL_SIZE
+        )
+        async_db = async_client[DATABASE_NAME]
+        
+        client.server_info()
+        logger.info("Connected to MongoDB: %s", DATABASE_NAME)
+        
+        db.users.create_index("email", unique=True)
+        db.users.create_index("username", unique=True)
+        db.documents.create_index("uploaded_by")
+        db.documents.create_index("uploaded_at")
+        db.documents.create_index("blob_id")
+        db.chats.create_index("user_id")
+        db.chats.create_index("updated_at")
+        db.chat_messages.create_index("chat_id")
+        db.chat_messages.create_index("timestamp")
+        db.generated_cases.create_index("chat_id")
+        db.generated_cases.create_index("document_id")
+        db.generated_mcqs.create_index("chat_id")
+        db.generated_mcqs.create_index("document_id")
+        db.generated_concepts.create_index("chat_id")
+        db.generated_concepts.create_index("document_id")
+        db.generation_jobs.create_index([("status", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)])
+        db.generation_jobs.create_index("user_id")
+        db.generation_jobs.create_index("expires_at", expireAfterSeconds=0)
+        db.llm_response_cache.create_index("expires_at", expireAfterSeconds=0)
+        db.profile_images.create_index("image_id")
+        db.mcq_attempts.create_index([("user_id", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)])
+        db.mcq_attempt_buckets.create_index([
+            ("user_id", pymongo.ASCENDING), ("granularity", pymongo.ASCENDING), ("period_start", pymongo.ASCENDING)
+        ])
+        try:
+            # Replaced by the per-generation index below
+            db.document_chunks.drop_index("document_id_1_index_1")
+        except pymongo.errors.OperationFailure:
+            pass
+        db.document_chunks.create_index([
+            ("document_id", pymongo.ASCENDING), ("generation", pymongo.ASCENDING), ("index", pymongo.ASCENDING)
+        ], unique=True)
+        
+        # Create admin user if it doesn't exist
+        create_admin_user()
+        
+    except Exception as e:
+        logger.error("Failed to connect to MongoDB: %s", e)
+        raise
+
+def create_admin_user():
+    """Create a default admin user if it doesn't exist"""
+    try:
+        if db is None:
+            return
+            
+        # Check if admin user already exists
+        admin_user = db.users.find_one({"email": "admin@casewise.com"})
+        if admin_user:
+            logger.info("✅ Admin user already exists")
+            return
+            
+        # Create admin user
+        admin_password = "admin123"
+        hashed_password = hash_password(admin_password)
+        
+        admin_user_data = {
+            "email": "admin@casewise.com",
+            "username": "admin",
+            "full_name": "System Administrator",
+            "hashed_password": hashed_password,
+            "role": "admin",
+            "is_active": True,
+            "status": "active",
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        }
+        
+        result = db.users.insert_one(admin_user_data)
+        logger.info("✅ Admin user created with ID: %s", result.inserted_id)
+        logger.info("📧 Admin credentials: admin@casewise.com / admin123")
+        
+    except Exception as e:
+        logger.error("❌ Failed to create admin user: %s", e)
+
+def get_database():
+    return db
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup
+    connect_to_mongodb()
+    generation_jobs.start()
+    warm_pdf_process_pool()
+    if GOOGLE_CLIENT_ID:
+        google_certs.start()
+    yield
+    # Shutdown
+    await generation_jobs.stop()
+    shutdown_pdf_process_pool()
+    await google_certs.stop()
+    if llm_gateway:
+        await llm_gateway.aclose()
+    if async_client:
+        await async_client.close()
+    if client:
+        client.close()
+        logger.info("MongoDB connection closed")
+
+class UserSignup(BaseModel):
+    """Schema for user signup"""
+    email: EmailStr
+    username: str = Field(..., min_length=3, max_length=50)
+    password: str = Field(..., min_length=6)
+    full_name: Optional[str] = Field(None, max_length=100)
+    
+    @field_validator('password')
+    @classmethod
+    def validate_password_length(cls, v):
+        # Allow longer passwords - we'll truncate them in hash_password function
+        if len(v) < 6:
+            raise ValueError('Password must be at least 6 characters long')
+        return v
+
+class UserLogin(BaseModel):
+    """Schema for user login"""
+    email: EmailStr
+    password: str
+    remember_me: Optional[bool] = False
+
+class GoogleAuthRequest(BaseModel):
+    """Schema for Google OAuth authentication"""
+    id_token: str
+
+class Token(BaseModel):
     """Token response schema"""
     access_token: str
     token_type: str = "bearer"
@@ -445,6 +2275,23 @@ class UserAnalytics(BaseModel):
     averageScore: int
     lastActiveDate: str
 
+class MCQTrendPoint(BaseModel):
+    """One day or week of MCQ results"""
+    periodStart: str
+    attempts: int
+    questionsAttempted: int
+    questionsCorrect: int
+    accuracy: Optional[int] = None
+
+class MCQTrendsResponse(BaseModel):
+    """MCQ score trend and distribution response schema"""
+    granularity: str
+    periods: List[MCQTrendPoint]
+    attempts: int
+    accuracy: Optional[int] = None
+    scorePercentiles: Dict[str, float]
+    difficultyAccuracy: Dict[str, Optional[int]]
+
 class CaseGenerationRequest(BaseModel):
     """Case generation request schema"""
     document_id: str
@@ -575,16 +2422,31 @@ class AutoGenerationResponse(BaseModel):
     generated_at: datetime
     success: bool
     message: str
+    section_status: Dict[str, str] = {}  # section -> "completed" | "fallback" | "failed"
+    section_errors: Dict[str, str] = {}
+
+class GenerationJobResponse(BaseModel):
+    """Background generation job status schema"""
+    job_id: str
+    kind: str
+    status: str  # queued | running | completed | failed
+    progress: Dict[str, Any] = {}
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[Dict[str, Any]] = None
+    attempts: int = 0
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
 
 
 def hash_password(password: str) -> str:
     """Hash a password using SHA-256"""
-    print(f"HASH_PASSWORD: Hashing password of length: {len(password)}")
+    auth_logger.debug("HASH_PASSWORD: Hashing password of length: %s", len(password))
     # Add a salt to make it more secure
     salt = "casewise_salt_2024"
     salted_password = password + salt
     hashed = hashlib.sha256(salted_password.encode('utf-8')).hexdigest()
-    print(f"HASH_PASSWORD: Hash successful")
+    auth_logger.debug("HASH_PASSWORD: Hash successful")
     return hashed
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -596,47 +2458,142 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     is_valid = computed_hash == hashed_password
     return is_valid
 
-def verify_google_token(id_token_str: str) -> dict:
+GOOGLE_OAUTH2_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+# Used when Google's response carries no max-age
+GOOGLE_CERTS_DEFAULT_MAX_AGE_SECONDS = 3600
+# The background refresh runs this long before the certificates expire
+GOOGLE_CERTS_REFRESH_MARGIN_SECONDS = 300
+# Minimum time between fetches after a failure or for an unknown key id
+GOOGLE_CERTS_RETRY_SECONDS = 30
+
+def cache_control_max_age(header: Optional[str]) -> Optional[int]:
+    """max-age in seconds from a Cache-Control header, if present"""
+    match = re.search(r"max-age=(\d+)", header or "")
+    return int(match.group(1)) if match else None
+
+async def fetch_google_certs() -> tuple:
+    """Google's current signing certificates by key id, and how long they may be cached"""
+    async with httpx.AsyncClient(timeout=10) as client:
+        response = await client.get(GOOGLE_OAUTH2_CERTS_URL)
+        response.raise_for_status()
+        return response.json(), cache_control_max_age(response.headers.get("cache-control"))
+
+class GoogleCertCache:
+    """Google ID token signing certificates, cached for the max-age Google advertises.
+
+    start() loads them and keeps a background task refreshing them ahead of
+    expiry, so verifying a login is local crypto only. A token signed with a key
+    id not in the cache (Google rotated keys) forces an early refresh. The fetch
+    function is injectable so verification can run offline in tests.
+    """
+
+    def __init__(self, fetch=fetch_google_certs):
+        self.fetch = fetch
+        self.certs = {}
+        self.expires_at = 0.0
+        self.fetched_at = None
+        self.lock = asyncio.Lock()
+        self.refresher = None
+
+    async def refresh(self, fetched_before: Optional[float] = None) -> dict:
+        """Fetch the certificates, unless another caller already did after fetched_before"""
+        async with self.lock:
+            if fetched_before is not None and self.fetched_at is not None and self.fetched_at > fetched_before:
+                return self.certs
+            certs, max_age = await self.fetch()
+            max_age = max_age or GOOGLE_CERTS_DEFAULT_MAX_AGE_SECONDS
+            self.certs = certs
+            self.fetched_at = time.monotonic()
+            self.expires_at = self.fetched_at + max_age
+            auth_logger.info("🔑 Loaded %s Google signing certificates, cached for %ss", len(certs), max_age)
+            return certs
+
+    async def get(self, key_id: Optional[str] = None) -> dict:
+        now = time.monotonic()
+        expired = now >= self.expires_at
+        unknown_key = (
+            key_id is not None and key_id not in self.certs
+            and (self.fetched_at is None or now - self.fetched_at > GOOGLE_CERTS_RETRY_SECONDS)
+        )
+        if expired or unknown_key:
+            try:
+                await self.refresh(fetched_before=now)
+            except Exception as e:
+                # Google keeps retired keys valid for a while, so stale certificates beat none
+                if not self.certs:
+                    raise
+                auth_logger.warning("⚠️ Google certificate refresh failed, using cached certificates: %s", e)
+        return self.certs
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh(fetched_before=time.monotonic())
+                delay = self.expires_at - time.monotonic() - GOOGLE_CERTS_REFRESH_MARGIN_SECONDS
+            except Exception as e:
+                auth_logger.warning("⚠️ Failed to refresh Google signing certificates: %s", e)
+                delay = GOOGLE_CERTS_RETRY_SECONDS
+            await asyncio.sleep(max(delay, GOOGLE_CERTS_RETRY_SECONDS))
+
+    def start(self):
+        """Load the certificates now and keep them fresh in the background"""
+        self.refresher = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self.refresher:
+            self.refresher.cancel()
+            await asyncio.gather(self.refresher, return_exceptions=True)
+            self.refresher = None
+
+google_certs = GoogleCertCache()
+
+def unverified_jwt_header(token: str) -> dict:
+    """The header of a JWT, read without checking anything"""
+    try:
+        header_encoded = token.split(".", 1)[0]
+        return json.loads(base64.urlsafe_b64decode(header_encoded + "=" * (-len(header_encoded) % 4)))
+    except Exception:
+        return {}
+
+async def verify_google_token(id_token_str: str) -> dict:
     """Verify Google ID token and return user info"""
     try:
-        print(f"GOOGLE_AUTH: Verifying Google ID token")
+        auth_logger.debug("GOOGLE_AUTH: Verifying Google ID token")
         
         if not GOOGLE_CLIENT_ID:
-            print("GOOGLE_AUTH: ERROR - GOOGLE_CLIENT_ID not configured")
+            auth_logger.error("GOOGLE_AUTH: ERROR - GOOGLE_CLIENT_ID not configured")
             raise HTTPException(status_code=500, detail="Google OAuth not configured")
         
-        print(f"GOOGLE_AUTH: Using client ID: {GOOGLE_CLIENT_ID[:20]}...")
+        auth_logger.debug("GOOGLE_AUTH: Using client ID: %s...", GOOGLE_CLIENT_ID[:20])
         
-        # Check system clock
-        import time
-        current_time = int(time.time())
-        print(f"GOOGLE_AUTH: Current system time: {current_time}")
+        certs = await google_certs.get(unverified_jwt_header(id_token_str).get("kid"))
         
         # Verify the token with clock tolerance
-        idinfo = id_token.verify_oauth2_token(
-            id_token_str, 
-            requests.Request(), 
-            GOOGLE_CLIENT_ID,
+        idinfo = google_jwt.decode(
+            id_token_str,
+            certs=certs,
+            audience=GOOGLE_CLIENT_ID,
             clock_skew_in_seconds=120  # Allow 2 minutes of clock difference
         )
         
         # Verify the issuer
         if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
-            print(f"GOOGLE_AUTH: Wrong issuer: {idinfo['iss']}")
+            auth_logger.error("GOOGLE_AUTH: Wrong issuer: %s", idinfo['iss'])
             raise ValueError('Wrong issuer.')
         
-        print(f"GOOGLE_AUTH: Token verified for user: {idinfo.get('email')}")
+        auth_logger.debug("GOOGLE_AUTH: Token verified for user: %s", idinfo.get('email'))
         return idinfo
         
+    except HTTPException:
+        raise
     except ValueError as e:
-        print(f"GOOGLE_AUTH: Invalid token: {e}")
+        auth_logger.error("GOOGLE_AUTH: Invalid token: %s", e)
         raise HTTPException(status_code=401, detail=f"Invalid Google token: {str(e)}")
     except Exception as e:
-        print(f"GOOGLE_AUTH: Error verifying token: {e}")
-        print(f"GOOGLE_AUTH: Error type: {type(e).__name__}")
+        auth_logger.error("GOOGLE_AUTH: Error verifying token (%s): %s", type(e).__name__, e)
         raise HTTPException(status_code=401, detail=f"Failed to verify Google token: {str(e)}")
 
-def create_notification(user_id: str, notification_type: str, title: str, message: str, metadata: dict = None):
+async def create_notification(user_id: str, notification_type: str, title: str, message: str, metadata: dict = None):
     """Create a notification for a user"""
     try:
         notification_doc = {
@@ -649,13 +2606,20 @@ def create_notification(user_id: str, notification_type: str, title: str, messag
             "metadata": metadata or {}
         }
         
-        result = db.notifications.insert_one(notification_doc)
-        print(f" Notification created: {notification_type} for user {user_id}")
-        return str(result.inserted_id)
+        notification_id = await notification_repository.create(notification_doc)
+        logger.info("Notification created: %s for user %s", notification_type, user_id)
+        return notification_id
     except Exception as e:
-        print(f" Error creating notification: {e}")
+        logger.error("Error creating notification: %s", e)
         return None
 
+async def record_user_activity(user_id: str, **counters):
+    """Update a user's activity rollup; failures are logged and never fail the request"""
+    try:
+        await user_stats_repository.record_activity(user_id, **counters)
+    except Exception as e:
+        logger.warning("⚠️ Failed to record activity for user %s: %s", user_id, e)
+
 def send_reset_password_email(email: str, reset_token: str, user_name: str = None):
     """Send password reset email to user"""
     try:
@@ -666,7 +2630,7 @@ def send_reset_password_email(email: str, reset_token: str, user_name: str = Non
         smtp_password = os.getenv("SMTP_PASSWORD", "")
         
         if not smtp_username or not smtp_password:
-            print("❌ SMTP credentials not configured. Please set SMTP_USERNAME and SMTP_PASSWORD environment variables.")
+            auth_logger.error("❌ SMTP credentials not configured. Please set SMTP_USERNAME and SMTP_PASSWORD environment variables.")
             return False
         
         # Create message
@@ -725,11 +2689,11 @@ def send_reset_password_email(email: str, reset_token: str, user_name: str = Non
         server.sendmail(smtp_username, email, text)
         server.quit()
         
-        print(f"✅ Password reset email sent to: {email}")
+        auth_logger.info("✅ Password reset email sent to: %s", email)
         return True
         
     except Exception as e:
-        print(f"❌ Error sending password reset email: {e}")
+        auth_logger.error("❌ Error sending password reset email: %s", e)
         return False
 
 def generate_reset_token():
@@ -764,41 +2728,107 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     
     return f"{header_encoded}.{payload_encoded}.{signature_encoded}"
 
-def decode_jwt_token(token: str) -> dict:
-    """Decode JWT token using simple implementation"""
-    try:
-        parts = token.split('.')
+JWT_VERIFY_CACHE_MAX_ENTRIES = int(os.getenv("JWT_VERIFY_CACHE_MAX_ENTRIES", "10000"))
+
+class JWTVerifier:
+    """HS256 token verification with a bounded cache of already-verified tokens.
+
+    Signatures are compared in constant time. A verified token's claims are kept
+    under a digest of the token until the token expires, so repeat requests
+    with the same token skip decoding and the HMAC.
+    """
+
+    def __init__(self, secret: Optional[str], max_entries: int = JWT_VERIFY_CACHE_MAX_ENTRIES):
+        self.secret = (secret or "").encode()
+        self.max_entries = max_entries
+        self.verified = OrderedDict()
+
+    def _verify_signature(self, token: str) -> dict:
+        parts = token.split(".")
         if len(parts) != 3:
             raise ValueError("Invalid token format")
-        
         header_encoded, payload_encoded, signature_encoded = parts
         
-        # Decode payload
-        payload_padded = payload_encoded + '=' * (4 - len(payload_encoded) % 4)
-        payload = json.loads(base64.urlsafe_b64decode(payload_padded))
-        
-        # Verify signature
-        message = f"{header_encoded}.{payload_encoded}"
         expected_signature = hmac.new(
-            SECRET_KEY.encode(),
-            message.encode(),
-            hashlib.sha256
+            self.secret, f"{header_encoded}.{payload_encoded}".encode(), hashlib.sha256
         ).digest()
-        expected_signature_encoded = base64.urlsafe_b64encode(expected_signature).decode().rstrip('=')
-        
-        if signature_encoded != expected_signature_encoded:
+        expected_signature_encoded = base64.urlsafe_b64encode(expected_signature).rstrip(b"=")
+        if not hmac.compare_digest(signature_encoded.encode(), expected_signature_encoded):
             raise ValueError("Invalid signature")
         
-        # Check expiration
-        if 'exp' in payload:
-            if datetime.utcnow().timestamp() > payload['exp']:
-                raise ValueError("Token expired")
-        
-        return payload
+        return json.loads(base64.urlsafe_b64decode(payload_encoded + "=" * (-len(payload_encoded) % 4)))
+
+    def verify(self, token: str) -> dict:
+        """The token's claims; raises ValueError for a bad signature or an expired token"""
+        key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        # Same clock create_access_token stamps "exp" with
+        now = datetime.utcnow().timestamp()
+        entry = self.verified.get(key)
+        if entry is not None:
+            expires_at, claims = entry
+            if expires_at is None or now <= expires_at:
+                self.verified.move_to_end(key)
+                return dict(claims)
+            del self.verified[key]
+        
+        claims = self._verify_signature(token)
+        expires_at = claims.get("exp")
+        if expires_at is not None and now > expires_at:
+            raise ValueError("Token expired")
+        
+        self.verified[key] = (expires_at, claims)
+        while len(self.verified) > self.max_entries:
+            self.verified.popitem(last=False)
+        return dict(claims)
+
+jwt_verifier = JWTVerifier(SECRET_KEY)
+
+def decode_jwt_token(token: str) -> dict:
+    """Decode and verify a JWT token"""
+    try:
+        return jwt_verifier.verify(token)
     except Exception as e:
         raise ValueError(f"Token decode error: {str(e)}")
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+# Authenticated users are cached as slim principals; a role or status change made
+# by another process is picked up once the entry expires
+AUTH_PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("AUTH_PRINCIPAL_CACHE_TTL_SECONDS", "30"))
+AUTH_PRINCIPAL_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_PRINCIPAL_CACHE_MAX_ENTRIES", "10000"))
+AUTH_PRINCIPAL_PROJECTION = {"email": 1, "username": 1, "role": 1, "is_active": 1, "status": 1}
+
+class PrincipalCache:
+    """Per-process LRU of authenticated user principals with expiry"""
+
+    def __init__(self, max_entries: int = AUTH_PRINCIPAL_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = AUTH_PRINCIPAL_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+
+    def get(self, user_id: str) -> Optional[dict]:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, principal = entry
+        if expires_at < time.monotonic():
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        # Handlers may modify current_user, so each request gets its own copy
+        return dict(principal)
+
+    def set(self, user_id: str, principal: dict):
+        self.entries[user_id] = (time.monotonic() + self.ttl_seconds, dict(principal))
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        self.entries.pop(user_id, None)
+
+principal_cache = PrincipalCache()
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get current user from JWT token"""
     try:
         payload = decode_jwt_token(credentials.credentials)
@@ -808,11 +2838,14 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     except ValueError as e:
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    user = db.users.find_one({"_id": ObjectId(user_id)})
+    user = principal_cache.get(user_id)
     if user is None:
-        raise HTTPException(status_code=401, detail="User not found")
+        user = await user_repository.get_by_id(user_id, AUTH_PRINCIPAL_PROJECTION)
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        user["id"] = str(user["_id"])
+        principal_cache.set(user_id, user)
     
-    user["id"] = str(user["_id"])
     return user
 
 # Rate Limiter Class
@@ -843,161 +2876,402 @@ rate_limiter = RateLimiter(max_requests=10, time_window=1)  # 10 requests per se
 def get_rate_limiter():
     return rate_limiter
 
-app = FastAPI(
-    title="Medical AI - Auth API",
-    description="User authentication using PyMongo",
-    version="1.0.0",
-    lifespan=lifespan
-)
+# Background generation jobs
+GENERATION_JOB_WORKERS = max(1, int(os.getenv("GENERATION_JOB_WORKERS", "2")))
+GENERATION_JOB_POLL_SECONDS = float(os.getenv("GENERATION_JOB_POLL_SECONDS", "2"))
+GENERATION_JOB_HEARTBEAT_SECONDS = float(os.getenv("GENERATION_JOB_HEARTBEAT_SECONDS", "15"))
+GENERATION_JOB_STALE_SECONDS = float(os.getenv("GENERATION_JOB_STALE_SECONDS", "90"))
+GENERATION_JOB_MAX_ATTEMPTS = int(os.getenv("GENERATION_JOB_MAX_ATTEMPTS", "3"))
+GENERATION_JOB_RETENTION_DAYS = int(os.getenv("GENERATION_JOB_RETENTION_DAYS", "7"))
 
-# CORS middleware - backup to custom middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=[
-        "https://casewise-beta.vercel.app",  # Production frontend
-        "http://localhost:3000",
-        "http://localhost:3001", 
-        "http://127.0.0.1:3000",
-        "http://127.0.0.1:3001",
-        "http://localhost:8000",
-        "http://127.0.0.1:8000"
-    ],
-    allow_credentials=True,
-    allow_methods=[
-        "GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH", "HEAD"
-    ],
-    allow_headers=[
-        "Accept",
-        "Accept-Language",
-        "Content-Language",
-        "Content-Type",
-        "Authorization",
-        "X-Requested-With",
-        "Origin",
-        "Access-Control-Request-Method",
-        "Access-Control-Request-Headers",
-        "Cache-Control",
-        "Pragma",
-        "Expires",
-        "X-Google-Auth-User"
-    ],
-    expose_headers=[
-        "Content-Length",
-        "Content-Type",
-        "Date",
-        "Server",
-        "Access-Control-Allow-Origin",
-        "Access-Control-Allow-Credentials"
-    ],
-    max_age=3600
-)
+current_generation_job = contextvars.ContextVar("current_generation_job", default=None)
 
-@app.middleware("http")
-async def cors_handler(request: Request, call_next):
-    # Define allowed origins for production and development
-    allowed_origins = [
-        "https://casewise-beta.vercel.app",  # Production frontend
-        "http://localhost:3000",              # Local development
-        "http://localhost:3001",              # Alternative local port
-        "http://127.0.0.1:3000",             # Local development
-        "http://127.0.0.1:3001",             # Alternative local port
-    ]
-    
-    # Get the origin from the request
-    origin = request.headers.get("origin")
-    print(f"🌐 CORS: Request origin: {origin}")
-    print(f"🌐 CORS: Request method: {request.method}")
-    print(f"🌐 CORS: Request URL: {request.url}")
-    
-    # Check if origin is allowed
-    if origin and origin in allowed_origins:
-        allowed_origin = origin
-        print(f"✅ CORS: Allowed origin: {allowed_origin}")
-    else:
-        # Default to production frontend for unknown origins
-        allowed_origin = "https://casewise-beta.vercel.app"
-        print(f"⚠️ CORS: Unknown origin: {origin}, defaulting to production frontend")
-    
-    # Handle preflight OPTIONS requests
-    if request.method == "OPTIONS":
-        print("🔄 CORS: Handling preflight OPTIONS request")
-        response = Response()
-        response.headers["Access-Control-Allow-Origin"] = allowed_origin
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS, PATCH, HEAD"
-        response.headers["Access-Control-Allow-Headers"] = "Accept, Accept-Language, Content-Language, Content-Type, Authorization, X-Requested-With, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, Cache-Control, Pragma, Expires, X-Google-Auth-User"
-        response.headers["Access-Control-Allow-Credentials"] = "true"
-        response.headers["Access-Control-Max-Age"] = "3600"
-        print(f"✅ CORS: Preflight response headers: {dict(response.headers)}")
-        return response
-    
-    # Process the request
-    print("🔄 CORS: Processing request")
-    response = await call_next(request)
-    
-    # Add CORS headers to all responses
-    response.headers["Access-Control-Allow-Origin"] = allowed_origin
-    response.headers["Access-Control-Allow-Credentials"] = "true"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS, PATCH, HEAD"
-    response.headers["Access-Control-Allow-Headers"] = "Accept, Accept-Language, Content-Language, Content-Type, Authorization, X-Requested-With, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, Cache-Control, Pragma, Expires, X-Google-Auth-User"
-    
-    print(f"✅ CORS: Response headers added: {dict(response.headers)}")
-    return response
-
-@app.middleware("http")
-async def catch_exceptions_middleware(request: Request, call_next):
-    try:
-        return await call_next(request)
-    except Exception as e:
-        # Log the error
-        print(f"ERROR: Unhandled exception: {e}")
-        import traceback
-        traceback.print_exc()
-        
-        # Return error response with CORS headers
-        origin = request.headers.get("origin", "https://casewise-beta.vercel.app")
-        response = Response(
-            content=f'{{"detail": "Internal server error: {str(e)}"}}',
-            status_code=500,
-            headers={
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": origin,
-                "Access-Control-Allow-Credentials": "true"
-            }
+# Query parameters of the generation endpoints: run inline or as a job, and whether to read the LLM cache
+GenerationMode = Literal["sync", "job"]
+CacheMode = Literal["use", "bypass"]
+
+class GenerationJobQueue:
+    """Mongo-backed job queue for long-running generation endpoints.
+
+    Jobs live in the generation_jobs collection, so any process can claim them
+    and a job whose worker stops heartbeating is put back in the queue.
+    """
+
+    def __init__(self, num_workers: int = GENERATION_JOB_WORKERS):
+        self.num_workers = num_workers
+        self.worker_id = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self.handlers = {}
+        self.workers = []
+        self.wakeup = asyncio.Event()
+
+    def register(self, kind: str, request_model, handler):
+        """Register the endpoint function that runs jobs of this kind"""
+        self.handlers[kind] = (request_model, handler)
+
+    async def submit(self, kind: str, request: BaseModel, user_id: str, options: Optional[dict] = None) -> dict:
+        """Persist a queued job and wake an idle worker; options are extra handler arguments such as cache"""
+        now = datetime.utcnow()
+        job = {
+            "kind": kind,
+            "user_id": user_id,
+            "request": request.model_dump(),
+            "options": options or {},
+            "status": "queued",
+            "progress": {},
+            "result": None,
+            "error": None,
+            "attempts": 0,
+            "created_at": now,
+            "updated_at": now
+        }
+        await generation_job_repository.insert(job)
+        self.wakeup.set()
+        jobs_logger.info("📥 Queued %s job %s for user %s", kind, job['_id'], user_id)
+        return job
+
+    def start(self):
+        """Start the worker pool; each worker first requeues jobs orphaned by a previous run"""
+        self.workers = [
+            asyncio.create_task(self._worker_loop(n)) for n in range(self.num_workers)
+        ]
+        jobs_logger.info("✅ Started %s generation job workers (%s)", self.num_workers, self.worker_id)
+
+    async def stop(self):
+        """Cancel the workers; jobs they were running go back to the queue"""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def requeue_stale_jobs(self):
+        """Return jobs whose worker stopped heartbeating to the queue, or fail them if out of attempts"""
+        stale_before = datetime.utcnow() - timedelta(seconds=GENERATION_JOB_STALE_SECONDS)
+        stale_query = {"status": "running", "heartbeat_at": {"$lt": stale_before}}
+        exhausted = await generation_job_repository.update_many(
+            {**stale_query, "attempts": {"$gte": GENERATION_JOB_MAX_ATTEMPTS}},
+            {"$set": {
+                "status": "failed",
+                "error": {"status_code": 500, "detail": "Job worker stopped responding too many times"},
+                "completed_at": datetime.utcnow(),
+                "expires_at": datetime.utcnow() + timedelta(days=GENERATION_JOB_RETENTION_DAYS)
+            }}
         )
-        return response
-
-
-@app.options("/{path:path}")
-async def options_handler(path: str, request: Request):
-    """Handle all OPTIONS requests for CORS preflight"""
-    allowed_origins = [
-        "https://casewise-beta.vercel.app",  # Production frontend
-        "http://localhost:3000",              # Local development
-        "http://localhost:3001",              # Alternative local port
-        "http://127.0.0.1:3000",             # Local development
-        "http://127.0.0.1:3001",             # Alternative local port
-    ]
-    
-    origin = request.headers.get("origin")
-    
-    # Validate origin
-    if origin and origin in allowed_origins:
-        allowed_origin = origin
-    else:
-        # Default to production frontend for unknown origins
-        allowed_origin = "https://casewise-beta.vercel.app"
-    
-    return Response(
-        status_code=200,
-        headers={
-            "Access-Control-Allow-Origin": allowed_origin,
-            "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS, PATCH, HEAD",
-            "Access-Control-Allow-Headers": "Accept, Accept-Language, Content-Language, Content-Type, Authorization, X-Requested-With, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, Cache-Control, Pragma, Expires, X-Google-Auth-User",
-            "Access-Control-Allow-Credentials": "true",
-            "Access-Control-Max-Age": "3600"
+        requeued = await generation_job_repository.update_many(
+            stale_query,
+            {"$set": {"status": "queued", "worker_id": None, "updated_at": datetime.utcnow()}}
+        )
+        if exhausted.modified_count or requeued.modified_count:
+            jobs_logger.info("♻️ Requeued %s stale generation jobs, failed %s", requeued.modified_count, exhausted.modified_count)
+
+    async def report_progress(self, **progress):
+        """Merge progress fields into the job running in the current task, if any"""
+        job_id = current_generation_job.get()
+        if job_id is None:
+            return
+        await generation_job_repository.update_one(
+            {"_id": job_id},
+            {"$set": {**{f"progress.{key}": value for key, value in progress.items()},
+                      "updated_at": datetime.utcnow()}}
+        )
+
+    async def _claim_next(self):
+        now = datetime.utcnow()
+        return await generation_job_repository.find_one_and_update(
+            {"status": "queued"},
+            {"$set": {
+                "status": "running",
+                "worker_id": self.worker_id,
+                "started_at": now,
+                "heartbeat_at": now,
+                "updated_at": now
+            }, "$inc": {"attempts": 1}},
+            sort=[("created_at", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+    async def _worker_loop(self, worker_number: int):
+        last_stale_check = None
+        while True:
+            try:
+                if last_stale_check is None or time.monotonic() - last_stale_check > GENERATION_JOB_STALE_SECONDS / 2:
+                    await self.requeue_stale_jobs()
+                    last_stale_check = time.monotonic()
+                job = await self._claim_next()
+            except Exception as e:
+                jobs_logger.error("❌ Generation job worker %s could not poll the queue: %s", worker_number, e)
+                job = None
+            if job is None:
+                # Idle: sleep until a local submit or the next poll (jobs may come from other processes)
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=GENERATION_JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run_job(job)
+
+    async def _heartbeat(self, job_id, work: asyncio.Task):
+        """Keep the job's lease alive; cancel the work if another worker has taken the job over"""
+        while True:
+            await asyncio.sleep(GENERATION_JOB_HEARTBEAT_SECONDS)
+            try:
+                result = await generation_job_repository.update_one(
+                    {"_id": job_id, "worker_id": self.worker_id},
+                    {"$set": {"heartbeat_at": datetime.utcnow()}}
+                )
+            except Exception as e:
+                jobs_logger.warning("⚠️ Heartbeat for job %s failed, retrying: %s", job_id, e)
+                continue
+            if result.modified_count == 0:
+                jobs_logger.warning("⚠️ Job %s is no longer owned by this worker, abandoning it", job_id)
+                work.cancel()
+                return
+
+    async def _execute(self, job: dict):
+        request_model, handler = self.handlers[job["kind"]]
+        user = await user_repository.get_by_id(job["user_id"], AUTH_PRINCIPAL_PROJECTION)
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        user["id"] = str(user["_id"])
+        return await handler(request=request_model(**job["request"]), current_user=user, **job.get("options", {}))
+
+    async def _run_job(self, job: dict):
+        job_id = job["_id"]
+        request_id_token = request_id_var.set(f"job-{job_id}")
+        jobs_logger.info("⚙️ Running %s job %s (attempt %s)", job['kind'], job_id, job['attempts'])
+        token = current_generation_job.set(job_id)
+        work = asyncio.create_task(self._execute(job))
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, work))
+        update = {"status": "failed"}
+        try:
+            result = await work
+            update = {"status": "completed", "result": jsonable_encoder(result)}
+            jobs_logger.info("✅ Job %s completed", job_id)
+        except asyncio.CancelledError:
+            if heartbeat.done():
+                # Lost the job to another worker, which now owns its outcome
+                return
+            # Shutting down: hand the job back so it resumes on the next start
+            await generation_job_repository.update_one(
+                {"_id": job_id, "worker_id": self.worker_id},
+                {"$set": {"status": "queued", "worker_id": None, "updated_at": datetime.utcnow()}}
+            )
+            raise
+        except HTTPException as e:
+            update["error"] = {"status_code": e.status_code, "detail": e.detail}
+            jobs_logger.error("❌ Job %s failed: %s", job_id, e.detail)
+        except Exception as e:
+            update["error"] = {"status_code": 500, "detail": str(e)}
+            jobs_logger.error("❌ Job %s failed: %s", job_id, e)
+        finally:
+            current_generation_job.reset(token)
+            request_id_var.reset(request_id_token)
+            heartbeat.cancel()
+
+        now = datetime.utcnow()
+        await generation_job_repository.update_one(
+            {"_id": job_id, "worker_id": self.worker_id},
+            {"$set": {
+                **update,
+                "completed_at": now,
+                "updated_at": now,
+                "expires_at": now + timedelta(days=GENERATION_JOB_RETENTION_DAYS)
+            }}
+        )
+
+generation_jobs = GenerationJobQueue()
+
+async def submit_generation_job(kind: str, request: BaseModel, current_user: dict, options: Optional[dict] = None) -> JSONResponse:
+    """Queue a generation request and answer 202 with where to poll for it"""
+    try:
+        document_exists = await document_repository.exists_for_user(request.document_id, current_user["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid document ID")
+    if not document_exists:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
+    job = await generation_jobs.submit(kind, request, current_user["id"], options)
+    job_id = str(job["_id"])
+    return JSONResponse(
+        status_code=202,
+        content={
+            "job_id": job_id,
+            "kind": kind,
+            "status": job["status"],
+            "status_url": f"/jobs/{job_id}"
         }
     )
 
+app = FastAPI(
+    title="Medical AI - Auth API",
+    description="User authentication using PyMongo",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+# CORS: one ASGI layer whose per-origin header blocks are built once at import
+CORS_DEFAULT_ORIGIN = "https://casewise-beta.vercel.app"  # Production frontend
+CORS_ALLOWED_ORIGINS = (
+    CORS_DEFAULT_ORIGIN,
+    "http://localhost:3000",              # Local development
+    "http://localhost:3001",              # Alternative local port
+    "http://127.0.0.1:3000",             # Local development
+    "http://127.0.0.1:3001",             # Alternative local port
+)
+CORS_ALLOW_METHODS = ("GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH", "HEAD")
+CORS_ALLOW_HEADERS = (
+    "Accept", "Accept-Language", "Content-Language", "Content-Type", "Authorization",
+    "X-Requested-With", "Origin", "Access-Control-Request-Method", "Access-Control-Request-Headers",
+    "Cache-Control", "Pragma", "Expires", "X-Google-Auth-User",
+)
+CORS_EXPOSE_HEADERS = (
+    "Content-Length", "Content-Type", "Date", "Server",
+    "Access-Control-Allow-Origin", "Access-Control-Allow-Credentials", "X-Request-ID",
+)
+CORS_MAX_AGE_SECONDS = 3600
+
+class CORSHeadersMiddleware:
+    """Adds CORS headers to every response and answers OPTIONS requests itself.
+
+    Allowed origins get their own origin echoed back; requests from any other origin
+    (or none) get the production frontend, which browsers treat as a denial.
+    Preflights never reach the router.
+    """
+
+    def __init__(self, app, allowed_origins=CORS_ALLOWED_ORIGINS, default_origin: str = CORS_DEFAULT_ORIGIN):
+        self.app = app
+        shared = [
+            (b"access-control-allow-credentials", b"true"),
+            (b"access-control-allow-methods", ", ".join(CORS_ALLOW_METHODS).encode()),
+            (b"access-control-allow-headers", ", ".join(CORS_ALLOW_HEADERS).encode()),
+            (b"access-control-expose-headers", ", ".join(CORS_EXPOSE_HEADERS).encode()),
+            (b"vary", b"Origin"),
+        ]
+        preflight_extra = [
+            (b"access-control-max-age", str(CORS_MAX_AGE_SECONDS).encode()),
+            (b"content-length", b"0"),
+        ]
+
+        def header_blocks(origin: str):
+            simple = [(b"access-control-allow-origin", origin.encode()), *shared]
+            return simple, simple + preflight_extra
+
+        self.allowed = {origin.encode(): header_blocks(origin) for origin in allowed_origins}
+        self.fallback = header_blocks(default_origin)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        origin = None
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value
+                break
+        blocks = self.allowed.get(origin)
+        if blocks is None:
+            blocks = self.fallback
+            if origin is not None:
+                cors_logger.warning("⚠️ CORS: Unknown origin: %s, defaulting to production frontend", origin.decode("latin-1"))
+        if cors_logger.isEnabledFor(logging.DEBUG):
+            cors_logger.debug("🌐 CORS: %s %s from origin %s", scope["method"], scope["path"], origin and origin.decode("latin-1"))
+        simple_headers, preflight_headers = blocks
+
+        if scope["method"] == "OPTIONS":
+            await send({"type": "http.response.start", "status": 200, "headers": preflight_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), *simple_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+class UnhandledExceptionMiddleware:
+    """Turns exceptions that escape a route into a JSON 500 response.
+
+    Pure ASGI, so response bodies (including streams) pass through untouched. CORS headers
+    are added by CORSHeadersMiddleware, which wraps this one.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        response_started = False
+
+        async def send_tracking_start(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_tracking_start)
+        except Exception as e:
+            if response_started:
+                # Part of the response is already on the wire; let the server abort the connection
+                raise
+            logger.exception("ERROR: Unhandled exception: %s", e)
+            body = json.dumps({"detail": f"Internal server error: {str(e)}"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 500,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            })
+            await send({"type": "http.response.body", "body": body})
+
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+class RequestIdMiddleware:
+    """Tags each request with an id for log correlation and echoes it back as X-Request-ID.
+
+    A well-formed X-Request-ID from the client or proxy is reused; anything else gets a fresh id.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                candidate = value.decode("latin-1")
+                if REQUEST_ID_PATTERN.fullmatch(candidate):
+                    request_id = candidate
+                break
+        request_id = request_id or secrets.token_hex(8)
+        header = (b"x-request-id", request_id.encode("latin-1"))
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), header]
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+
+# Middleware added later wraps middleware added earlier
+app.add_middleware(UnhandledExceptionMiddleware)
+app.add_middleware(CORSHeadersMiddleware)
+# Added last so it wraps every other middleware and their log lines carry the id
+app.add_middleware(RequestIdMiddleware)
+
+
 @app.get("/test")
 def test_endpoint():
     return {"message": "Test endpoint working", "status": "ok"}
@@ -1019,15 +3293,21 @@ def admin_test():
         "timestamp": datetime.utcnow().isoformat()
     }
 
+@app.get("/admin/ai/stats")
+def get_ai_stats(current_user: dict = Depends(get_current_user)):
+    """Generation cache and request coalescing counters - admin only"""
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {"cache": llm_response_cache.stats(), "coalescing": generation_flights.stats()}
+
 @app.post("/signup", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-def signup(user_data: UserSignup):
-    print("SIGNUP ENDPOINT CALLED")
-    print(f"Email: {user_data.email}")
-    print(f"Username: {user_data.username}")
+async def signup(user_data: UserSignup):
+    auth_logger.debug("SIGNUP ENDPOINT CALLED - email: %s, username: %s", user_data.email, user_data.username)
     
     try:
         # Check if user already exists
-        existing_user = db.users.find_one({
+        existing_user = await user_repository.find_one({
             "$or": [
                 {"email": user_data.email}, 
                 {"username": user_data.username}
@@ -1036,14 +3316,14 @@ def signup(user_data: UserSignup):
         
         if existing_user:
             if existing_user.get("email") == user_data.email:
-                print(" Email already registered")
+                auth_logger.debug("Email already registered")
                 raise HTTPException(status_code=400, detail="Email already registered")
             else:
-                print(" Username already taken")
+                auth_logger.debug("Username already taken")
                 raise HTTPException(status_code=400, detail="Username already taken")
         
         # Create new user
-        print(" Hashing password...")
+        auth_logger.debug("Hashing password...")
         hashed_password = hash_password(user_data.password)
         
         user_doc = {
@@ -1057,38 +3337,36 @@ def signup(user_data: UserSignup):
             "created_at": datetime.utcnow()
         }
         
-        print(" Inserting user into database...")
-        result = db.users.insert_one(user_doc)
-        print(f" User created with ID: {result.inserted_id}")
+        auth_logger.debug("Inserting user into database...")
+        user_id = await user_repository.create(user_doc)
+        auth_logger.debug("User created with ID: %s", user_id)
         
         # Prepare response
-        user_doc["id"] = str(result.inserted_id)
+        user_doc["id"] = user_id
         del user_doc["hashed_password"]  
         del user_doc["_id"]  
         
         return user_doc
         
     except HTTPException as he:
-        print(f" HTTP Exception: {he.detail}")
+        auth_logger.info("HTTP Exception: %s", he.detail)
         raise
     except Exception as e:
-        print(f" Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
+        auth_logger.exception("Unexpected error: %s", e)
         raise HTTPException(status_code=500, detail=f"Signup error: {str(e)}")
 
 @app.post("/login", response_model=Token)
-def login(user_credentials: UserLogin):
+async def login(user_credentials: UserLogin):
     # Removed debug prints for performance
     
     try:
         # Check if database is connected
-        if db is None:
-            print(" Database not connected")
+        if async_db is None:
+            auth_logger.error("Database not connected")
             raise HTTPException(status_code=500, detail="Database connection error")
         
         # Find user by email
-        user = db.users.find_one({"email": user_credentials.email})
+        user = await user_repository.get_by_email(user_credentials.email)
         if not user:
             raise HTTPException(status_code=401, detail="Incorrect email or password")
         
@@ -1116,52 +3394,48 @@ def login(user_credentials: UserLogin):
         }
         
     except HTTPException as he:
-        print(f" HTTP Exception: {he.detail}")
+        auth_logger.info("HTTP Exception: %s", he.detail)
         raise
     except Exception as e:
-        print(f" Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
+        auth_logger.exception("Unexpected error: %s", e)
         raise HTTPException(status_code=500, detail=f"Login error: {str(e)}")
 
 @app.post("/admin/login", response_model=Token)
-def admin_login(user_credentials: UserLogin):
-    print(" ADMIN LOGIN ENDPOINT CALLED")
-    print(f" Email: {user_credentials.email}")
-    print(f" Password length: {len(user_credentials.password)}")
+async def admin_login(user_credentials: UserLogin):
+    auth_logger.debug("ADMIN LOGIN ENDPOINT CALLED - email: %s", user_credentials.email)
     
     try:
         # Check if database is connected
-        if db is None:
-            print(" Database not connected")
+        if async_db is None:
+            auth_logger.error("Database not connected")
             raise HTTPException(status_code=500, detail="Database connection error")
         
         # Find admin user by email
-        user = db.users.find_one({"email": user_credentials.email, "role": "admin"})
-        print(f" Admin user found: {user is not None}")
+        user = await user_repository.get_by_email(user_credentials.email, role="admin")
+        auth_logger.debug("Admin user found: %s", user is not None)
         
         if not user:
-            print(" Admin user not found")
+            auth_logger.warning("Admin user not found")
             raise HTTPException(status_code=401, detail="Incorrect email or password")
         
-        print(f" Admin user details: {user.get('username')} - Active: {user.get('is_active', True)}")
+        auth_logger.debug("Admin user details: %s - Active: %s", user.get('username'), user.get('is_active', True))
         
         # Verify password
         password_valid = verify_password(user_credentials.password, user["hashed_password"])
-        print(f" Password verification result: {password_valid}")
+        auth_logger.debug("Password verification result: %s", password_valid)
         
         if not password_valid:
-            print(" Invalid password")
+            auth_logger.warning("Invalid password")
             raise HTTPException(status_code=401, detail="Incorrect email or password")
         
         # Check if user is active
         if not user.get("is_active", True):
-            print(" Admin user inactive")
+            auth_logger.warning("Admin user inactive")
             raise HTTPException(status_code=400, detail="Inactive user")
         
         # Create access token
         access_token = create_access_token(data={"sub": str(user["_id"])})
-        print(" Admin login successful - token created")
+        auth_logger.debug("Admin login successful - token created")
         
         return {
             "access_token": access_token,
@@ -1171,24 +3445,22 @@ def admin_login(user_credentials: UserLogin):
         }
         
     except HTTPException as he:
-        print(f" HTTP Exception: {he.detail}")
+        auth_logger.info("HTTP Exception: %s", he.detail)
         raise
     except Exception as e:
-        print(f" Unexpected error during admin login: {str(e)}")
+        auth_logger.error("Unexpected error during admin login: %s", str(e))
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/auth/google", response_model=Token)
-def google_auth(request: GoogleAuthRequest):
+async def google_auth(request: GoogleAuthRequest):
     """Authenticate user with Google OAuth"""
-    print("GOOGLE_AUTH ENDPOINT CALLED")
-    print(f"GOOGLE_AUTH: Token length: {len(request.id_token)}")
-    print(f"GOOGLE_AUTH: Token preview: {request.id_token[:50]}...")
+    auth_logger.debug("GOOGLE_AUTH ENDPOINT CALLED - token length: %s", len(request.id_token))
     
     try:
         # Verify the Google ID token
-        print("GOOGLE_AUTH: Starting token verification...")
-        idinfo = verify_google_token(request.id_token)
-        print("GOOGLE_AUTH: Token verification successful")
+        auth_logger.debug("GOOGLE_AUTH: Starting token verification...")
+        idinfo = await verify_google_token(request.id_token)
+        auth_logger.debug("GOOGLE_AUTH: Token verification successful")
         
         email = idinfo.get('email')
         name = idinfo.get('name', '')
@@ -1197,26 +3469,26 @@ def google_auth(request: GoogleAuthRequest):
         if not email:
             raise HTTPException(status_code=400, detail="Email not provided by Google")
         
-        print(f"GOOGLE_AUTH: Processing user: {email}")
+        auth_logger.debug("GOOGLE_AUTH: Processing user: %s", email)
         
         # Check if user already exists
-        existing_user = db.users.find_one({"email": email})
+        existing_user = await user_repository.get_by_email(email)
         
         if existing_user:
-            print(f"GOOGLE_AUTH: Existing user found: {email}")
+            auth_logger.debug("GOOGLE_AUTH: Existing user found: %s", email)
             # Block login if user is inactive
             if not existing_user.get("is_active", True):
                 raise HTTPException(status_code=400, detail="Inactive user")
             user = existing_user
         else:
-            print(f"GOOGLE_AUTH: Creating new user: {email}")
+            auth_logger.debug("GOOGLE_AUTH: Creating new user: %s", email)
             # Create new user
             username = email.split('@')[0]  # Use email prefix as username
             
             # Check if username is taken
             counter = 1
             original_username = username
-            while db.users.find_one({"username": username}):
+            while await user_repository.get_by_username(username):
                 username = f"{original_username}{counter}"
                 counter += 1
             
@@ -1232,13 +3504,13 @@ def google_auth(request: GoogleAuthRequest):
                 "auth_provider": "google"
             }
             
-            result = db.users.insert_one(user_doc)
-            user = db.users.find_one({"_id": result.inserted_id})
-            print(f"GOOGLE_AUTH: New user created with ID: {result.inserted_id}")
+            user_id = await user_repository.create(user_doc)
+            user = await user_repository.get_by_id(user_id)
+            auth_logger.debug("GOOGLE_AUTH: New user created with ID: %s", user_id)
         
         # Create access token
         access_token = create_access_token(data={"sub": str(user["_id"])})
-        print("GOOGLE_AUTH: Login successful - token created")
+        auth_logger.debug("GOOGLE_AUTH: Login successful - token created")
         
         return {
             "access_token": access_token,
@@ -1248,24 +3520,20 @@ def google_auth(request: GoogleAuthRequest):
         }
         
     except HTTPException as he:
-        print(f"GOOGLE_AUTH: HTTP Exception: {he.detail}")
-        print(f"GOOGLE_AUTH: HTTP Exception status: {he.status_code}")
+        auth_logger.info("GOOGLE_AUTH: HTTP Exception %s: %s", he.status_code, he.detail)
         raise
     except Exception as e:
-        print(f"GOOGLE_AUTH: Unexpected error: {e}")
-        print(f"GOOGLE_AUTH: Error type: {type(e).__name__}")
-        import traceback
-        traceback.print_exc()
+        auth_logger.exception("GOOGLE_AUTH: Unexpected error (%s): %s", type(e).__name__, e)
         raise HTTPException(status_code=500, detail=f"Google authentication error: {str(e)}")
 
 @app.post("/forgot-password")
 async def forgot_password(request: ForgotPasswordRequest):
     """Send password reset email to user"""
-    print(f"FORGOT_PASSWORD: Request for email: {request.email}")
+    auth_logger.info("FORGOT_PASSWORD: Request for email: %s", request.email)
     
     try:
         # Check if user exists
-        user = db.users.find_one({"email": request.email})
+        user = await user_repository.get_by_email(request.email)
         if not user:
             # Don't reveal if email exists or not for security
             return {"message": "If an account with that email exists, we've sent a password reset link."}
@@ -1275,7 +3543,7 @@ async def forgot_password(request: ForgotPasswordRequest):
         expires_at = datetime.utcnow() + timedelta(hours=1)  # Token expires in 1 hour
         
         # Store reset token in database
-        db.password_reset_tokens.insert_one({
+        await password_reset_token_repository.create({
             "user_id": str(user["_id"]),
             "email": request.email,
             "token": reset_token,
@@ -1289,32 +3557,26 @@ async def forgot_password(request: ForgotPasswordRequest):
         email_sent = send_reset_password_email(request.email, reset_token, user_name)
         
         if email_sent:
-            print(f"✅ Password reset email sent to: {request.email}")
+            auth_logger.info("✅ Password reset email sent to: %s", request.email)
             return {"message": "If an account with that email exists, we've sent a password reset link."}
         else:
-            print(f"❌ Failed to send password reset email to: {request.email}")
+            auth_logger.error("❌ Failed to send password reset email to: %s", request.email)
             raise HTTPException(status_code=500, detail="Failed to send password reset email. Please try again later.")
             
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ FORGOT_PASSWORD: Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
+        auth_logger.exception("❌ FORGOT_PASSWORD: Unexpected error: %s", e)
         raise HTTPException(status_code=500, detail="An error occurred. Please try again later.")
 
 @app.post("/reset-password")
 async def reset_password(request: ResetPasswordRequest):
     """Reset user password using token"""
-    print(f"RESET_PASSWORD: Request with token: {request.token[:8]}...")
+    auth_logger.info("RESET_PASSWORD: Request with token: %s...", request.token[:8])
     
     try:
         # Find valid reset token
-        reset_record = db.password_reset_tokens.find_one({
-            "token": request.token,
-            "used": False,
-            "expires_at": {"$gt": datetime.utcnow()}
-        })
+        reset_record = await password_reset_token_repository.get_valid(request.token)
         
         if not reset_record:
             raise HTTPException(status_code=400, detail="Invalid or expired reset token.")
@@ -1323,13 +3585,11 @@ async def reset_password(request: ResetPasswordRequest):
         hashed_password = hashlib.sha256(request.new_password.encode()).hexdigest()
         
         # Update user password
-        result = db.users.update_one(
-            {"_id": ObjectId(reset_record["user_id"])},
+        result = await user_repository.update_fields(
+            reset_record["user_id"],
             {
-                "$set": {
-                    "hashed_password": hashed_password,
-                    "updated_at": datetime.utcnow()
-                }
+                "hashed_password": hashed_password,
+                "updated_at": datetime.utcnow()
             }
         )
         
@@ -1337,24 +3597,24 @@ async def reset_password(request: ResetPasswordRequest):
             raise HTTPException(status_code=404, detail="User not found.")
         
         # Mark token as used
-        db.password_reset_tokens.update_one(
-            {"_id": reset_record["_id"]},
-            {"$set": {"used": True, "used_at": datetime.utcnow()}}
-        )
+        await password_reset_token_repository.mark_used(reset_record["_id"])
         
-        print(f"✅ Password reset successful for user: {reset_record['user_id']}")
+        auth_logger.info("✅ Password reset successful for user: %s", reset_record['user_id'])
         return {"message": "Password has been reset successfully. You can now log in with your new password."}
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ RESET_PASSWORD: Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
+        auth_logger.exception("❌ RESET_PASSWORD: Unexpected error: %s", e)
         raise HTTPException(status_code=500, detail="An error occurred. Please try again later.")
 
 @app.get("/me", response_model=UserResponse)
-def get_current_user_info(current_user: dict = Depends(get_current_user)):
+async def get_current_user_info(principal: dict = Depends(get_current_user)):
+    # The principal only carries auth fields; the profile needs the full record
+    current_user = await user_repository.get_by_id(principal["id"], {"hashed_password": 0})
+    if current_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    current_user["id"] = principal["id"]
     user_response = {
         "id": current_user["id"],
         "email": current_user["email"],
@@ -1362,7 +3622,7 @@ def get_current_user_info(current_user: dict = Depends(get_current_user)):
         "full_name": current_user.get("full_name"),
         "first_name": current_user.get("first_name"),
         "last_name": current_user.get("last_name"),
-        "profile_image_url": current_user.get("profile_image_url"),
+        "profile_image_url": await profile_image_url_for(current_user),
         "bio": current_user.get("bio"),
         "role": current_user.get("role", "user"),
         "created_at": current_user["created_at"],
@@ -1376,7 +3636,7 @@ def logout():
     return {"message": "Logged out successfully"}
 
 @app.get("/admin/users")
-def get_all_users(
+async def get_all_users(
     current_user: dict = Depends(get_current_user),
     limit: int = 50,
     skip: int = 0
@@ -1387,11 +3647,10 @@ def get_all_users(
         raise HTTPException(status_code=403, detail="Admin access required")
     
     try:
-        # Get total count for pagination info
-        total_count = db.users.count_documents({})
-        
-        # Get paginated users from database
-        users_cursor = db.users.find({}, {
+        # Total count for pagination info, and the page with each user's activity rollup joined in
+        total_count, users_page = await asyncio.gather(
+            user_repository.count({}),
+            user_repository.list_page_with_stats(skip, limit, {
             "_id": 1,
             "email": 1,
             "username": 1,
@@ -1404,32 +3663,39 @@ def get_all_users(
             "mcq_attempted": 1,
             "total_questions_correct": 1,
             "total_questions_attempted": 1
-        }).skip(skip).limit(limit)
+            })
+        )
+        
+        # Users whose activity predates the rollups get them built once, a few per page load;
+        # the rest show their partial rollups until a later load reaches them
+        missing = [user for user in users_page if not user["stats"] or "backfilled_at" not in user["stats"][0]]
+        if missing:
+            missing = missing[:ADMIN_USERS_BACKFILL_LIMIT]
+            backfilled = await asyncio.gather(
+                *[user_stats_repository.backfill(user["user_id"], user) for user in missing]
+            )
+            for user, stats in zip(missing, backfilled):
+                user["stats"] = [stats or {}]
+        for user in users_page:
+            if not user["stats"]:
+                user["stats"] = [{}]
         
         users = []
-        for user in users_cursor:
+        for user in users_page:
             # Get analytics data for each user
             analytics = user.get("analytics", {})
+            stats = user["stats"][0]
             
             # Count documents uploaded by user
-            cases_uploaded = db.documents.count_documents({"uploaded_by": str(user["_id"])})
+            cases_uploaded = stats.get("document_count", 0)
             
             # Get MCQ statistics from user document (direct fields, not analytics)
             mcq_attempted = user.get("mcq_attempted", 0)
             total_questions_correct = user.get("total_questions_correct", 0)
             total_questions_attempted = user.get("total_questions_attempted", 0)
             
-            # Get chat sessions to calculate time spent
-            chat_count = db.chats.count_documents({"user_id": str(user["_id"])})
-            
-            # Calculate time spent (simplified)
-            time_spent_minutes = chat_count * 5  # Assume 5 minutes per chat session
-            if time_spent_minutes < 60:
-                time_spent = f"{time_spent_minutes} mins"
-            else:
-                hours = time_spent_minutes // 60
-                minutes = time_spent_minutes % 60
-                time_spent = f"{hours}h {minutes}m"
+            # Time spent across the user's activity sessions
+            time_spent = format_time_spent(stats.get("time_spent_seconds", 0))
             
             # Calculate average score
             average_score = 0
@@ -1448,25 +3714,9 @@ def get_all_users(
                 if user_created and isinstance(user_created, datetime):
                     activity_dates.append(user_created)
             
-            # Check for most recent chat activity
-            most_recent_chat = db.chats.find_one(
-                {"user_id": str(user["_id"])},
-                sort=[("updated_at", -1)]
-            )
-            if most_recent_chat and most_recent_chat.get("updated_at"):
-                chat_date = most_recent_chat["updated_at"]
-                if isinstance(chat_date, datetime):
-                    activity_dates.append(chat_date)
-            
-            # Check for most recent document upload
-            most_recent_doc = db.documents.find_one(
-                {"uploaded_by": str(user["_id"])},
-                sort=[("uploaded_at", -1)]
-            )
-            if most_recent_doc and most_recent_doc.get("uploaded_at"):
-                doc_date = most_recent_doc["uploaded_at"]
-                if isinstance(doc_date, datetime):
-                    activity_dates.append(doc_date)
+            # Most recent upload, chat, message or MCQ completion
+            if isinstance(stats.get("last_active_at"), datetime):
+                activity_dates.append(stats["last_active_at"])
             
             # Use the most recent date
             if activity_dates:
@@ -1521,7 +3771,7 @@ def get_all_users(
         }
         
     except Exception as e:
-        print(f"Error fetching users: {e}")
+        logger.error("Error fetching users: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch users data")
 
 @app.put("/admin/users/update")
@@ -1531,17 +3781,14 @@ async def admin_update_users(
 ):
     """Update multiple users' roles and status - admin only"""
     
-    print(f"🔍 Admin update endpoint called by user: {current_user.get('id', 'unknown')}")
-    print(f"🔍 User role: {current_user.get('role', 'unknown')}")
-    print(f"🔍 Request data: {request}")
+    logger.debug("🔍 Admin update endpoint called by user: %s (role: %s), request: %s", current_user.get('id', 'unknown'), current_user.get('role', 'unknown'), request)
     
     # Check if current user is admin
     if current_user.get("role") != "admin":
-        print("❌ Access denied - user is not admin")
+        logger.warning("❌ Access denied - user is not admin")
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    print(f"🔄 Admin bulk user update request from user: {current_user['id']}")
-    print(f"📊 Updates to process: {len(request.updates)}")
+    logger.info("🔄 Admin bulk user update request from user: %s, %s updates", current_user['id'], len(request.updates))
     
     try:
         updated_users = []
@@ -1550,7 +3797,7 @@ async def admin_update_users(
         for update in request.updates:
             try:
                 # Validate user exists
-                user = db.users.find_one({"_id": ObjectId(update.user_id)})
+                user = await user_repository.get_by_id(update.user_id)
                 if not user:
                     errors.append(f"User {update.user_id} not found")
                     continue
@@ -1575,10 +3822,8 @@ async def admin_update_users(
                 update_data["updated_at"] = datetime.utcnow()
                 
                 # Update user in database
-                result = db.users.update_one(
-                    {"_id": ObjectId(update.user_id)},
-                    {"$set": update_data}
-                )
+                result = await user_repository.update_fields(update.user_id, update_data)
+                principal_cache.invalidate(update.user_id)
                 
                 if result.modified_count > 0:
                     updated_users.append({
@@ -1587,16 +3832,16 @@ async def admin_update_users(
                         "username": user["username"],
                         "updates": update_data
                     })
-                    print(f"✅ Updated user {update.user_id}: {update_data}")
+                    logger.debug("✅ Updated user %s: %s", update.user_id, update_data)
                 else:
                     errors.append(f"Failed to update user {update.user_id}")
                     
             except Exception as e:
                 error_msg = f"Error updating user {update.user_id}: {str(e)}"
                 errors.append(error_msg)
-                print(f"❌ {error_msg}")
+                logger.error("❌ %s", error_msg)
         
-        print(f"📊 Update summary: {len(updated_users)} successful, {len(errors)} errors")
+        logger.info("📊 Update summary: %s successful, %s errors", len(updated_users), len(errors))
         
         return {
             "message": f"Updated {len(updated_users)} users successfully",
@@ -1606,7 +3851,7 @@ async def admin_update_users(
         }
         
     except Exception as e:
-        print(f"❌ Error in admin bulk user update: {str(e)}")
+        logger.error("❌ Error in admin bulk user update: %s", str(e))
         raise HTTPException(status_code=500, detail="Failed to update users")
 
 @app.put("/profile", response_model=UserResponse)
@@ -1616,11 +3861,11 @@ async def update_profile(
 ):
     """Update user profile information"""
     
-    print(f" Profile update request for user: {current_user['id']}")
+    logger.debug("Profile update request for user: %s", current_user['id'])
     
     # Check if email is being changed and if it's already taken
     if profile_data.email and profile_data.email != current_user["email"]:
-        existing_user = db.users.find_one({"email": profile_data.email})
+        existing_user = await user_repository.get_by_email(profile_data.email)
         if existing_user:
             raise HTTPException(
                 status_code=400, 
@@ -1629,7 +3874,7 @@ async def update_profile(
     
     # Check if username is being changed and if it's already taken
     if profile_data.username and profile_data.username != current_user["username"]:
-        existing_user = db.users.find_one({"username": profile_data.username})
+        existing_user = await user_repository.get_by_username(profile_data.username)
         if existing_user:
             raise HTTPException(
                 status_code=400, 
@@ -1662,10 +3907,8 @@ async def update_profile(
     
     # Update user in database
     try:
-        result = db.users.update_one(
-            {"_id": ObjectId(current_user["id"])},
-            {"$set": update_data}
-        )
+        result = await user_repository.update_fields(current_user["id"], update_data)
+        principal_cache.invalidate(current_user["id"])
         
         if result.modified_count == 0:
             raise HTTPException(
@@ -1673,10 +3916,10 @@ async def update_profile(
                 detail="User not found"
             )
         
-        print(f" Profile updated successfully for user: {current_user['id']}")
+        logger.debug("Profile updated successfully for user: %s", current_user['id'])
         
         # Create notification for profile update
-        create_notification(
+        await create_notification(
             user_id=current_user["id"],
             notification_type="profile_update",
             title="Profile Updated",
@@ -1685,7 +3928,7 @@ async def update_profile(
         )
         
         # Fetch updated user data
-        updated_user = db.users.find_one({"_id": ObjectId(current_user["id"])})
+        updated_user = await user_repository.get_by_id(current_user["id"], {"hashed_password": 0})
         
         if not updated_user:
             raise HTTPException(
@@ -1701,7 +3944,7 @@ async def update_profile(
             "full_name": updated_user.get("full_name"),
             "first_name": updated_user.get("first_name"),
             "last_name": updated_user.get("last_name"),
-            "profile_image_url": updated_user.get("profile_image_url"),
+            "profile_image_url": await profile_image_url_for(updated_user),
             "bio": updated_user.get("bio"),
             "created_at": updated_user["created_at"],
             "updated_at": updated_user.get("updated_at")
@@ -1710,7 +3953,7 @@ async def update_profile(
         return user_response
         
     except Exception as e:
-        print(f" Error updating profile: {str(e)}")
+        logger.error("Error updating profile: %s", str(e))
         raise HTTPException(
             status_code=500, 
             detail="Failed to update profile"
@@ -1723,10 +3966,10 @@ async def change_password(
 ):
     """Change user password"""
     
-    print(f" Password change request for user: {current_user['id']}")
+    auth_logger.debug("Password change request for user: %s", current_user['id'])
     
     # Verify current password
-    user = db.users.find_one({"_id": ObjectId(current_user["id"])})
+    user = await user_repository.get_by_id(current_user["id"])
     if not user:
         raise HTTPException(
             status_code=404, 
@@ -1745,13 +3988,11 @@ async def change_password(
     
     # Update password in database
     try:
-        result = db.users.update_one(
-            {"_id": ObjectId(current_user["id"])},
+        result = await user_repository.update_fields(
+            current_user["id"],
             {
-                "$set": {
-                    "hashed_password": new_hashed_password,
-                    "updated_at": datetime.utcnow()
-                }
+                "hashed_password": new_hashed_password,
+                "updated_at": datetime.utcnow()
             }
         )
         
@@ -1761,17 +4002,131 @@ async def change_password(
                 detail="User not found"
             )
         
-        print(f" Password updated successfully for user: {current_user['id']}")
+        auth_logger.debug("Password updated successfully for user: %s", current_user['id'])
         
         return {"message": "Password updated successfully"}
         
     except Exception as e:
-        print(f" Error updating password: {str(e)}")
+        auth_logger.error("Error updating password: %s", str(e))
         raise HTTPException(
             status_code=500, 
             detail="Failed to update password"
         )
 
+# Profile image thumbnails rendered at upload, as square sizes in pixels
+PROFILE_IMAGE_SIZES = (64, 256)
+PROFILE_IMAGE_MAX_BYTES = 2 * 1024 * 1024
+PROFILE_IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Where clients reach this API, used for links it hands out; proxy headers are not trusted for it
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+# Raster formats only: images are served from the API origin, so anything scriptable (SVG, HTML) is refused
+PROFILE_IMAGE_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp")
+
+def sniff_image_type(data: bytes) -> Optional[str]:
+    """The image type given by the data's magic bytes, if it is one of PROFILE_IMAGE_TYPES"""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def render_profile_thumbnails(data: bytes) -> Dict[int, tuple]:
+    """(content_type, bytes) of a square thumbnail per PROFILE_IMAGE_SIZES; empty without Pillow or for unreadable images"""
+    if not PIL_AVAILABLE:
+        return {}
+    thumbnails = {}
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image)
+            has_alpha = image.mode in ("RGBA", "LA", "P")
+            image = image.convert("RGBA" if has_alpha else "RGB")
+            for size in PROFILE_IMAGE_SIZES:
+                thumbnail = ImageOps.fit(image, (size, size))
+                output = io.BytesIO()
+                if has_alpha:
+                    thumbnail.save(output, format="PNG", optimize=True)
+                else:
+                    thumbnail.save(output, format="JPEG", quality=85, optimize=True)
+                thumbnails[size] = ("image/png" if has_alpha else "image/jpeg", output.getvalue())
+    except Exception as e:
+        logger.warning("⚠️ Could not render profile image thumbnails: %s", e)
+        return {}
+    return thumbnails
+
+async def store_profile_image(user_id: str, content_type: str, data: bytes) -> str:
+    """Store an image and its thumbnails and return the new image id"""
+    image_id = secrets.token_urlsafe(16)
+    thumbnails = await asyncio.to_thread(render_profile_thumbnails, data)
+    renditions = {image_id: (content_type, data)}
+    renditions.update({f"{image_id}_{size}": rendition for size, rendition in thumbnails.items()})
+    now = datetime.utcnow()
+    await asyncio.gather(*[
+        profile_image_repository.create({
+            "_id": rendition_id,
+            "image_id": image_id,
+            "user_id": user_id,
+            "content_type": rendition_type,
+            "data": rendition_data,
+            "size": len(rendition_data),
+            "etag": f'"{hashlib.sha256(rendition_data).hexdigest()[:32]}"',
+            "created_at": now
+        })
+        for rendition_id, (rendition_type, rendition_data) in renditions.items()
+    ])
+    return image_id
+
+def profile_image_url(image_id: str) -> str:
+    """URL of a stored profile image, absolute when PUBLIC_BASE_URL is configured"""
+    return f"{PUBLIC_BASE_URL}{app.url_path_for('get_profile_image', image_id=image_id)}"
+
+async def profile_image_url_for(user: dict) -> Optional[str]:
+    """Public URL of a user's profile image, moving an image still stored inline as a data URL out first"""
+    inline_url = user.get("profile_image_url") or ""
+    if inline_url.startswith("data:") and not user.get("profile_image_id"):
+        try:
+            header, encoded = inline_url.split(",", 1)
+            data = base64.b64decode(encoded)
+            content_type = sniff_image_type(data)
+            if content_type is None:
+                raise ValueError(f"unsupported image type {header[len('data:'):].split(';')[0]!r}")
+            image_id = await store_profile_image(str(user["_id"]), content_type, data)
+            await user_repository.set_profile_image(str(user["_id"]), image_id)
+            user["profile_image_id"] = image_id
+        except Exception as e:
+            logger.warning("⚠️ Failed to move inline profile image for user %s: %s", user['_id'], e)
+            return inline_url
+    if user.get("profile_image_id"):
+        return profile_image_url(user["profile_image_id"])
+    # Images hosted elsewhere, such as Google profile pictures
+    return user.get("profile_image_url")
+
+@app.get("/profile/images/{image_id}")
+async def get_profile_image(image_id: str, request: Request, size: Optional[int] = None):
+    """Serve a profile image; size picks the smallest thumbnail at least that large"""
+    thumbnail_size = None
+    if size:
+        thumbnail_size = next((s for s in PROFILE_IMAGE_SIZES if s >= size), None)
+    image = await profile_image_repository.get_rendition(image_id, thumbnail_size)
+    if not image:
+        raise HTTPException(status_code=404, detail="Image not found")
+    # Images stored before types were checked are served only if their bytes are a supported image
+    content_type = image["content_type"] if image["content_type"] in PROFILE_IMAGE_TYPES else sniff_image_type(bytes(image["data"]))
+    if content_type is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    headers = {
+        "ETag": image["etag"],
+        "Cache-Control": PROFILE_IMAGE_CACHE_CONTROL,
+        "X-Content-Type-Options": "nosniff"
+    }
+    if image["etag"] in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=bytes(image["data"]), media_type=content_type, headers=headers)
+
 @app.post("/profile/upload-image")
 async def upload_profile_image(
     file: UploadFile = File(...),
@@ -1779,7 +4134,7 @@ async def upload_profile_image(
 ):
     """Upload profile image"""
     
-    print(f" Profile image upload for user: {current_user['id']}")
+    logger.debug("Profile image upload for user: %s", current_user['id'])
     
     # Validate file type
     if not file.content_type or not file.content_type.startswith('image/'):
@@ -1789,49 +4144,52 @@ async def upload_profile_image(
         )
     
     # Validate file size (2MB limit)
-    max_size = 2 * 1024 * 1024  # 2MB
-    if file.size and file.size > max_size:
+    if file.size and file.size > PROFILE_IMAGE_MAX_BYTES:
         raise HTTPException(
             status_code=400, 
             detail="File size must be less than 2MB"
         )
     
+    upload = await spool_upload(file, max_bytes=PROFILE_IMAGE_MAX_BYTES)
     try:
-        # Read file content
-        content = await file.read()
-        
-        # For now, we'll store the image as base64 in the database
-        # In production, you'd want to use a cloud storage service like AWS S3
-        import base64
-        image_base64 = base64.b64encode(content).decode('utf-8')
-        image_url = f"data:{file.content_type};base64,{image_base64}"
-        
-        # Update user profile with image URL
-        result = db.users.update_one(
-            {"_id": ObjectId(current_user["id"])},
-            {
-                "$set": {
-                    "profile_image_url": image_url,
-                    "updated_at": datetime.utcnow()
-                }
-            }
+        with open(upload.path, "rb") as image_file:
+            content = image_file.read()
+    finally:
+        upload.cleanup()
+    
+    # The stored type comes from the bytes, never from the client's Content-Type
+    content_type = sniff_image_type(content)
+    if content_type is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Image must be a PNG, JPEG, GIF or WebP file"
         )
+    
+    try:
+        # Store the image apart from the user record, which keeps only its id
+        image_id = await store_profile_image(current_user["id"], content_type, content)
+        previous = await user_repository.set_profile_image(current_user["id"], image_id)
         
-        if result.modified_count == 0:
+        if previous is None:
+            await profile_image_repository.delete_image(image_id)
             raise HTTPException(
                 status_code=404, 
                 detail="User not found"
             )
+        if previous.get("profile_image_id"):
+            await profile_image_repository.delete_image(previous["profile_image_id"])
+        
+        image_url = profile_image_url(image_id)
         
-        print(f" Profile image uploaded successfully for user: {current_user['id']}")
+        logger.debug("Profile image uploaded successfully for user: %s", current_user['id'])
         
         # Create notification for profile image upload
-        create_notification(
+        await create_notification(
             user_id=current_user["id"],
             notification_type="profile_update",
             title="Profile Image Updated",
             message="Your profile image has been successfully updated.",
-            metadata={"file_size": len(content), "content_type": file.content_type}
+            metadata={"file_size": len(content), "content_type": content_type}
         )
         
         return {
@@ -1839,8 +4197,10 @@ async def upload_profile_image(
             "image_url": image_url
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f" Error uploading profile image: {str(e)}")
+        logger.error("Error uploading profile image: %s", str(e))
         raise HTTPException(
             status_code=500, 
             detail="Failed to upload profile image"
@@ -1856,21 +4216,14 @@ async def get_notifications(
 ):
     """Get user notifications with pagination"""
     
-    print(f" Getting notifications for user: {current_user['id']}, limit={limit}, skip={skip}")
+    logger.debug("Getting notifications for user: %s, limit=%s, skip=%s", current_user['id'], limit, skip)
     
     try:
-        query = {"user_id": current_user["id"]}
-        if unread_only:
-            query["is_read"] = False
-        
         # Get total count for pagination info
-        total_count = db.notifications.count_documents(query)
+        total_count = await notification_repository.count_for_user(current_user["id"], unread_only)
         
         # Get paginated notifications
-        notifications = list(db.notifications.find(query)
-                           .sort("created_at", -1)
-                           .skip(skip)
-                           .limit(limit))
+        notifications = await notification_repository.list_for_user(current_user["id"], unread_only, skip, limit)
         
         notification_list = []
         for notification in notifications:
@@ -1896,7 +4249,7 @@ async def get_notifications(
                 "metadata": notification.get("metadata")
             })
         
-        print(f" Found {len(notification_list)} notifications (total: {total_count})")
+        logger.debug("Found %s notifications (total: %s)", len(notification_list), total_count)
         return {
             "notifications": notification_list,
             "total": total_count,
@@ -1906,7 +4259,7 @@ async def get_notifications(
         }
         
     except Exception as e:
-        print(f" Error getting notifications: {str(e)}")
+        logger.error("Error getting notifications: %s", str(e))
         raise HTTPException(
             status_code=500, 
             detail="Failed to get notifications"
@@ -1919,16 +4272,10 @@ async def mark_notification_read(
 ):
     """Mark a notification as read"""
     
-    print(f" Marking notification {notification_id} as read for user: {current_user['id']}")
+    logger.debug("Marking notification %s as read for user: %s", notification_id, current_user['id'])
     
     try:
-        result = db.notifications.update_one(
-            {
-                "_id": ObjectId(notification_id),
-                "user_id": current_user["id"]
-            },
-            {"$set": {"is_read": True}}
-        )
+        result = await notification_repository.mark_read(notification_id, current_user["id"])
         
         if result.modified_count == 0:
             raise HTTPException(
@@ -1936,11 +4283,11 @@ async def mark_notification_read(
                 detail="Notification not found"
             )
         
-        print(f" Notification {notification_id} marked as read")
+        logger.debug("Notification %s marked as read", notification_id)
         return {"message": "Notification marked as read"}
         
     except Exception as e:
-        print(f" Error marking notification as read: {str(e)}")
+        logger.error("Error marking notification as read: %s", str(e))
         raise HTTPException(
             status_code=500, 
             detail="Failed to mark notification as read"
@@ -1952,22 +4299,16 @@ async def mark_all_notifications_read(
 ):
     """Mark all notifications as read for the current user"""
     
-    print(f" Marking all notifications as read for user: {current_user['id']}")
+    logger.debug("Marking all notifications as read for user: %s", current_user['id'])
     
     try:
-        result = db.notifications.update_many(
-            {
-                "user_id": current_user["id"],
-                "is_read": False
-            },
-            {"$set": {"is_read": True}}
-        )
+        result = await notification_repository.mark_all_read(current_user["id"])
         
-        print(f" Marked {result.modified_count} notifications as read")
+        logger.debug("Marked %s notifications as read", result.modified_count)
         return {"message": f"Marked {result.modified_count} notifications as read"}
         
     except Exception as e:
-        print(f" Error marking all notifications as read: {str(e)}")
+        logger.error("Error marking all notifications as read: %s", str(e))
         raise HTTPException(
             status_code=500, 
             detail="Failed to mark all notifications as read"
@@ -1980,15 +4321,12 @@ async def get_unread_count(
     """Get count of unread notifications"""
     
     try:
-        count = db.notifications.count_documents({
-            "user_id": current_user["id"],
-            "is_read": False
-        })
+        count = await notification_repository.count_for_user(current_user["id"], unread_only=True)
         
         return {"unread_count": count}
         
     except Exception as e:
-        print(f" Error getting unread count: {str(e)}")
+        logger.error("Error getting unread count: %s", str(e))
         raise HTTPException(
             status_code=500, 
             detail="Failed to get unread count"
@@ -2002,30 +4340,26 @@ async def get_user_analytics(current_user: dict = Depends(get_current_user)):
         user_id = current_user["id"]
         
         # Get user info
-        user = db.users.find_one({"_id": ObjectId(user_id)})
+        user = await user_repository.get_by_id(user_id, {
+            "username": 1, "full_name": 1, "created_at": 1, "updated_at": 1, "difficulty_counts": 1,
+            "mcq_attempted": 1, "total_questions_correct": 1, "total_questions_attempted": 1
+        })
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Calculate statistics
+        # Activity comes from the user's rollup
+        stats = await user_stats_repository.get(user_id, user)
+        
         # Count documents uploaded by user
-        cases_uploaded = db.documents.count_documents({"uploaded_by": user_id})
+        cases_uploaded = stats.get("document_count", 0)
         
         # Get MCQ statistics from user document
         mcq_attempted = user.get("mcq_attempted", 0)
         total_questions_correct = user.get("total_questions_correct", 0)
         total_questions_attempted = user.get("total_questions_attempted", 0)
         
-        # Get chat sessions to calculate time spent (optimized)
-        chat_count = db.chats.count_documents({"user_id": user_id})
-        
-        # Calculate time spent (simplified - could be more sophisticated)
-        time_spent_minutes = chat_count * 5  # Assume 5 minutes per chat session
-        if time_spent_minutes < 60:
-            time_spent = f"{time_spent_minutes} mins"
-        else:
-            hours = time_spent_minutes // 60
-            minutes = time_spent_minutes % 60
-            time_spent = f"{hours}h {minutes}m"
+        # Time spent across the user's activity sessions
+        time_spent = format_time_spent(stats.get("time_spent_seconds", 0))
         
         # Determine most common question type based on attempted questions by difficulty
         diff_counts = user.get("difficulty_counts", {}) or {}
@@ -2045,7 +4379,7 @@ async def get_user_analytics(current_user: dict = Depends(get_current_user)):
             average_score = int((total_questions_correct / total_questions_attempted) * 100)
         
         # Get last active date
-        last_active_date = user.get("updated_at", user.get("created_at", datetime.now()))
+        last_active_date = stats.get("last_active_at") or user.get("updated_at", user.get("created_at", datetime.now()))
         if isinstance(last_active_date, datetime):
             last_active_date = last_active_date.strftime("%Y-%m-%d")
         else:
@@ -2067,7 +4401,7 @@ async def get_user_analytics(current_user: dict = Depends(get_current_user)):
         return analytics
         
     except Exception as e:
-        print(f"Error getting user analytics: {str(e)}")
+        logger.error("Error getting user analytics: %s", str(e))
         raise HTTPException(
             status_code=500, 
             detail="Failed to get user analytics"
@@ -2080,6 +4414,104 @@ class MCQCompletionRequest(BaseModel):
     case_id: Optional[str] = None
     case_difficulty: Optional[str] = None
 
+async def record_mcq_attempt(user_id: str, request: MCQCompletionRequest):
+    """Append a quiz result to the attempt log and its trend buckets; failures are only logged"""
+    if request.total_questions <= 0:
+        return
+    attempt = {
+        "user_id": user_id,
+        "case_id": request.case_id,
+        "difficulty": (request.case_difficulty or "").lower() or None,
+        "correct": request.correct_answers,
+        "total": request.total_questions,
+        "score": int(request.correct_answers / request.total_questions * 100),
+        "timestamp": datetime.utcnow()
+    }
+    try:
+        await asyncio.gather(mcq_attempt_repository.create(dict(attempt)), mcq_attempt_bucket_repository.add(attempt))
+    except Exception as e:
+        logger.warning("⚠️ Failed to record MCQ attempt for user %s: %s", user_id, e)
+
+def percent(part: int, whole: int) -> Optional[int]:
+    return int(part / whole * 100) if whole else None
+
+def score_percentiles(score_bins: dict, percentiles: tuple = (25, 50, 75, 90)) -> Dict[str, float]:
+    """Percentiles of attempt scores, interpolated within the histogram bins"""
+    counts = [score_bins.get(str(score_bin), 0) for score_bin in range(100 // MCQ_SCORE_BIN_WIDTH + 1)]
+    total = sum(counts)
+    result = {}
+    if not total:
+        return result
+    for p in percentiles:
+        rank = p / 100 * total
+        cumulative = 0
+        for score_bin, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                lower = score_bin * MCQ_SCORE_BIN_WIDTH
+                width = min(MCQ_SCORE_BIN_WIDTH, 100 - lower)
+                result[f"p{p}"] = round(lower + width * (rank - cumulative) / count, 1)
+                break
+            cumulative += count
+    return result
+
+@app.get("/analytics/mcq-trends", response_model=MCQTrendsResponse)
+async def get_mcq_trends(
+    current_user: dict = Depends(get_current_user),
+    granularity: str = "week",
+    periods: int = 12
+):
+    """MCQ accuracy per day or week, with score percentiles and accuracy by difficulty over the same range"""
+    if granularity not in MCQ_TREND_GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of: {', '.join(MCQ_TREND_GRANULARITIES)}")
+    if not 1 <= periods <= 366:
+        raise HTTPException(status_code=400, detail="periods must be between 1 and 366")
+    
+    try:
+        step = MCQ_TREND_GRANULARITIES[granularity]
+        current_period = mcq_period_start(datetime.utcnow(), granularity)
+        since = current_period - step * (periods - 1)
+        buckets = {
+            bucket["period_start"]: bucket
+            for bucket in await mcq_attempt_bucket_repository.list_for_user(current_user["id"], granularity, since)
+        }
+        
+        points = []
+        score_bins = defaultdict(int)
+        difficulty_totals = {level: {"questions": 0, "correct": 0} for level in MCQ_DIFFICULTY_BUCKETS}
+        for index in range(periods):
+            period_start = since + step * index
+            bucket = buckets.get(period_start, {})
+            points.append(MCQTrendPoint(
+                periodStart=period_start.strftime("%Y-%m-%d"),
+                attempts=bucket.get("attempts", 0),
+                questionsAttempted=bucket.get("questions", 0),
+                questionsCorrect=bucket.get("correct", 0),
+                accuracy=percent(bucket.get("correct", 0), bucket.get("questions", 0))
+            ))
+            for score_bin, count in bucket.get("score_bins", {}).items():
+                score_bins[score_bin] += count
+            for level, counts in bucket.get("difficulty", {}).items():
+                if level in difficulty_totals:
+                    difficulty_totals[level]["questions"] += counts.get("questions", 0)
+                    difficulty_totals[level]["correct"] += counts.get("correct", 0)
+        
+        questions = sum(point.questionsAttempted for point in points)
+        return MCQTrendsResponse(
+            granularity=granularity,
+            periods=points,
+            attempts=sum(point.attempts for point in points),
+            accuracy=percent(sum(point.questionsCorrect for point in points), questions),
+            scorePercentiles=score_percentiles(score_bins),
+            difficultyAccuracy={
+                level.capitalize(): percent(totals["correct"], totals["questions"])
+                for level, totals in difficulty_totals.items()
+            }
+        )
+    
+    except Exception as e:
+        logger.error("Error getting MCQ trends: %s", str(e))
+        raise HTTPException(status_code=500, detail="Failed to get MCQ trends")
+
 @app.post("/analytics/mcq-completion")
 async def update_mcq_analytics(
     request: MCQCompletionRequest,
@@ -2087,63 +4519,32 @@ async def update_mcq_analytics(
 ):
     """Update user analytics after MCQ completion"""
     
-    print(f"🔄 MCQ Analytics Update Request:")
-    print(f"   User ID: {current_user.get('id', 'N/A')}")
-    print(f"   Correct Answers: {request.correct_answers}")
-    print(f"   Total Questions: {request.total_questions}")
-    print(f"   Case ID: {request.case_id}")
+    logger.debug("🔄 MCQ Analytics Update Request - user: %s, correct: %s/%s, case: %s", current_user.get('id', 'N/A'), request.correct_answers, request.total_questions, request.case_id)
     
     try:
         user_id = current_user["id"]
         
-        # Get user info
-        user = db.users.find_one({"_id": ObjectId(user_id)})
-        if not user:
+        # Increment the totals and the difficulty bucket in place, so concurrent
+        # completions never overwrite each other; mcq_attempted counts questions, not cases
+        totals = await user_repository.record_mcq_completion(
+            user_id,
+            request.correct_answers,
+            request.total_questions,
+            (request.case_difficulty or "").lower()
+        )
+        if not totals:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Update user's MCQ statistics
-        # For now, we'll store this in the user document
-        # In a real app, you might want a separate analytics collection
-        
-        current_mcq_attempted = user.get("mcq_attempted", 0)
-        current_correct = user.get("total_questions_correct", 0)
-        current_attempted = user.get("total_questions_attempted", 0)
-        
-        # Update the statistics
-        # mcq_attempted should count total questions attempted, not cases
-        new_mcq_attempted = current_mcq_attempted + request.total_questions
-        new_correct = current_correct + request.correct_answers
-        new_attempted = current_attempted + request.total_questions
-        
-        # Update difficulty counters based on attempted questions
-        difficulty_field = (request.case_difficulty or "").lower()
-        if difficulty_field in ["easy", "moderate", "hard"]:
-            diff_counts = user.get("difficulty_counts", {})
-            current = int(diff_counts.get(difficulty_field, 0))
-            diff_counts[difficulty_field] = current + request.total_questions
-        else:
-            diff_counts = user.get("difficulty_counts", {})
-
-        # Calculate new average score
+        new_mcq_attempted = totals.get("mcq_attempted", 0)
+        new_correct = totals.get("total_questions_correct", 0)
+        new_attempted = totals.get("total_questions_attempted", 0)
+        
+        # The average is derived from the totals rather than stored
         new_average_score = int((new_correct / new_attempted) * 100) if new_attempted > 0 else 0
         
-        # Update user document
-        update_result = db.users.update_one(
-            {"_id": ObjectId(user_id)},
-            {
-                "$set": {
-                    "mcq_attempted": new_mcq_attempted,
-                    "total_questions_correct": new_correct,
-                    "total_questions_attempted": new_attempted,
-                    "average_score": new_average_score,
-                    "difficulty_counts": diff_counts,
-                    "updated_at": datetime.now()
-                }
-            }
-        )
+        await asyncio.gather(record_user_activity(user_id), record_mcq_attempt(user_id, request))
         
-        print(f"📊 Database update result: {update_result.modified_count} documents modified")
-        print(f"📊 New stats: MCQ={new_mcq_attempted}, Correct={new_correct}, Total={new_attempted}, Avg={new_average_score}%")
+        logger.debug("📊 New stats: MCQ=%s, Correct=%s, Total=%s, Avg=%s%%", new_mcq_attempted, new_correct, new_attempted, new_average_score)
         
         return {
             "message": "Analytics updated successfully",
@@ -2155,8 +4556,10 @@ async def update_mcq_analytics(
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error updating MCQ analytics: {str(e)}")
+        logger.error("Error updating MCQ analytics: %s", str(e))
         raise HTTPException(
             status_code=500,
             detail="Failed to update analytics"
@@ -2170,7 +4573,7 @@ async def clear_user_analytics(current_user: dict = Depends(get_current_user)):
         user_id = current_user["id"]
         
         # Clear analytics fields for the user
-        result = db.users.update_one(
+        result = await user_repository.update_one(
             {"_id": ObjectId(user_id)},
             {
                 "$unset": {
@@ -2182,13 +4585,18 @@ async def clear_user_analytics(current_user: dict = Depends(get_current_user)):
             }
         )
         
+        await asyncio.gather(
+            mcq_attempt_repository.delete_for_user(user_id),
+            mcq_attempt_bucket_repository.delete_for_user(user_id)
+        )
+        
         if result.modified_count > 0:
             return {"message": "Analytics data cleared successfully"}
         else:
             return {"message": "No analytics data found to clear"}
         
     except Exception as e:
-        print(f"Error clearing analytics: {str(e)}")
+        logger.error("Error clearing analytics: %s", str(e))
         raise HTTPException(
             status_code=500,
             detail="Failed to clear analytics"
@@ -2201,10 +4609,10 @@ async def upload_document(
 ):
     """Upload a document and store it in MongoDB with enhanced processing"""
     
-    print(f" Document upload started: {file.filename} ({file.content_type})")
+    documents_logger.info("Document upload started: %s (%s)", file.filename, file.content_type)
     
     # Validate file size (20MB limit)
-    max_size = 20 * 1024 * 1024  # 20MB
+    max_size = UPLOAD_MAX_BYTES
     if file.size and file.size > max_size:
         raise HTTPException(
             status_code=400, 
@@ -2224,41 +4632,44 @@ async def upload_document(
             detail=f"File type {file.content_type} not supported. Allowed types: {', '.join(allowed_types)}"
         )
     
-    # Read file content
+    # Stream the file to a size-capped temp file; extractors read it from disk
+    upload = await spool_upload(file)
+    # The same bytes were uploaded before: link to the stored text instead of extracting it again
+    blob = await document_blob_repository.get(upload.sha256)
+    if blob and "text_file_id" not in blob:
+        blob = await asyncio.to_thread(migrate_inline_blob_text, blob["_id"])
     try:
-        content = await file.read()
         content_str = None
-        
-        if file.content_type in ["text/plain", "text/markdown"]:
-            content_str = content.decode('utf-8')
-            print(f" Text file processed: {len(content_str)} characters")
+        extraction_metadata = {}
+        # Only real extracted text is shared through the blob; placeholders stay on this document
+        extracted = False
+        
+        if blob:
+            content_str = await fetch_document_text(blob)
+            extraction_metadata = blob.get("extraction_metadata", {})
+            documents_logger.info("Duplicate upload, linking existing content %s: %s characters", upload.sha256[:12], len(content_str))
+        elif file.content_type in ["text/plain", "text/markdown"]:
+            content_str = await asyncio.to_thread(upload.read_text)
+            extracted = True
+            documents_logger.info("Text file processed: %s characters", len(content_str))
         elif file.content_type == "application/pdf":
             if PDF_AVAILABLE and PDF_LIBRARY:
                 # Extract actual content from PDF using available library
                 try:
-                    if PDF_LIBRARY == "pypdf":
-                        import pypdf
-                        pdf_reader = pypdf.PdfReader(io.BytesIO(content))
-                    else:  # PyPDF2
-                        import PyPDF2
-                        pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-                    
-                    content_str = ""
+                    extraction = await extract_pdf_pages(upload.path)
+                    content_str = pdf_pages_to_text(extraction["pages"])
+                    extraction_metadata = pdf_extraction_timing(extraction)
+                    extracted = bool(content_str.strip())
                     
-                    for page_num, page in enumerate(pdf_reader.pages):
-                        page_text = page.extract_text()
-                        if page_text.strip():
-                            content_str += f"\n--- Page {page_num + 1} ---\n"
-                            content_str += page_text
-                    
-                    if not content_str.strip():
+                    if not extracted:
                         # Fallback if no text could be extracted
                         content_str = f"PDF file: {file.filename}\n\nNote: This PDF file could not be processed for text extraction. Please ensure the PDF contains selectable text."
                     
-                    print(f" PDF processed with {PDF_LIBRARY}: {len(content_str)} characters extracted from {len(pdf_reader.pages)} pages")
+                    documents_logger.info("PDF processed with %s: %s characters extracted from %s pages in %ss (%s workers)", PDF_LIBRARY, len(content_str), extraction['total_pages'], extraction['seconds'], extraction['workers'])
                     
                 except Exception as e:
-                    print(f" PDF processing error with {PDF_LIBRARY}: {e}")
+                    documents_logger.error("PDF processing error with %s: %s", PDF_LIBRARY, e)
+                    extracted = False
                     content_str = f"PDF file: {file.filename}\n\nError: Could not extract text from PDF using {PDF_LIBRARY}. Please ensure the file is not corrupted and contains selectable text."
             else:
                 # Fallback content when no PDF library is available - provide sample medical content for testing
@@ -2302,76 +4713,93 @@ PROGNOSIS:
 Patient requires immediate intervention. Door-to-balloon time should be less than 90 minutes for optimal outcomes.
 
 Note: This is sample medical content for testing purposes. In a real scenario, this would be extracted from the actual PDF document."""
-                print(f" PDF file processed with enhanced fallback content: {len(content_str)} characters")
+                documents_logger.info("PDF file processed with enhanced fallback content: %s characters", len(content_str))
         elif file.content_type in ["application/msword", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"]:
             # Process Word documents (DOC and DOCX)
             try:
                 if file.content_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
                     # DOCX file processing
-                    import docx
-                    doc = docx.Document(io.BytesIO(content))
-                    content_str = ""
-                    
-                    for paragraph in doc.paragraphs:
-                        if paragraph.text.strip():
-                            content_str += paragraph.text + "\n"
+                    content_str = await asyncio.to_thread(extract_docx_text, upload.path)
                     
-                    # Also extract text from tables
-                    for table in doc.tables:
-                        for row in table.rows:
-                            for cell in row.cells:
-                                if cell.text.strip():
-                                    content_str += cell.text + " "
-                            content_str += "\n"
-                    
-                    if not content_str.strip():
+                    extracted = bool(content_str.strip())
+                    if not extracted:
                         content_str = f"DOCX file: {file.filename}\n\nNote: This DOCX file could not be processed for text extraction. Please ensure the document contains readable text."
                     
-                    print(f" DOCX processed: {len(content_str)} characters extracted")
+                    documents_logger.info("DOCX processed: %s characters extracted", len(content_str))
                     
                 elif file.content_type == "application/msword":
                     # DOC file processing using docx2txt
                     import docx2txt
-                    content_str = docx2txt.process(io.BytesIO(content))
+                    content_str = await asyncio.to_thread(docx2txt.process, upload.path)
                     
-                    if not content_str.strip():
+                    extracted = bool(content_str.strip())
+                    if not extracted:
                         content_str = f"DOC file: {file.filename}\n\nNote: This DOC file could not be processed for text extraction. Please ensure the document contains readable text."
                     
-                    print(f" DOC processed: {len(content_str)} characters extracted")
+                    documents_logger.info("DOC processed: %s characters extracted", len(content_str))
                     
             except ImportError as e:
-                print(f" Missing library for Word document processing: {e}")
+                documents_logger.error("Missing library for Word document processing: %s", e)
+                extracted = False
                 content_str = f"Word document: {file.filename}\n\nError: Required libraries for Word document processing are not installed. Please install python-docx and docx2txt."
             except Exception as e:
-                print(f" Error processing Word document: {e}")
+                documents_logger.error("Error processing Word document: %s", e)
+                extracted = False
                 content_str = f"Word document: {file.filename}\n\nError: Could not extract text from Word document. Please ensure the file is not corrupted and contains readable text."
         else:
             content_str = f"Document: {file.filename}. Content type: {file.content_type}. Please use text files for full functionality."
-            print(f" Unsupported file type processed with placeholder content")
+            documents_logger.info("Unsupported file type processed with placeholder content")
             
     except Exception as e:
-        print(f" Error reading file: {str(e)}")
+        documents_logger.error("Error reading file: %s", str(e))
         raise HTTPException(status_code=400, detail=f"Error reading file: {str(e)}")
+    finally:
+        upload.cleanup()
+    
+    if blob is None and extracted:
+        blob = await asyncio.to_thread(
+            store_document_blob, upload.sha256, file.content_type, upload.size, content_str, extraction_metadata
+        )
     
-    # Create document record
+    # Create document record; text and derived artifacts live on the shared blob
     document_doc = {
         "filename": file.filename,
         "content_type": file.content_type,
-        "size": len(content),
-        "content": content_str,
+        "size": upload.size,
         "uploaded_by": current_user["id"],
         "uploaded_at": datetime.utcnow(),
         "processing_status": "completed"
     }
+    if blob:
+        document_doc.update({"blob_id": blob["_id"], "content_hash": blob["content_hash"]})
+    else:
+        # Extraction failed: keep the placeholder text on this document only, so the next
+        # upload of the same file is extracted again instead of linking to the placeholder
+        document_doc.update({
+            "content": content_str,
+            "content_hash": hashlib.sha256(content_str.encode("utf-8")).hexdigest(),
+            "text_length": len(content_str),
+            "extraction_metadata": extraction_metadata,
+            "extraction_failed": True
+        })
     
     # Store in MongoDB
-    result = db.documents.insert_one(document_doc)
-    document_id = str(result.inserted_id)
+    document_id = await document_repository.create(document_doc)
+    if blob:
+        await document_blob_repository.link(blob["_id"])
+    await record_user_activity(current_user["id"], document_count=1)
+    
+    documents_logger.info("Document stored successfully with ID: %s", document_id)
     
-    print(f" Document stored successfully with ID: {document_id}")
+    # Clean and chunk once per blob so generation and chat never re-process the full text
+    if blob and blob.get("index_version") != DOCUMENT_INDEX_VERSION:
+        try:
+            await asyncio.to_thread(index_document, blob["_id"], content_str)
+        except Exception as e:
+            documents_logger.warning("⚠️ Failed to index document %s, it will be indexed on first use: %s", document_id, e)
     
     # Create notification for file upload
-    create_notification(
+    await create_notification(
         user_id=current_user["id"],
         notification_type="file_upload",
         title="Document Uploaded",
@@ -2379,12 +4807,14 @@ Note: This is sample medical content for testing purposes. In a real scenario, t
         metadata={
             "document_id": document_id,
             "filename": file.filename,
-            "file_size": len(content),
+            "file_size": upload.size,
             "content_type": file.content_type
         }
     )
     
     # Return response
+    document_doc["content"] = content_str
+    document_doc["extraction_metadata"] = extraction_metadata
     document_doc["id"] = document_id
     del document_doc["_id"]
     
@@ -2397,10 +4827,10 @@ async def upload_document_enhanced(
 ):
     """Upload a document with enhanced PDF extraction and automatic case/MCQ detection"""
     
-    print(f" Enhanced document upload started: {file.filename} ({file.content_type})")
+    documents_logger.info("Enhanced document upload started: %s (%s)", file.filename, file.content_type)
     
     # Validate file size (20MB limit)
-    max_size = 20 * 1024 * 1024
+    max_size = UPLOAD_MAX_BYTES
     if file.size and file.size > max_size:
         raise HTTPException(
             status_code=400, 
@@ -2420,23 +4850,52 @@ async def upload_document_enhanced(
             detail=f"File type {file.content_type} not supported"
         )
     
-    # Read file content
+    # Stream the file to a size-capped temp file; extractors read it from disk
+    upload = await spool_upload(file)
+    # The same bytes were uploaded before: link to the stored text instead of extracting it again
+    blob = await document_blob_repository.get(upload.sha256)
+    if blob and "text_file_id" not in blob:
+        blob = await asyncio.to_thread(migrate_inline_blob_text, blob["_id"])
     try:
-        content = await file.read()
         content_str = None
         extraction_metadata = {}
-        
-        if file.content_type in ["text/plain", "text/markdown"]:
-            content_str = content.decode('utf-8')
-            print(f" Text file processed: {len(content_str)} characters")
+        # Only real extracted text is shared through the blob; placeholders stay on this document
+        extracted = False
+        
+        if blob:
+            content_str = await fetch_document_text(blob)
+            extraction_metadata = blob.get("extraction_metadata", {})
+            documents_logger.info("Duplicate upload, linking existing content %s: %s characters", upload.sha256[:12], len(content_str))
+            if file.content_type == "application/pdf" and "has_cases" not in extraction_metadata:
+                # First uploaded through the basic endpoint, which skips case/MCQ detection
+                extractor = PDFContentExtractor()
+                detected_cases = await asyncio.to_thread(extractor.detect_cases, content_str)
+                detected_mcqs = await asyncio.to_thread(extractor.detect_mcqs, content_str)
+                extraction_metadata = {
+                    **extraction_metadata,
+                    "has_cases": len(detected_cases) > 0,
+                    "has_mcqs": len(detected_mcqs) > 0,
+                    "detected_cases_count": len(detected_cases),
+                    "detected_mcqs_count": len(detected_mcqs),
+                    "detected_cases": detected_cases,
+                    "detected_mcqs": detected_mcqs
+                }
+                await document_blob_repository.update_fields(blob["_id"], {"extraction_metadata": extraction_metadata})
+        elif file.content_type in ["text/plain", "text/markdown"]:
+            content_str = await asyncio.to_thread(upload.read_text)
+            extracted = True
+            documents_logger.info("Text file processed: %s characters", len(content_str))
             
         elif file.content_type == "application/pdf":
             if PDF_AVAILABLE and PDF_LIBRARY == "pypdf":
                 try:
                     extractor = PDFContentExtractor()
-                    result = extractor.extract_text_from_pdf(content)
+                    extraction = await extract_pdf_pages(upload.path)
+                    # Case/MCQ detection is regex work over the whole text, so keep it off the event loop too
+                    result = await asyncio.to_thread(extractor.analyze_pages, extraction["pages"], extraction["total_pages"])
                     
                     content_str = result["full_text"]
+                    extracted = bool(content_str.strip())
                     
                     # Store extraction metadata
                     extraction_metadata = {
@@ -2446,25 +4905,21 @@ async def upload_document_enhanced(
                         "detected_cases_count": len(result["detected_cases"]),
                         "detected_mcqs_count": len(result["detected_mcqs"]),
                         "detected_cases": result["detected_cases"],
-                        "detected_mcqs": result["detected_mcqs"]
+                        "detected_mcqs": result["detected_mcqs"],
+                        **pdf_extraction_timing(extraction)
                     }
                     
-                    print(f" Enhanced PDF processing:")
-                    print(f"   - Pages: {result['total_pages']}")
-                    print(f"   - Cases detected: {len(result['detected_cases'])}")
-                    print(f"   - MCQs detected: {len(result['detected_mcqs'])}")
-                    print(f"   - Characters extracted: {len(content_str)}")
+                    documents_logger.info(
+                        "Enhanced PDF processing: %s pages in %ss (%s workers, %s shards), %s cases, %s MCQs, %s characters extracted",
+                        result['total_pages'], extraction['seconds'], extraction['workers'], extraction['shards'],
+                        len(result['detected_cases']), len(result['detected_mcqs']), len(content_str)
+                    )
                     
                 except Exception as e:
-                    print(f" Enhanced PDF processing error: {e}")
+                    documents_logger.error("Enhanced PDF processing error: %s", e)
                     # Fallback to basic extraction
-                    pdf_reader = pypdf.PdfReader(io.BytesIO(content))
-                    content_str = ""
-                    for page_num, page in enumerate(pdf_reader.pages):
-                        page_text = page.extract_text()
-                        if page_text.strip():
-                            content_str += f"\n--- Page {page_num + 1} ---\n"
-                            content_str += page_text
+                    content_str = pdf_pages_to_text(await asyncio.to_thread(extract_pdf_page_range, upload.path))
+                    extracted = bool(content_str.strip())
             else:
                 # Fallback content
                 content_str = f"PDF file: {file.filename}\n\nPDF processing library not available."
@@ -2474,36 +4929,24 @@ async def upload_document_enhanced(
             try:
                 if file.content_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
                     # DOCX file processing
-                    import docx
-                    doc = docx.Document(io.BytesIO(content))
-                    content_str = ""
-                    
-                    for paragraph in doc.paragraphs:
-                        if paragraph.text.strip():
-                            content_str += paragraph.text + "\n"
+                    content_str = await asyncio.to_thread(extract_docx_text, upload.path)
                     
-                    # Also extract text from tables
-                    for table in doc.tables:
-                        for row in table.rows:
-                            for cell in row.cells:
-                                if cell.text.strip():
-                                    content_str += cell.text + " "
-                            content_str += "\n"
-                    
-                    if not content_str.strip():
+                    extracted = bool(content_str.strip())
+                    if not extracted:
                         content_str = f"DOCX file: {file.filename}\n\nNote: This DOCX file could not be processed for text extraction. Please ensure the document contains readable text."
                     
-                    print(f" Enhanced DOCX processed: {len(content_str)} characters extracted")
+                    documents_logger.info("Enhanced DOCX processed: %s characters extracted", len(content_str))
                     
                 elif file.content_type == "application/msword":
                     # DOC file processing using python-docx2txt
                     import docx2txt
-                    content_str = docx2txt.process(io.BytesIO(content))
+                    content_str = await asyncio.to_thread(docx2txt.process, upload.path)
                     
-                    if not content_str.strip():
+                    extracted = bool(content_str.strip())
+                    if not extracted:
                         content_str = f"DOC file: {file.filename}\n\nNote: This DOC file could not be processed for text extraction. Please ensure the document contains readable text."
                     
-                    print(f" Enhanced DOC processed: {len(content_str)} characters extracted")
+                    documents_logger.info("Enhanced DOC processed: %s characters extracted", len(content_str))
                     
                 # For Word documents, we can also try to detect cases and MCQs
                 if content_str and len(content_str) > 100:  # Only if we have substantial content
@@ -2522,42 +4965,70 @@ async def upload_document_enhanced(
                         "word_document_processed": True
                     }
                     
-                    print(f" Enhanced Word document analysis:")
-                    print(f"   - Cases detected: {has_cases}")
-                    print(f"   - MCQs detected: {has_mcqs}")
-                    print(f"   - Characters extracted: {len(content_str)}")
+                    documents_logger.info(
+                        "Enhanced Word document analysis: cases detected: %s, MCQs detected: %s, %s characters extracted",
+                        has_cases, has_mcqs, len(content_str)
+                    )
                     
             except ImportError as e:
-                print(f" Missing library for Word document processing: {e}")
+                documents_logger.error("Missing library for Word document processing: %s", e)
+                extracted = False
                 content_str = f"Word document: {file.filename}\n\nError: Required libraries for Word document processing are not installed. Please install python-docx and docx2txt."
             except Exception as e:
-                print(f" Error processing Word document: {e}")
+                documents_logger.error("Error processing Word document: %s", e)
+                extracted = False
                 content_str = f"Word document: {file.filename}\n\nError: Could not extract text from Word document. Please ensure the file is not corrupted and contains readable text."
                 
     except Exception as e:
-        print(f" Error reading file: {str(e)}")
+        documents_logger.error("Error reading file: %s", str(e))
         raise HTTPException(status_code=400, detail=f"Error reading file: {str(e)}")
+    finally:
+        upload.cleanup()
+    
+    if blob is None and extracted:
+        blob = await asyncio.to_thread(
+            store_document_blob, upload.sha256, file.content_type, upload.size, content_str, extraction_metadata
+        )
     
-    # Create document record
+    # Create document record; text and derived artifacts live on the shared blob
     document_doc = {
         "filename": file.filename,
         "content_type": file.content_type,
-        "size": len(content),
-        "content": content_str,
+        "size": upload.size,
         "uploaded_by": current_user["id"],
         "uploaded_at": datetime.utcnow(),
-        "processing_status": "completed",
-        "extraction_metadata": extraction_metadata
+        "processing_status": "completed"
     }
+    if blob:
+        document_doc.update({"blob_id": blob["_id"], "content_hash": blob["content_hash"]})
+    else:
+        # Extraction failed: keep the placeholder text on this document only, so the next
+        # upload of the same file is extracted again instead of linking to the placeholder
+        document_doc.update({
+            "content": content_str,
+            "content_hash": hashlib.sha256(content_str.encode("utf-8")).hexdigest(),
+            "text_length": len(content_str),
+            "extraction_metadata": extraction_metadata,
+            "extraction_failed": True
+        })
     
     # Store in MongoDB
-    result = db.documents.insert_one(document_doc)
-    document_id = str(result.inserted_id)
+    document_id = await document_repository.create(document_doc)
+    if blob:
+        await document_blob_repository.link(blob["_id"])
+    await record_user_activity(current_user["id"], document_count=1)
+    
+    documents_logger.info("Enhanced document stored successfully with ID: %s", document_id)
     
-    print(f" Enhanced document stored successfully with ID: {document_id}")
+    # Clean and chunk once per blob so generation and chat never re-process the full text
+    if blob and blob.get("index_version") != DOCUMENT_INDEX_VERSION:
+        try:
+            await asyncio.to_thread(index_document, blob["_id"], content_str)
+        except Exception as e:
+            documents_logger.warning("⚠️ Failed to index document %s, it will be indexed on first use: %s", document_id, e)
     
     # Create notification for file upload
-    create_notification(
+    await create_notification(
         user_id=current_user["id"],
         notification_type="file_upload",
         title="Document Uploaded",
@@ -2565,13 +5036,15 @@ async def upload_document_enhanced(
         metadata={
             "document_id": document_id,
             "filename": file.filename,
-            "file_size": len(content),
+            "file_size": upload.size,
             "content_type": file.content_type,
-            "extraction_metadata": extraction_metadata
+            "extraction_metadata": {key: value for key, value in extraction_metadata.items() if key != "page_timings"}
         }
     )
     
     # Return response
+    document_doc["content"] = content_str
+    document_doc["extraction_metadata"] = extraction_metadata
     document_doc["id"] = document_id
     del document_doc["_id"]
     
@@ -2585,10 +5058,7 @@ async def get_extracted_content(
     """Get extracted cases and MCQs from a document"""
     
     try:
-        document = db.documents.find_one({
-            "_id": ObjectId(document_id),
-            "uploaded_by": current_user["id"]
-        })
+        document = await document_repository.get_for_user(document_id, current_user["id"])
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid document ID")
     
@@ -2612,7 +5082,7 @@ async def get_extracted_content(
 async def test_openai():
     """Test OpenAI API and list available models"""
     try:
-        if not openai_client:
+        if not llm_gateway:
             return {
                 "api_key_configured": False,
                 "api_key_prefix": None,
@@ -2621,7 +5091,7 @@ async def test_openai():
             }
         
         # List available models
-        models = openai_client.models.list()
+        models = await llm_gateway.list_models()
         available_models = [model.id for model in models.data if 'gpt' in model.id.lower()]
         
         return {
@@ -2651,10 +5121,7 @@ async def generate_case_scenarios(
     
     # 1) Find the document
     try:
-        document = db.documents.find_one({
-            "_id": ObjectId(request.document_id),
-            "uploaded_by": current_user["id"]
-        })
+        document = await document_repository.get_for_user(request.document_id, current_user["id"])
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid document ID")
     
@@ -2662,12 +5129,12 @@ async def generate_case_scenarios(
         raise HTTPException(status_code=404, detail="Document not found or access denied")
     
     # Check if document has text content
-    if not document.get("content"):
+    if not document.get("text_length"):
         raise HTTPException(status_code=400, detail="Document does not contain readable text content")
     
     try:
         # 2) Use OpenAI GPT-4 mini
-        if not openai_client:
+        if not llm_gateway:
             raise Exception("OpenAI client not initialized")
         
         # Create the prompt for case generation
@@ -2675,7 +5142,7 @@ async def generate_case_scenarios(
         You are an expert medical case scenario generator specializing in creating comprehensive, educational medical cases for medical students. Based on the following document content and user prompt, generate {request.num_scenarios} realistic, detailed medical case scenarios.
 
         Document Content:
-        {document['content'][:3000]}  # Increased context for better relevance
+        {await select_document_context(document, request.prompt, 750)}
 
         User Prompt: {request.prompt}
 
@@ -2715,7 +5182,7 @@ async def generate_case_scenarios(
         """
         
         # Generate response from OpenAI
-        response = openai_client.chat.completions.create(
+        response = await llm_gateway.chat_completion(
             model="gpt-4.1",
             messages=[
                 {
@@ -2779,7 +5246,7 @@ async def generate_case_scenarios(
         # 5) Persist generated cases so Key Concepts / Explore Case can find them
         try:
             for scen in normalized_scenarios:
-                db.generated_cases.insert_one(
+                await generated_case_repository.create(
                     {
                         "document_id": str(document["_id"]),   # IMPORTANT: store as string
                         "title": scen["title"],
@@ -2793,7 +5260,7 @@ async def generate_case_scenarios(
                 )
         except Exception as e:
             # Non‑fatal: log but don't break the endpoint
-            print(f"⚠️ Warning: failed to persist generated_cases: {e}")
+            llm_logger.warning("⚠️ Warning: failed to persist generated_cases: %s", e)
         
         # 6) Convert to CaseScenario objects for the response
         scenarios = [CaseScenario(**scenario) for scenario in normalized_scenarios]
@@ -2811,19 +5278,24 @@ async def generate_case_scenarios(
 @app.post("/ai/generate-case-titles", response_model=CaseTitlesResponse)
 async def generate_case_titles(
     request: CaseTitleRequest,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    mode: GenerationMode = "sync",
+    cache: CacheMode = "use"
 ):
-    """Generate case titles from a document using OpenAI GPT-4 mini"""
+    """Generate case titles from a document using OpenAI GPT-4 mini
+
+    Pass cache=bypass to force a fresh generation (the result still refreshes the cache).
+    """
     
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     
+    if mode == "job":
+        return await submit_generation_job("generate_case_titles", request, current_user, {"cache": cache})
+    
     # Find the document
     try:
-        document = db.documents.find_one({
-            "_id": ObjectId(request.document_id),
-            "uploaded_by": current_user["id"]
-        })
+        document = await document_repository.get_for_user(request.document_id, current_user["id"])
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid document ID")
     
@@ -2831,12 +5303,19 @@ async def generate_case_titles(
         raise HTTPException(status_code=404, detail="Document not found or access denied")
     
     # Check if document has text content
-    if not document.get("content"):
+    if not document.get("text_length"):
         raise HTTPException(status_code=400, detail="Document does not contain readable text content")
     
+    cache_key = llm_response_cache.make_key(
+        "case_titles", "gpt-4.1", {"num_cases": request.num_cases}, document_content_hash(document)
+    )
+    cached = await llm_response_cache.get(cache_key, "case_titles", bypass=cache == "bypass")
+    if cached is not None:
+        return CaseTitlesResponse(document_id=request.document_id, cases=cached["cases"], generated_at=datetime.utcnow())
+    
     try:
         # Use OpenAI GPT-4 mini
-        if not openai_client:
+        if not llm_gateway:
             raise Exception("OpenAI client not initialized")
         
         # Determine difficulty distribution
@@ -2864,7 +5343,7 @@ async def generate_case_titles(
         You are an expert medical case generator. Based on the following document content, generate {num_cases} realistic medical case titles with brief descriptions that are DIRECTLY RELEVANT to the document content.
 
         Document Content:
-        {document['content'][:3000]}
+        {await select_document_context(document, None, 750)}
 
         CRITICAL RELEVANCE REQUIREMENTS:
         - Cases MUST be directly based on the medical concepts, conditions, and information in the document above
@@ -2908,7 +5387,7 @@ async def generate_case_titles(
         if request.num_cases == 5:
             system_message += " CRITICAL: When generating 5 cases, you MUST create exactly 3 Moderate cases (first, second, and third), and 2 Hard cases (fourth and fifth) in this EXACT order. The case descriptions must match their difficulty levels and be directly relevant to the document content."
         
-        response = openai_client.chat.completions.create(
+        response = await llm_gateway.chat_completion(
             model="gpt-4.1",
             messages=[
                 {"role": "system", "content": system_message},
@@ -2921,8 +5400,9 @@ async def generate_case_titles(
         
         # Parse the response
         import json
-        print(f"AI Raw OpenAI response: {response.choices[0].message.content}")
+        llm_logger.debug("AI Raw OpenAI response: %s", response.choices[0].message.content)
         
+        used_fallback = False
         try:
             # Try to extract JSON from the response if it's wrapped in markdown
             response_text = response.choices[0].message.content.strip()
@@ -2932,7 +5412,7 @@ async def generate_case_titles(
                 response_text = response_text.replace('```', '').strip()
             
             cases_data = json.loads(response_text)
-            print(f"SUCCESS: Successfully parsed JSON: {len(cases_data)} cases")
+            llm_logger.info("SUCCESS: Successfully parsed JSON: %s cases", len(cases_data))
             
             # Validate and enforce difficulty distribution for 5 cases
             if request.num_cases == 5 and len(cases_data) >= 5:
@@ -2953,27 +5433,27 @@ async def generate_case_titles(
                     else:
                         difficulty_counts["Moderate"] += 1  # Default to Moderate
                 
-                print(f"📊 Difficulty distribution before fix: Easy={difficulty_counts['Easy']}, Moderate={difficulty_counts['Moderate']}, Hard={difficulty_counts['Hard']}")
+                llm_logger.info("📊 Difficulty distribution before fix: Easy=%s, Moderate=%s, Hard=%s", difficulty_counts['Easy'], difficulty_counts['Moderate'], difficulty_counts['Hard'])
                 
                 # Always enforce correct distribution in order (even if already correct, ensure order is right)
                 if difficulty_counts["Easy"] != 1 or difficulty_counts["Moderate"] != 2 or difficulty_counts["Hard"] != 2:
-                    print(f"⚠️ WARNING: Difficulty distribution incorrect. Expected: 1 Easy, 2 Moderate, 2 Hard. Got: {difficulty_counts}")
+                    llm_logger.warning("⚠️ WARNING: Difficulty distribution incorrect. Expected: 1 Easy, 2 Moderate, 2 Hard. Got: %s", difficulty_counts)
                 
-                print(f"🔧 Enforcing correct distribution in order: [Easy, Moderate, Moderate, Hard, Hard]")
+                llm_logger.info("🔧 Enforcing correct distribution in order: [Easy, Moderate, Moderate, Hard, Hard]")
                 
                 # Force correct distribution in exact order (always, to ensure consistency)
                 for i, case in enumerate(cases_data[:5]):
                     case["difficulty"] = required_distribution[i]
-                    print(f"  Case {i+1}: Set difficulty to {required_distribution[i]}")
+                    llm_logger.debug("Case %s: Set difficulty to %s", i+1, required_distribution[i])
                 
                 # Verify final distribution
                 final_counts = {"Easy": 0, "Moderate": 0, "Hard": 0}
                 for case in cases_data[:5]:
                     final_counts[case.get("difficulty", "Moderate")] += 1
-                print(f"✅ Final difficulty distribution: Easy={final_counts['Easy']}, Moderate={final_counts['Moderate']}, Hard={final_counts['Hard']}")
+                llm_logger.info("✅ Final difficulty distribution: Easy=%s, Moderate=%s, Hard=%s", final_counts['Easy'], final_counts['Moderate'], final_counts['Hard'])
         except json.JSONDecodeError as e:
-            print(f"ERROR: JSON parsing failed: {e}")
-            print(f"Response text: {response.choices[0].message.content[:500]}...")
+            llm_logger.error("ERROR: JSON parsing failed: %s", e)
+            llm_logger.debug("Response text: %s...", response.choices[0].message.content[:500])
             # If JSON parsing fails, create a fallback response based on document content
             # Create a longer fallback description (250-300 words)
             fallback_description = f"""This medical case scenario is based on the uploaded document content and presents a comprehensive clinical scenario designed for medical education. The case includes a detailed patient presentation with comprehensive demographic information, presenting complaint, and relevant social history that provides important context for understanding the clinical situation. The patient's medical history is thoroughly documented, including past medical conditions, previous surgeries, family history, and any relevant genetic or environmental factors that may influence the current presentation. Physical examination findings are described in detail, including vital signs, general appearance, and system-by-system examination results with both positive and negative findings that are crucial for differential diagnosis. Diagnostic test results are provided with specific values, reference ranges, and clinical interpretation to help students understand how laboratory and imaging studies contribute to the diagnostic process. Treatment considerations are explored, including first-line and alternative therapeutic options, with discussion of mechanism of action, indications, contraindications, and potential side effects. The case also addresses important learning points related to pathophysiology, clinical reasoning, differential diagnosis, and evidence-based medicine principles. This comprehensive approach ensures that medical students gain a thorough understanding of the clinical scenario, develop critical thinking skills, and learn to apply medical knowledge in realistic patient care situations. The case is designed to be educational, clinically relevant, and aligned with current medical practice guidelines and standards of care."""
@@ -2984,10 +5464,14 @@ async def generate_case_titles(
                 "description": fallback_description,
                 "difficulty": "Moderate"
             } for i in range(request.num_cases)]
+            used_fallback = True
         
         # Convert to CaseTitle objects
         cases = [CaseTitle(**case) for case in cases_data[:request.num_cases]]
         
+        if not used_fallback:
+            await llm_response_cache.set(cache_key, {"cases": jsonable_encoder(cases)}, "case_titles")
+        
         return CaseTitlesResponse(
             document_id=request.document_id,
             cases=cases,
@@ -3000,90 +5484,30 @@ async def generate_case_titles(
 @app.post("/ai/generate-mcqs", response_model=MCQResponse)
 async def generate_mcqs(
     request: MCQRequest,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    cache: CacheMode = "use"
 ):
-    """Generate MCQ questions from a document or case using OpenAI GPT-4 mini"""
+    """Generate MCQ questions from a document or case using OpenAI GPT-4 mini
+
+    Pass cache=bypass to force a fresh generation (the result still refreshes the cache).
+    """
     
-    print(f"🎯 MCQ Generation Request - Difficulty: {request.difficulty}, Case: {request.case_title}")
+    llm_logger.info("🎯 MCQ Generation Request - Difficulty: %s, Case: %s", request.difficulty, request.case_title)
     
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     
     document_context = ""
     
-    def clean_document_content(content):
-        """Remove metadata and non-medical content from document."""
-        if not content:
-            return ""
-        
-        lines = content.split('\n')
-        cleaned_lines = []
-        skip_section = False
-        
-        # Keywords that indicate metadata sections to skip
-        metadata_indicators = [
-            "author:", "authors:", "publication:", "published:", "journal:",
-            "copyright", "doi:", "isbn:", "issn:", "reference", "citation",
-            "bibliography", "acknowledgment", "affiliation", "institution:",
-            "university:", "department:", "page", "chapter", "section",
-            "abstract:", "keywords:", "corresponding author"
-        ]
-        
-        for line in lines:
-            line_lower = line.lower().strip()
-            
-            # Skip lines that are clearly metadata
-            if any(indicator in line_lower for indicator in metadata_indicators):
-                # Check if it's actually metadata (not a medical term)
-                if any(term in line_lower for term in ["author", "publication", "journal", "copyright", 
-                                                       "doi", "isbn", "issn", "reference", "citation",
-                                                       "bibliography", "acknowledgment", "affiliation"]):
-                    skip_section = True
-                    continue
-            
-            # Skip empty lines if we're in a metadata section
-            if skip_section and not line.strip():
-                continue
-            
-            # Reset skip flag if we hit a new substantial line (likely medical content)
-            if skip_section and len(line.strip()) > 20 and not any(indicator in line_lower for indicator in metadata_indicators):
-                skip_section = False
-            
-            if not skip_section:
-                cleaned_lines.append(line)
-        
-        cleaned = '\n'.join(cleaned_lines)
-        
-        # Remove common metadata patterns
-        import re
-        # Remove lines with email patterns
-        cleaned = re.sub(r'[\w\.-]+@[\w\.-]+\.\w+', '', cleaned)
-        # Remove lines with URL patterns
-        cleaned = re.sub(r'https?://\S+', '', cleaned)
-        # Remove lines that are just numbers (likely page numbers)
-        cleaned = re.sub(r'^\s*\d+\s*$', '', cleaned, flags=re.MULTILINE)
-        
-        return cleaned.strip()
-    
     # Get document context if document_id is provided
     if request.document_id:
         try:
-            document = db.documents.find_one({
-                "_id": ObjectId(request.document_id),
-                "uploaded_by": current_user["id"]
-            })
-            if document and document.get("content"):
-                raw_content = document['content']
-                # Clean metadata before using
-                cleaned_content = clean_document_content(raw_content)
-                # If cleaning removed too much, use original but with warning
-                if len(cleaned_content.strip()) < 100 and len(raw_content) > 500:
-                    print(f"WARNING: Document cleaning removed too much content. Using original with metadata warning.")
-                    document_context = raw_content[:800]
-                else:
-                    document_context = cleaned_content[:800]  # Increased after cleaning
+            document = await document_repository.get_for_user(request.document_id, current_user["id"])
+            if document and document.get("text_length"):
+                # Pick the passages most relevant to the case from the pre-cleaned chunk index
+                document_context = await select_document_context(document, request.case_title, 200)
         except Exception as e:
-            print(f"ERROR: Failed to fetch/clean document: {e}")
+            llm_logger.error("ERROR: Failed to fetch/clean document: %s", e)
             pass
     
     if not document_context or len(document_context.strip()) < 50:
@@ -3106,17 +5530,8 @@ async def generate_mcqs(
         
         # Try to find the case in generated_cases collection for full description
         try:
-            doc_id_str = str(request.document_id)
-            # Try multiple query formats
-            case_doc = db.generated_cases.find_one({
-                "title": request.case_title,
-                "document_id": doc_id_str
-            })
-            if not case_doc:
-                # Try without document_id constraint (in case format differs)
-                case_doc = db.generated_cases.find_one({
-                    "title": request.case_title
-                })
+            # Falls back to matching the title alone (in case the document_id format differs)
+            case_doc = await generated_case_repository.find_by_title(request.case_title, str(request.document_id))
             
             if case_doc:
                 case_details = case_doc
@@ -3130,7 +5545,7 @@ async def generate_mcqs(
                     gender_match = re.search(r'\b(girl|boy|female|male|woman|man|child)\b', case_description, re.IGNORECASE)
                     gender = gender_match.group(1).lower() if gender_match else None
         except Exception as e:
-            print(f"⚠️ Warning: Could not fetch case details from database for MCQ generation: {e}")
+            llm_logger.warning("⚠️ Warning: Could not fetch case details from database for MCQ generation: %s", e)
             # Continue with title-based extraction
         
         # Build demographics string
@@ -3151,25 +5566,42 @@ async def generate_mcqs(
             # Last resort: use the case title itself
             case_demographics = f"\n\nCRITICAL CASE CONTEXT:\n- Case Title: {request.case_title}\n- ALL MCQ questions MUST be consistent with this specific case scenario\n- Extract and maintain consistency with patient demographics from the case title"
     
-    try:
-        # Use OpenAI GPT-4 mini
-        if not openai_client:
-            raise Exception("OpenAI client not initialized")
-        
-        # Create the prompt for MCQ generation
-        case_context = ""
-        if request.case_title:
-            if case_demographics:
-                case_context = f"\n\nSpecific Case Focus: {request.case_title}{case_demographics}\n\nGenerate MCQs specifically related to this case scenario. Maintain strict consistency with the patient demographics provided above."
-            else:
-                case_context = f"\n\nSpecific Case Focus: {request.case_title}\nGenerate MCQs specifically related to this case scenario."
+    cache_key = llm_response_cache.make_key(
+        "mcqs",
+        "gpt-4.1",
+        {
+            "case_title": normalize_cache_text(request.case_title),
+            "difficulty": normalize_cache_text(request.difficulty or "Moderate"),
+            "num_questions": request.num_questions,
+            "case_context": case_demographics
+        },
+        document_content_hash(document)
+    )
+    cached = await llm_response_cache.get(cache_key, "mcqs", bypass=cache == "bypass")
+    if cached is not None:
+        return MCQResponse(questions=cached["questions"], generated_at=datetime.utcnow())
+    
+    async def run_generation():
+        """Generate, validate and cache the questions for this request"""
+        try:
+            # Use OpenAI GPT-4 mini
+            if not llm_gateway:
+                raise Exception("OpenAI client not initialized")
+        
+            # Create the prompt for MCQ generation
+            case_context = ""
+            if request.case_title:
+                if case_demographics:
+                    case_context = f"\n\nSpecific Case Focus: {request.case_title}{case_demographics}\n\nGenerate MCQs specifically related to this case scenario. Maintain strict consistency with the patient demographics provided above."
+                else:
+                    case_context = f"\n\nSpecific Case Focus: {request.case_title}\nGenerate MCQs specifically related to this case scenario."
         
-        # Build difficulty instruction - make it very explicit
-        difficulty_instruction = ""
-        if request.difficulty:
-            difficulty_instruction = f"""- Assign difficulty (Easy/Moderate/Hard)"""
+            # Build difficulty instruction - make it very explicit
+            difficulty_instruction = ""
+            if request.difficulty:
+                difficulty_instruction = f"""- Assign difficulty (Easy/Moderate/Hard)"""
         
-        system_prompt = f"""TASK: GENERATE A SINGLE-BEST-ANSWER MULTIPLE-CHOICE QUESTION (MCQ) WITH RATIONALE
+            system_prompt = f"""TASK: GENERATE A SINGLE-BEST-ANSWER MULTIPLE-CHOICE QUESTION (MCQ) WITH RATIONALE
 
 Based on the preceding medical case information, generate {request.num_questions} multiple-choice question(s) designed to test high-yield, essential clinical concepts related to this case.
 
@@ -3296,28 +5728,28 @@ CRITICAL REQUIREMENTS:
 
 Return JSON array only with ALL questions having difficulty: "{request.difficulty or 'Moderate'}" """
         
-        # Generate response from OpenAI with optimized settings
-        try:
-            response = openai_client.chat.completions.create(
-                model="gpt-4.1",
-                messages=[
-                    {"role": "system", "content": f"You are a medical educator. Generate single-best-answer MCQs with exactly 5 options (A-E). Test high-yield essential clinical concepts with plausible distractors. Include mandatory answer rationale. ALL questions must have EXACTLY the same difficulty: {request.difficulty or 'Moderate'}. Always respond with valid JSON format. CRITICAL DIVERSITY: When generating multiple questions, create VARIED question types - NOT all about the same patient. Mix patient-specific questions (max 1-2), case-based scenarios, general concept questions, mechanism/pathophysiology questions, diagnostic questions, and management questions. Do NOT repeat the same patient demographics or start every question with patient information. STRICTLY PROHIBITED: NEVER create questions about document metadata, author names, publication dates, journal names, file names, or any bibliographic/non-medical information. Only focus on medical concepts, pathophysiology, diagnosis, and treatment."},
-                    {"role": "user", "content": system_prompt}
-                ],
-                temperature=0.3,  # Slightly higher for faster generation while maintaining quality
-                max_tokens=4000,  # Increased to ensure complete questions with full options are generated
-                timeout=120  # Increased timeout for better quality generation
-            )
-        except Exception as e:
-            print(f"OpenAI API error: {e}")
-            # Fallback: try with even more optimized settings
-            response = openai_client.chat.completions.create(
-                model="gpt-4.1",
-                messages=[
-                    {"role": "system", "content": f"Generate single-best-answer medical MCQs with 5 options (A-E) in JSON format. ALL questions must have difficulty: {request.difficulty or 'Moderate'}. Questions must test high-yield clinical concepts with plausible distractors. CRITICAL DIVERSITY: Create VARIED question types - NOT all about the same patient. Mix patient-specific, case-based, general concept, mechanism, diagnostic, and management questions. Do NOT repeat demographics or start every question with patient information. STRICTLY PROHIBITED: NEVER create questions about document metadata, author names, publication dates, journal names, file names, or any bibliographic/non-medical information. Only focus on medical concepts, pathophysiology, diagnosis, and treatment."},
-                    {"role": "user", "content": f"""Create {request.num_questions} case-based medical MCQs with 5 options each from the following MEDICAL CONTENT ONLY (ignore any metadata, author names, publication info, or bibliographic details):
+            # Generate response from OpenAI with optimized settings
+            try:
+                response = await llm_gateway.chat_completion(
+                    model="gpt-4.1",
+                    messages=[
+                        {"role": "system", "content": f"You are a medical educator. Generate single-best-answer MCQs with exactly 5 options (A-E). Test high-yield essential clinical concepts with plausible distractors. Include mandatory answer rationale. ALL questions must have EXACTLY the same difficulty: {request.difficulty or 'Moderate'}. Always respond with valid JSON format. CRITICAL DIVERSITY: When generating multiple questions, create VARIED question types - NOT all about the same patient. Mix patient-specific questions (max 1-2), case-based scenarios, general concept questions, mechanism/pathophysiology questions, diagnostic questions, and management questions. Do NOT repeat the same patient demographics or start every question with patient information. STRICTLY PROHIBITED: NEVER create questions about document metadata, author names, publication dates, journal names, file names, or any bibliographic/non-medical information. Only focus on medical concepts, pathophysiology, diagnosis, and treatment."},
+                        {"role": "user", "content": system_prompt}
+                    ],
+                    temperature=0.3,  # Slightly higher for faster generation while maintaining quality
+                    max_tokens=4000,  # Increased to ensure complete questions with full options are generated
+                    timeout=120  # Increased timeout for better quality generation
+                )
+            except Exception as e:
+                llm_logger.error("OpenAI API error: %s", e)
+                # Fallback: try with even more optimized settings
+                response = await llm_gateway.chat_completion(
+                    model="gpt-4.1",
+                    messages=[
+                        {"role": "system", "content": f"Generate single-best-answer medical MCQs with 5 options (A-E) in JSON format. ALL questions must have difficulty: {request.difficulty or 'Moderate'}. Questions must test high-yield clinical concepts with plausible distractors. CRITICAL DIVERSITY: Create VARIED question types - NOT all about the same patient. Mix patient-specific, case-based, general concept, mechanism, diagnostic, and management questions. Do NOT repeat demographics or start every question with patient information. STRICTLY PROHIBITED: NEVER create questions about document metadata, author names, publication dates, journal names, file names, or any bibliographic/non-medical information. Only focus on medical concepts, pathophysiology, diagnosis, and treatment."},
+                        {"role": "user", "content": f"""Create {request.num_questions} case-based medical MCQs with 5 options each from the following MEDICAL CONTENT ONLY (ignore any metadata, author names, publication info, or bibliographic details):
 
-{document_context[:800]}
+{document_context}
 
 CRITICAL REQUIREMENTS:
 - ALL questions must be {request.difficulty or 'Moderate'} difficulty
@@ -3327,331 +5759,341 @@ CRITICAL REQUIREMENTS:
 - If you see any metadata in the content above, IGNORE IT COMPLETELY
 
 Return valid JSON array with exactly 5 options per question."""}
-                ],
-                temperature=0.3,  # Slightly higher for faster generation
-                max_tokens=3500,  # Increased for fallback generation
-                timeout=90  # Increased timeout for fallback generation
-            )
+                    ],
+                    temperature=0.3,  # Slightly higher for faster generation
+                    max_tokens=3500,  # Increased for fallback generation
+                    timeout=90  # Increased timeout for fallback generation
+                )
         
-        # Parse the response
-        import json
-        print(f"AI Raw MCQ OpenAI response: {response.choices[0].message.content}")
+            # Parse the response
+            import json
+            llm_logger.debug("AI Raw MCQ OpenAI response: %s", response.choices[0].message.content)
         
-        try:
-            # Try to extract JSON from the response if it's wrapped in markdown
-            response_text = response.choices[0].message.content.strip()
+            try:
+                # Try to extract JSON from the response if it's wrapped in markdown
+                response_text = response.choices[0].message.content.strip()
             
-            # Remove markdown code blocks
-            if response_text.startswith('```json'):
-                response_text = response_text.replace('```json', '').replace('```', '').strip()
-            elif response_text.startswith('```'):
-                response_text = response_text.replace('```', '').strip()
+                # Remove markdown code blocks
+                if response_text.startswith('```json'):
+                    response_text = response_text.replace('```json', '').replace('```', '').strip()
+                elif response_text.startswith('```'):
+                    response_text = response_text.replace('```', '').strip()
             
-            # Try to find JSON array boundaries if there's extra text
-            start_idx = response_text.find('[')
-            end_idx = response_text.rfind(']') + 1
+                # Try to find JSON array boundaries if there's extra text
+                start_idx = response_text.find('[')
+                end_idx = response_text.rfind(']') + 1
             
-            if start_idx != -1 and end_idx > start_idx:
-                json_text = response_text[start_idx:end_idx]
-                mcqs_data = json.loads(json_text)
-            else:
-                # Try parsing the whole text
-                mcqs_data = json.loads(response_text)
+                if start_idx != -1 and end_idx > start_idx:
+                    json_text = response_text[start_idx:end_idx]
+                    mcqs_data = json.loads(json_text)
+                else:
+                    # Try parsing the whole text
+                    mcqs_data = json.loads(response_text)
             
-            # Validate that we got actual questions, not placeholders
-            if not isinstance(mcqs_data, list) or len(mcqs_data) == 0:
-                raise ValueError("No valid questions in response")
+                # Validate that we got actual questions, not placeholders
+                if not isinstance(mcqs_data, list) or len(mcqs_data) == 0:
+                    raise ValueError("No valid questions in response")
             
-            # Check for placeholder questions and validate structure
-            for i, mcq in enumerate(mcqs_data):
-                if not isinstance(mcq, dict):
-                    raise ValueError(f"Question {i+1} is not a dictionary: {type(mcq)}")
+                # Check for placeholder questions and validate structure
+                for i, mcq in enumerate(mcqs_data):
+                    if not isinstance(mcq, dict):
+                        raise ValueError(f"Question {i+1} is not a dictionary: {type(mcq)}")
                 
-                if not mcq.get("question") or "Case-based question" in mcq.get("question", "") or "based on document content" in mcq.get("question", "").lower():
-                    raise ValueError("Placeholder questions detected in response")
+                    if not mcq.get("question") or "Case-based question" in mcq.get("question", "") or "based on document content" in mcq.get("question", "").lower():
+                        raise ValueError("Placeholder questions detected in response")
                 
-                # Validate options structure
-                if "options" not in mcq:
-                    raise ValueError(f"Question {i+1} missing 'options' field")
+                    # Validate options structure
+                    if "options" not in mcq:
+                        raise ValueError(f"Question {i+1} missing 'options' field")
                 
-                if not isinstance(mcq["options"], list):
-                    raise ValueError(f"Question {i+1} has invalid options type: {type(mcq['options'])}")
+                    if not isinstance(mcq["options"], list):
+                        raise ValueError(f"Question {i+1} has invalid options type: {type(mcq['options'])}")
                 
-                if len(mcq["options"]) == 0:
-                    raise ValueError(f"Question {i+1} has no options")
+                    if len(mcq["options"]) == 0:
+                        raise ValueError(f"Question {i+1} has no options")
                 
-                # Log first question structure for debugging
-                if i == 0:
-                    print(f"DEBUG: First question structure: id={mcq.get('id')}, question={mcq.get('question')[:50]}..., options_count={len(mcq.get('options', []))}")
-                    if mcq.get("options"):
-                        print(f"DEBUG: First option type: {type(mcq['options'][0])}")
-                        print(f"DEBUG: First option value: {mcq['options'][0]}")
-                        print(f"DEBUG: All options types: {[type(opt) for opt in mcq['options']]}")
-                        print(f"DEBUG: All options: {mcq['options']}")
+                    # Log first question structure for debugging
+                    if i == 0:
+                        llm_logger.debug("DEBUG: First question structure: id=%s, question=%s..., options_count=%s", mcq.get('id'), mcq.get('question')[:50], len(mcq.get('options', [])))
+                        if mcq.get("options"):
+                            llm_logger.debug("DEBUG: First option type: %s", type(mcq['options'][0]))
+                            llm_logger.debug("DEBUG: First option value: %s", mcq['options'][0])
+                            llm_logger.debug("DEBUG: All options types: %s", [type(opt) for opt in mcq['options']])
+                            llm_logger.debug("DEBUG: All options: %s", mcq['options'])
             
-            print(f"SUCCESS: Successfully parsed MCQ JSON: {len(mcqs_data)} questions")
-        except (json.JSONDecodeError, ValueError) as e:
-            print(f"ERROR: MCQ JSON parsing/validation failed: {e}")
-            print(f"Response text: {response.choices[0].message.content[:1000]}...")
-            # Instead of creating placeholder questions, raise an error to trigger retry
-            raise HTTPException(
-                status_code=500, 
-                detail=f"Failed to generate valid MCQs. The AI response could not be parsed or contained placeholder content. Please try again. Error: {str(e)}"
-            )
+                llm_logger.info("SUCCESS: Successfully parsed MCQ JSON: %s questions", len(mcqs_data))
+            except (json.JSONDecodeError, ValueError) as e:
+                llm_logger.error("ERROR: MCQ JSON parsing/validation failed: %s", e)
+                llm_logger.debug("Response text: %s...", response.choices[0].message.content[:1000])
+                # Instead of creating placeholder questions, raise an error to trigger retry
+                raise HTTPException(
+                    status_code=500, 
+                    detail=f"Failed to generate valid MCQs. The AI response could not be parsed or contained placeholder content. Please try again. Error: {str(e)}"
+                )
         
-        # Validate questions don't contain metadata/non-medical content
-        metadata_keywords = [
-            "author", "publication", "journal", "published", "copyright", 
-            "publisher", "doi", "isbn", "issn", "reference", "citation",
-            "bibliography", "abstract", "acknowledgment", "affiliation",
-            "institution", "university", "department", "page", "chapter",
-            "section header", "document id", "file name", "metadata"
-        ]
+            # Validate questions don't contain metadata/non-medical content
+            metadata_keywords = [
+                "author", "publication", "journal", "published", "copyright", 
+                "publisher", "doi", "isbn", "issn", "reference", "citation",
+                "bibliography", "abstract", "acknowledgment", "affiliation",
+                "institution", "university", "department", "page", "chapter",
+                "section header", "document id", "file name", "metadata"
+            ]
         
-        def contains_metadata(text):
-            """Check if text contains metadata-related keywords in a medical context."""
-            if not text:
-                return False
-            text_lower = text.lower()
+            def contains_metadata(text):
+                """Check if text contains metadata-related keywords in a medical context."""
+                if not text:
+                    return False
+                text_lower = text.lower()
             
-            # Context-aware detection - check for metadata patterns, not just keywords
-            # Patterns that indicate metadata (not medical terms)
-            metadata_patterns = [
-                r'\bauthor[s]?\s*[:=]\s*\w+',  # "Author: John Smith"
-                r'\bpublication\s*[:=]',        # "Publication:"
-                r'\bjournal\s*[:=]\s*\w+',     # "Journal: Nature"
-                r'\bpublished\s+in\s+\d{4}',   # "Published in 2024"
-                r'\bcopyright\s+\d{4}',        # "Copyright 2024"
-                r'\bdoi\s*[:=]\s*10\.',        # "DOI: 10.1234/..."
-                r'\bisbn\s*[:=]',              # "ISBN:"
-                r'\bissn\s*[:=]',              # "ISSN:"
-                r'\breference[s]?\s*[:=]\s*\d+', # "Reference: 1" or "References:"
-                r'\bcitation[s]?\s*[:=]',      # "Citation:"
-                r'\bbibliography\s*[:=]',      # "Bibliography:"
-                r'\backnowledgment[s]?\s*[:=]', # "Acknowledgment:"
-                r'\baffiliation[s]?\s*[:=]',   # "Affiliation:"
-                r'\binstitution\s*[:=]\s*\w+', # "Institution: Harvard"
-                r'\bpage\s+\d+\s+of\s+\d+',    # "Page 5 of 10"
-                r'\bchapter\s+\d+\s*[:=]',     # "Chapter 3:"
-                r'\bcorresponding\s+author',   # "Corresponding author"
-            ]
+                # Context-aware detection - check for metadata patterns, not just keywords
+                # Patterns that indicate metadata (not medical terms)
+                metadata_patterns = [
+                    r'\bauthor[s]?\s*[:=]\s*\w+',  # "Author: John Smith"
+                    r'\bpublication\s*[:=]',        # "Publication:"
+                    r'\bjournal\s*[:=]\s*\w+',     # "Journal: Nature"
+                    r'\bpublished\s+in\s+\d{4}',   # "Published in 2024"
+                    r'\bcopyright\s+\d{4}',        # "Copyright 2024"
+                    r'\bdoi\s*[:=]\s*10\.',        # "DOI: 10.1234/..."
+                    r'\bisbn\s*[:=]',              # "ISBN:"
+                    r'\bissn\s*[:=]',              # "ISSN:"
+                    r'\breference[s]?\s*[:=]\s*\d+', # "Reference: 1" or "References:"
+                    r'\bcitation[s]?\s*[:=]',      # "Citation:"
+                    r'\bbibliography\s*[:=]',      # "Bibliography:"
+                    r'\backnowledgment[s]?\s*[:=]', # "Acknowledgment:"
+                    r'\baffiliation[s]?\s*[:=]',   # "Affiliation:"
+                    r'\binstitution\s*[:=]\s*\w+', # "Institution: Harvard"
+                    r'\bpage\s+\d+\s+of\s+\d+',    # "Page 5 of 10"
+                    r'\bchapter\s+\d+\s*[:=]',     # "Chapter 3:"
+                    r'\bcorresponding\s+author',   # "Corresponding author"
+                ]
             
-            import re
-            for pattern in metadata_patterns:
-                if re.search(pattern, text_lower):
-                    return True
+                import re
+                for pattern in metadata_patterns:
+                    if re.search(pattern, text_lower):
+                        return True
             
-            # Check for question/option that's clearly about metadata (not medical)
-            # Only flag if it's asking about metadata explicitly
-            if re.search(r'(what|which|who)\s+(is|was|are)\s+(the\s+)?(author|publication|journal|publisher)', text_lower):
-                return True
-            if re.search(r'(author|publication|journal|publisher)\s+(name|date|year|title)', text_lower):
-                return True
+                # Check for question/option that's clearly about metadata (not medical)
+                # Only flag if it's asking about metadata explicitly
+                if re.search(r'(what|which|who)\s+(is|was|are)\s+(the\s+)?(author|publication|journal|publisher)', text_lower):
+                    return True
+                if re.search(r'(author|publication|journal|publisher)\s+(name|date|year|title)', text_lower):
+                    return True
             
-            return False
+                return False
         
-        # Convert to MCQQuestion objects
-        questions = []
-        for mcq_data in mcqs_data[:request.num_questions]:
-            try:
-                # Check if question contains metadata
-                question_text = mcq_data.get("question", "")
-                if contains_metadata(question_text):
-                    print(f"WARNING: Question {mcq_data.get('id', 'unknown')} contains metadata keywords: {question_text[:100]}")
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Failed to generate MCQs: Question contains document metadata. Please try again."
-                    )
-                
-                # Validate and normalize options
-                if "options" not in mcq_data or not isinstance(mcq_data["options"], list):
-                    print(f"ERROR: Invalid options format in MCQ {mcq_data.get('id', 'unknown')}")
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Failed to generate MCQs: Invalid question format received. Please try again."
-                    )
-                
-                options = []
-                for opt_idx, opt in enumerate(mcq_data["options"]):
-                    # Ensure option is a dictionary, not a string
-                    if isinstance(opt, str):
-                        print(f"ERROR: Option {opt_idx} is a string instead of dict: {opt[:100]}")
-                        print(f"ERROR: Full options array: {mcq_data['options']}")
+            # Convert to MCQQuestion objects
+            questions = []
+            for mcq_data in mcqs_data[:request.num_questions]:
+                try:
+                    # Check if question contains metadata
+                    question_text = mcq_data.get("question", "")
+                    if contains_metadata(question_text):
+                        llm_logger.warning("WARNING: Question %s contains metadata keywords: %s", mcq_data.get('id', 'unknown'), question_text[:100])
                         raise HTTPException(
                             status_code=500,
-                            detail=f"Failed to generate MCQs: Invalid option format (option is a string). Please try again."
+                            detail=f"Failed to generate MCQs: Question contains document metadata. Please try again."
                         )
-                    
-                    if not isinstance(opt, dict):
-                        print(f"ERROR: Option {opt_idx} is not a dict: type={type(opt)}, value={opt}")
-                        print(f"ERROR: Full options array: {mcq_data['options']}")
+                
+                    # Validate and normalize options
+                    if "options" not in mcq_data or not isinstance(mcq_data["options"], list):
+                        llm_logger.error("ERROR: Invalid options format in MCQ %s", mcq_data.get('id', 'unknown'))
                         raise HTTPException(
                             status_code=500,
-                            detail=f"Failed to generate MCQs: Invalid option format (expected dictionary). Please try again."
+                            detail=f"Failed to generate MCQs: Invalid question format received. Please try again."
                         )
+                
+                    options = []
+                    for opt_idx, opt in enumerate(mcq_data["options"]):
+                        # Ensure option is a dictionary, not a string
+                        if isinstance(opt, str):
+                            llm_logger.error("ERROR: Option %s is a string instead of dict: %s", opt_idx, opt[:100])
+                            llm_logger.error("ERROR: Full options array: %s", mcq_data['options'])
+                            raise HTTPException(
+                                status_code=500,
+                                detail=f"Failed to generate MCQs: Invalid option format (option is a string). Please try again."
+                            )
                     
-                    # Try to normalize option format - handle variations
-                    normalized_opt = {}
+                        if not isinstance(opt, dict):
+                            llm_logger.error("ERROR: Option %s is not a dict: type=%s, value=%s", opt_idx, type(opt), opt)
+                            llm_logger.error("ERROR: Full options array: %s", mcq_data['options'])
+                            raise HTTPException(
+                                status_code=500,
+                                detail=f"Failed to generate MCQs: Invalid option format (expected dictionary). Please try again."
+                            )
                     
-                    # Handle different field names
-                    if "id" in opt:
-                        normalized_opt["id"] = str(opt["id"])
-                    elif "option_id" in opt:
-                        normalized_opt["id"] = str(opt["option_id"])
-                    elif "letter" in opt:
-                        normalized_opt["id"] = str(opt["letter"])
-                    else:
-                        # Try to infer from position
-                        normalized_opt["id"] = ["A", "B", "C", "D", "E"][opt_idx] if opt_idx < 5 else str(opt_idx)
+                        # Try to normalize option format - handle variations
+                        normalized_opt = {}
                     
-                    if "text" in opt:
-                        normalized_opt["text"] = str(opt["text"])
-                    elif "option_text" in opt:
-                        normalized_opt["text"] = str(opt["option_text"])
-                    elif "content" in opt:
-                        normalized_opt["text"] = str(opt["content"])
-                    else:
-                        print(f"ERROR: Option {opt_idx} missing text field. Available keys: {list(opt.keys())}")
-                        print(f"ERROR: Option value: {opt}")
-                        raise HTTPException(
-                            status_code=500,
-                            detail=f"Failed to generate MCQs: Option missing text content. Please try again."
-                        )
+                        # Handle different field names
+                        if "id" in opt:
+                            normalized_opt["id"] = str(opt["id"])
+                        elif "option_id" in opt:
+                            normalized_opt["id"] = str(opt["option_id"])
+                        elif "letter" in opt:
+                            normalized_opt["id"] = str(opt["letter"])
+                        else:
+                            # Try to infer from position
+                            normalized_opt["id"] = ["A", "B", "C", "D", "E"][opt_idx] if opt_idx < 5 else str(opt_idx)
                     
-                    # Check if option text contains metadata
-                    if contains_metadata(normalized_opt["text"]):
-                        print(f"WARNING: Option {opt_idx} in question {mcq_data.get('id', 'unknown')} contains metadata: {normalized_opt['text'][:100]}")
-                        raise HTTPException(
-                            status_code=500,
-                            detail=f"Failed to generate MCQs: Option contains document metadata. Please try again."
-                        )
+                        if "text" in opt:
+                            normalized_opt["text"] = str(opt["text"])
+                        elif "option_text" in opt:
+                            normalized_opt["text"] = str(opt["option_text"])
+                        elif "content" in opt:
+                            normalized_opt["text"] = str(opt["content"])
+                        else:
+                            llm_logger.error("ERROR: Option %s missing text field. Available keys: %s", opt_idx, list(opt.keys()))
+                            llm_logger.error("ERROR: Option value: %s", opt)
+                            raise HTTPException(
+                                status_code=500,
+                                detail=f"Failed to generate MCQs: Option missing text content. Please try again."
+                            )
                     
-                    if "is_correct" in opt:
-                        normalized_opt["is_correct"] = bool(opt["is_correct"])
-                    elif "correct" in opt:
-                        normalized_opt["is_correct"] = bool(opt["correct"])
-                    elif "isCorrect" in opt:
-                        normalized_opt["is_correct"] = bool(opt["isCorrect"])
-                    else:
-                        # Default to false if not specified
-                        normalized_opt["is_correct"] = False
-                        print(f"WARNING: Option {opt_idx} missing is_correct field, defaulting to False")
+                        # Check if option text contains metadata
+                        if contains_metadata(normalized_opt["text"]):
+                            llm_logger.warning("WARNING: Option %s in question %s contains metadata: %s", opt_idx, mcq_data.get('id', 'unknown'), normalized_opt['text'][:100])
+                            raise HTTPException(
+                                status_code=500,
+                                detail=f"Failed to generate MCQs: Option contains document metadata. Please try again."
+                            )
                     
-                    try:
-                        options.append(MCQOption(**normalized_opt))
-                    except Exception as e:
-                        print(f"ERROR: Failed to create MCQOption from: {opt}")
-                        print(f"ERROR: Normalized to: {normalized_opt}")
-                        print(f"ERROR: Exception: {e}")
-                        raise HTTPException(
-                            status_code=500,
-                            detail=f"Failed to generate MCQs: Error processing question options. Please try again."
-                        )
+                        if "is_correct" in opt:
+                            normalized_opt["is_correct"] = bool(opt["is_correct"])
+                        elif "correct" in opt:
+                            normalized_opt["is_correct"] = bool(opt["correct"])
+                        elif "isCorrect" in opt:
+                            normalized_opt["is_correct"] = bool(opt["isCorrect"])
+                        else:
+                            # Default to false if not specified
+                            normalized_opt["is_correct"] = False
+                            llm_logger.warning("WARNING: Option %s missing is_correct field, defaulting to False", opt_idx)
+                    
+                        try:
+                            options.append(MCQOption(**normalized_opt))
+                        except Exception as e:
+                            llm_logger.error("ERROR: Failed to create MCQOption from: %s", opt)
+                            llm_logger.error("ERROR: Normalized to: %s", normalized_opt)
+                            llm_logger.error("ERROR: Exception: %s", e)
+                            raise HTTPException(
+                                status_code=500,
+                                detail=f"Failed to generate MCQs: Error processing question options. Please try again."
+                            )
                 
-                # BULLETPROOF: Completely ignore AI's difficulty and force case difficulty
-                if request.difficulty:
-                    # Normalize difficulty to ensure proper capitalization (Easy, Moderate, Hard)
-                    difficulty_lower = request.difficulty.lower().strip()
-                    if difficulty_lower == "easy":
-                        question_difficulty = "Easy"
-                    elif difficulty_lower == "moderate":
-                        question_difficulty = "Moderate"
-                    elif difficulty_lower == "hard":
-                        question_difficulty = "Hard"
-                    else:
-                        # If invalid, default to Moderate
-                        question_difficulty = "Moderate"
-                        print(f"⚠️ Invalid difficulty '{request.difficulty}', defaulting to 'Moderate'")
+                    # BULLETPROOF: Completely ignore AI's difficulty and force case difficulty
+                    if request.difficulty:
+                        # Normalize difficulty to ensure proper capitalization (Easy, Moderate, Hard)
+                        difficulty_lower = request.difficulty.lower().strip()
+                        if difficulty_lower == "easy":
+                            question_difficulty = "Easy"
+                        elif difficulty_lower == "moderate":
+                            question_difficulty = "Moderate"
+                        elif difficulty_lower == "hard":
+                            question_difficulty = "Hard"
+                        else:
+                            # If invalid, default to Moderate
+                            question_difficulty = "Moderate"
+                            llm_logger.warning("⚠️ Invalid difficulty '%s', defaulting to 'Moderate'", request.difficulty)
                     
-                    # Always use the normalized case difficulty, completely ignore what AI returned
-                    print(f"🔒 Forcing difficulty to case difficulty: '{question_difficulty}' (ignoring AI's '{mcq_data.get('difficulty', 'unknown')}')")
-                else:
-                    question_difficulty = mcq_data.get("difficulty", "Moderate")
-                    # Normalize AI's difficulty too
-                    difficulty_lower = question_difficulty.lower().strip()
-                    if difficulty_lower == "easy":
-                        question_difficulty = "Easy"
-                    elif difficulty_lower == "moderate":
-                        question_difficulty = "Moderate"
-                    elif difficulty_lower == "hard":
-                        question_difficulty = "Hard"
+                        # Always use the normalized case difficulty, completely ignore what AI returned
+                        llm_logger.info("🔒 Forcing difficulty to case difficulty: '%s' (ignoring AI's '%s')", question_difficulty, mcq_data.get('difficulty', 'unknown'))
                     else:
-                        question_difficulty = "Moderate"
+                        question_difficulty = mcq_data.get("difficulty", "Moderate")
+                        # Normalize AI's difficulty too
+                        difficulty_lower = question_difficulty.lower().strip()
+                        if difficulty_lower == "easy":
+                            question_difficulty = "Easy"
+                        elif difficulty_lower == "moderate":
+                            question_difficulty = "Moderate"
+                        elif difficulty_lower == "hard":
+                            question_difficulty = "Hard"
+                        else:
+                            question_difficulty = "Moderate"
                 
-                question = MCQQuestion(
-                    id=mcq_data["id"],
-                    question=mcq_data["question"],
-                    options=options,
-                    explanation=mcq_data["explanation"],
-                    difficulty=question_difficulty  # This will ALWAYS be the case difficulty
-                )
-                questions.append(question)
-            except HTTPException:
-                # Re-raise HTTPExceptions as-is
-                raise
-            except Exception as e:
-                # Catch any other unexpected errors
-                print(f"ERROR: Unexpected error processing MCQ {mcq_data.get('id', 'unknown')}: {e}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to generate MCQs: Error processing question. Please try again."
-                )
+                    question = MCQQuestion(
+                        id=mcq_data["id"],
+                        question=mcq_data["question"],
+                        options=options,
+                        explanation=mcq_data["explanation"],
+                        difficulty=question_difficulty  # This will ALWAYS be the case difficulty
+                    )
+                    questions.append(question)
+                except HTTPException:
+                    # Re-raise HTTPExceptions as-is
+                    raise
+                except Exception as e:
+                    # Catch any other unexpected errors
+                    llm_logger.error("ERROR: Unexpected error processing MCQ %s: %s", mcq_data.get('id', 'unknown'), e)
+                    raise HTTPException(
+                        status_code=500,
+                        detail=f"Failed to generate MCQs: Error processing question. Please try again."
+                    )
         
-        # Final validation: Ensure ALL questions have the same difficulty
-        if request.difficulty:
-            # Normalize the expected difficulty
-            difficulty_lower = request.difficulty.lower().strip()
-            if difficulty_lower == "easy":
-                expected_difficulty = "Easy"
-            elif difficulty_lower == "moderate":
-                expected_difficulty = "Moderate"
-            elif difficulty_lower == "hard":
-                expected_difficulty = "Hard"
-            else:
-                expected_difficulty = "Moderate"
+            # Final validation: Ensure ALL questions have the same difficulty
+            if request.difficulty:
+                # Normalize the expected difficulty
+                difficulty_lower = request.difficulty.lower().strip()
+                if difficulty_lower == "easy":
+                    expected_difficulty = "Easy"
+                elif difficulty_lower == "moderate":
+                    expected_difficulty = "Moderate"
+                elif difficulty_lower == "hard":
+                    expected_difficulty = "Hard"
+                else:
+                    expected_difficulty = "Moderate"
             
-            for i, question in enumerate(questions):
-                if question.difficulty != expected_difficulty:
-                    print(f"🚨 CRITICAL: Question {i} has wrong difficulty '{question.difficulty}', forcing to '{expected_difficulty}'")
-                    question.difficulty = expected_difficulty
-        
-        # Log the final difficulties for debugging
-        difficulties = [q.difficulty for q in questions]
-        unique_difficulties = set(difficulties)
-        print(f"✅ Final MCQ difficulties: {difficulties}")
-        print(f"✅ Unique difficulties: {unique_difficulties}")
-        
-        if len(unique_difficulties) > 1:
-            print(f"🚨 ERROR: Still have mixed difficulties: {unique_difficulties}")
-        else:
-            print(f"✅ SUCCESS: All questions have consistent difficulty: {list(unique_difficulties)[0]}")
+                for i, question in enumerate(questions):
+                    if question.difficulty != expected_difficulty:
+                        llm_logger.error("🚨 CRITICAL: Question %s has wrong difficulty '%s', forcing to '%s'", i, question.difficulty, expected_difficulty)
+                        question.difficulty = expected_difficulty
+        
+            # Log the final difficulties for debugging
+            difficulties = [q.difficulty for q in questions]
+            unique_difficulties = set(difficulties)
+            llm_logger.info("✅ Final MCQ difficulties: %s", difficulties)
+            llm_logger.info("✅ Unique difficulties: %s", unique_difficulties)
+        
+            if len(unique_difficulties) > 1:
+                llm_logger.error("🚨 ERROR: Still have mixed difficulties: %s", unique_difficulties)
+            else:
+                llm_logger.info("✅ SUCCESS: All questions have consistent difficulty: %s", list(unique_difficulties)[0])
         
-        return MCQResponse(
-            questions=questions,
-            generated_at=datetime.utcnow()
-        )
+            await llm_response_cache.set(cache_key, {"questions": jsonable_encoder(questions)}, "mcqs")
         
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating MCQs: {str(e)}")
+            return MCQResponse(
+                questions=questions,
+                generated_at=datetime.utcnow()
+            )
+        
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error generating MCQs: {str(e)}")
+    
+    # Identical requests arriving while this one runs share its result
+    return await generation_flights.run(cache_key, "mcqs", run_generation)
 
 @app.post("/ai/identify-concepts", response_model=ConceptResponse)
 async def identify_concepts(
     request: ConceptRequest,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    mode: GenerationMode = "sync",
+    cache: CacheMode = "use"
 ):
-    """Identify key medical concepts from a document using OpenAI GPT-4 mini"""
+    """Identify key medical concepts from a document using OpenAI GPT-4 mini
+
+    Pass cache=bypass to force a fresh generation (the result still refreshes the cache).
+    """
     
-    print(f"🔵🔵🔵 identify_concepts endpoint called - document_id: {request.document_id}, case_title: '{request.case_title}', num_concepts: {request.num_concepts}")
+    llm_logger.info("🔵🔵🔵 identify_concepts endpoint called - document_id: %s, case_title: '%s', num_concepts: %s", request.document_id, request.case_title, request.num_concepts)
     
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     
+    if mode == "job":
+        return await submit_generation_job("identify_concepts", request, current_user, {"cache": cache})
+    
     # Find the document
     try:
-        document = db.documents.find_one({
-            "_id": ObjectId(request.document_id),
-            "uploaded_by": current_user["id"]
-        })
+        document = await document_repository.get_for_user(request.document_id, current_user["id"])
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid document ID")
     
@@ -3659,15 +6101,16 @@ async def identify_concepts(
         raise HTTPException(status_code=404, detail="Document not found or access denied")
     
     # Check if document has text content
-    if not document.get("content"):
+    if not document.get("text_length"):
         raise HTTPException(status_code=400, detail="Document does not contain readable text content")
     
     # Fetch case details if case_title is provided
     case_details = None
+    case_doc = None
     case_demographics = ""
     case_difficulty = None
     
-    print(f"🔍 Concept generation - case_title: '{request.case_title}'")
+    llm_logger.debug("🔍 Concept generation - case_title: '%s'", request.case_title)
     
     if request.case_title:
         import re
@@ -3684,17 +6127,8 @@ async def identify_concepts(
         # Try to find the case in generated_cases collection for full description
         case_doc = None
         try:
-            doc_id_str = str(document["_id"])
-            # Try multiple query formats
-            case_doc = db.generated_cases.find_one({
-                "title": request.case_title,
-                "document_id": doc_id_str
-            })
-            if not case_doc:
-                # Try without document_id constraint (in case format differs)
-                case_doc = db.generated_cases.find_one({
-                    "title": request.case_title
-                })
+            # Falls back to matching the title alone (in case the document_id format differs)
+            case_doc = await generated_case_repository.find_by_title(request.case_title, str(document["_id"]))
             
             if case_doc:
                 case_details = case_doc
@@ -3709,12 +6143,12 @@ async def identify_concepts(
                     gender_match = re.search(r'\b(girl|boy|female|male|woman|man|child)\b', case_description, re.IGNORECASE)
                     gender = gender_match.group(1).lower() if gender_match else None
         except Exception as e:
-            print(f"⚠️ Warning: Could not fetch case details from database: {e}")
+            llm_logger.warning("⚠️ Warning: Could not fetch case details from database: %s", e)
             # Continue with title-based extraction
         
-        print(f"🔍 Case details - case_difficulty: '{case_difficulty}' (type: {type(case_difficulty)})")
+        llm_logger.debug("🔍 Case details - case_difficulty: '%s' (type: %s)", case_difficulty, type(case_difficulty))
         if not case_difficulty:
-            print(f"⚠️ WARNING: case_difficulty is None/empty - will use normal validation (first case is now Moderate)")
+            llm_logger.warning("⚠️ WARNING: case_difficulty is None/empty - will use normal validation (first case is now Moderate)")
         
         # Build demographics string
         if age and gender:
@@ -3734,26 +6168,42 @@ async def identify_concepts(
             # Last resort: use the case title itself
             case_demographics = f"\n\nCRITICAL CASE CONTEXT:\n- Case Title: {request.case_title}\n- ALL generated content MUST be consistent with this specific case scenario\n- Extract and maintain consistency with patient demographics from the case title"
     
-    try:
-        # Use OpenAI GPT-4 mini
-        if not openai_client:
-            raise Exception("OpenAI client not initialized")
-        
-        # Retry logic for concept generation - force real generation, no fallbacks
-        max_retries = 5  # Increased retries to force real generation
-        retry_count = 0
-        concepts_data = None
-        last_error = None
+    cache_key = llm_response_cache.make_key(
+        "concepts",
+        "gpt-4.1",
+        {
+            "case_title": normalize_cache_text(request.case_title),
+            "num_concepts": request.num_concepts,
+            "case_context": case_demographics,
+            "case": {
+                "difficulty": case_doc.get("difficulty"),
+                "description": case_doc.get("description"),
+                "key_points": case_doc.get("key_points")
+            } if case_doc else None
+        },
+        document_content_hash(document)
+    )
+    cached = await llm_response_cache.get(cache_key, "concepts", bypass=cache == "bypass")
+    if cached is not None:
+        return ConceptResponse(document_id=request.document_id, concepts=cached["concepts"], generated_at=datetime.utcnow())
+    
+    async def run_generation():
+        """Generate, validate and cache the concept for this request"""
+        try:
+            # Use OpenAI GPT-4 mini
+            if not llm_gateway:
+                raise Exception("OpenAI client not initialized")
         
-        while retry_count <= max_retries:
-            try:
+            # Retry logic for concept generation - force real generation, no fallbacks
+            async def generate_concepts_attempt():
+                """Run one generation attempt; raising ValueError marks the output as unusable"""
                 # Build case JSON for the prompt
                 import json
                 case_json_data = {}
                 case_id_str = ""
                 case_title_str = request.case_title or "Medical Case"
                 case_difficulty_str = case_difficulty or "Moderate"
-                
+            
                 if case_doc:
                     case_id_str = str(case_doc.get("_id", ""))
                     case_title_str = case_doc.get("title", request.case_title or "Medical Case")
@@ -3773,7 +6223,7 @@ async def identify_concepts(
                         "description": "",
                         "key_points": []
                     }
-                
+            
                 # Add demographics if available
                 if age and gender:
                     gender_normalized = gender
@@ -3783,21 +6233,21 @@ async def identify_concepts(
                         gender_normalized = 'male'
                     case_json_data["age"] = age
                     case_json_data["gender"] = gender_normalized
-                
+            
                 case_json = json.dumps(case_json_data, indent=2)
-                
+            
                 # Extract key_concept from case if available
                 key_concept = ""
                 if case_doc and case_doc.get("key_points") and len(case_doc.get("key_points", [])) > 0:
                     key_concept = case_doc.get("key_points", [""])[0]
-                
+            
                 # Include case description in prompt if available for better context
                 case_description_text = ""
                 if case_doc and case_doc.get("description"):
                     case_description_text = f"\n\nCASE DESCRIPTION:\n{case_doc.get('description')}\n"
                 elif case_description:
                     case_description_text = f"\n\nCASE DESCRIPTION:\n{case_description}\n"
-                
+            
                 # New structured prompt for key concepts
                 identify_concepts_prompt = f"""
 You are an expert medical educator. Based on the SINGLE, SPECIFIC clinical case provided below, generate a structured breakdown of the essential high‑yield concepts a medical student must master to understand THIS PARTICULAR CASE.
@@ -3871,13 +6321,14 @@ RULES:
 - CRITICAL WORD COUNT REQUIREMENT: Each section (key_concept_summary, each learning_objective, core_pathophysiology, each clinical_reasoning_step, each red_flags_and_pitfalls item, each differential_diagnosis_framework item, each important_labs_imaging_to_know item, and why_this_case_matters) MUST contain a minimum of 150 words and should aim for 150-250 words. Count the words carefully - sections with less than 150 words are NOT acceptable.
 - Give it to me like I am a university student - use accessible language while maintaining scientific accuracy.
 """
-                
+            
                 system_prompt = identify_concepts_prompt
-        
+    
                 # Generate response from OpenAI
-                print(f"🔄 Attempt {retry_count + 1} of {max_retries + 1} to generate concepts...")
-                response = openai_client.chat.completions.create(
+                llm_logger.info("🔄 Generating concepts for case: '%s'", request.case_title)
+                response = await llm_gateway.chat_completion(
                     model="gpt-4.1",
+                    retry_policy=NO_RETRY_POLICY,  # CONCEPT_RETRY_POLICY owns retries here
                     messages=[
                         {"role": "system", "content": "Medical educator. Generate key concepts for a medical case with clear sections. Return valid JSON only. CRITICAL: Each section MUST be 150-250 words minimum (no less than 150 words). Give it to me like I am a university student - write in a clear, accessible, and educational style appropriate for university-level medical education."},
                         {"role": "user", "content": system_prompt}
@@ -3887,27 +6338,27 @@ RULES:
                     timeout=240,  # Increased timeout for comprehensive detailed case generation
                     response_format={"type": "json_object"}  # Force JSON object format for better accuracy
                 )
-                
+            
                 # Parse the response
                 import json
-                print(f"AI Raw Concepts OpenAI response: {response.choices[0].message.content}")
-                
+                llm_logger.debug("AI Raw Concepts OpenAI response: %s", response.choices[0].message.content)
+            
                 # Try to extract JSON from the response if it's wrapped in markdown
-                response_text = response.choices[0].message.content.strip()
-                print(f"🔍 Raw response text (first 500 chars): {response_text[:500]}")
-                
+                response_text = (response.choices[0].message.content or "").strip()
+                llm_logger.debug("🔍 Raw response text (first 500 chars): %s", response_text[:500])
+            
                 # Remove markdown code blocks if present
                 if response_text.startswith('```json'):
                     response_text = response_text.replace('```json', '').replace('```', '').strip()
                 elif response_text.startswith('```'):
                     response_text = response_text.replace('```', '').strip()
-                
+            
                 # Try to find JSON object/array in the text
                 # Look for first { or [
                 start_idx = response_text.find('{')
                 if start_idx == -1:
                     start_idx = response_text.find('[')
-                
+            
                 if start_idx != -1:
                     # Find matching closing brace/bracket
                     brace_count = 0
@@ -3922,39 +6373,39 @@ RULES:
                             bracket_count += 1
                         elif response_text[i] == ']':
                             bracket_count -= 1
-                        
+                    
                         if brace_count == 0 and bracket_count == 0:
                             end_idx = i + 1
                             break
-                    
+                
                     if end_idx > start_idx:
                         response_text = response_text[start_idx:end_idx]
-                
-                print(f"🔍 Extracted JSON text: {response_text[:500]}")
-                
+            
+                llm_logger.debug("🔍 Extracted JSON text: %s", response_text[:500])
+            
                 try:
                     concepts_data = json.loads(response_text)
-                    print(f"✅ Successfully parsed Concepts JSON: {type(concepts_data)}")
+                    llm_logger.info("✅ Successfully parsed Concepts JSON: %s", type(concepts_data))
                 except json.JSONDecodeError as json_err:
-                    print(f"❌ JSON parsing error: {json_err}")
-                    print(f"❌ Full response text (first 1000 chars): {response_text[:1000]}")
+                    llm_logger.error("❌ JSON parsing error: %s", json_err)
+                    llm_logger.error("❌ Full response text (first 1000 chars): %s", response_text[:1000])
                     raise ValueError(f"Invalid JSON format: {str(json_err)}")
-                
+            
                 # Ensure we always return a single case as an array
                 if not isinstance(concepts_data, list):
-                    print(f"📦 Converting single object to array")
+                    llm_logger.info("📦 Converting single object to array")
                     concepts_data = [concepts_data]
-                
+            
                 # Validate that we have at least one concept
                 if not concepts_data or len(concepts_data) == 0:
-                    print(f"❌ ERROR: Empty concepts_data after parsing")
+                    llm_logger.error("❌ ERROR: Empty concepts_data after parsing")
                     raise ValueError("No concepts found in parsed JSON")
-                
+            
                 # Validate the response - common validation for all cases
                 if concepts_data and len(concepts_data) > 0:
                     first_concept = concepts_data[0]
                     description = first_concept.get("description", "")
-                    
+                
                     # Check if structured fields are present (new format or old format)
                     has_structured_fields = bool(
                         first_concept.get("objective") or 
@@ -3976,13 +6427,13 @@ RULES:
                         first_concept.get("important_labs_imaging_to_know") or
                         first_concept.get("why_this_case_matters")
                     )
-                    
+                
                     # For non-Easy/non-first cases, do normal validation
                     # If no structured fields and no description, that's a problem
                     if not has_structured_fields and not description:
-                        print(f"⚠️ WARNING: No structured fields and no description, will retry...")
+                        llm_logger.warning("⚠️ WARNING: No structured fields and no description, will retry...")
                         raise ValueError("No content found in response")
-                    
+                
                     # Check for placeholder text - only in description if it exists
                     # If structured fields are present, description might be empty (that's OK)
                     if description:  # Only check if description exists
@@ -3998,9 +6449,9 @@ RULES:
                             "Case breakdown not available"
                         ]
                         if any(indicator in description for indicator in placeholder_indicators):
-                            print(f"⚠️ WARNING: Detected placeholder text in response, will retry...")
+                            llm_logger.warning("⚠️ WARNING: Detected placeholder text in response, will retry...")
                             raise ValueError("Placeholder content detected")
-                    
+                
                     # Only check for generic descriptions if we don't have structured fields
                     # (structured fields indicate proper case breakdown format)
                     # Skip this check for Easy case to be more lenient
@@ -4011,7 +6462,7 @@ RULES:
                     # Also check if it's likely the first case (no difficulty set, or first in list)
                     # If case_difficulty is None, treat as Moderate (first case is now Moderate)
                     if not case_difficulty:
-                        print(f"⚠️ No case_difficulty found - treating as Moderate (first case is now Moderate)")
+                        llm_logger.warning("⚠️ No case_difficulty found - treating as Moderate (first case is now Moderate)")
                         is_easy_case = False  # First case is now Moderate, use normal validation
                     if not has_structured_fields and description and not is_easy_case:
                         generic_phrases = [
@@ -4038,18 +6489,18 @@ RULES:
                             "presenting complaint", "chief complaint", "physical examination"
                         ]
                         detail_count = sum(1 for indicator in case_detail_indicators if indicator in description_lower)
-                        
+                    
                         # If too many generic phrases and not enough case details, reject
                         # But be more lenient - require 3+ generic phrases AND < 2 details
                         if generic_count >= 3 and detail_count < 2:
-                            print(f"⚠️ WARNING: Description too generic ({generic_count} generic phrases, {detail_count} case details), will retry...")
+                            llm_logger.warning("⚠️ WARNING: Description too generic (%s generic phrases, %s case details), will retry...", generic_count, detail_count)
                             raise ValueError("Description is too generic and lacks specific case details")
-                    
+                
                     # Check if we have structured fields with substantial real content
                     # Support both old format (objective, patient_profile, etc.) and new format (key_concept_summary, learning_objectives, etc.)
                     content_length = 0
                     structured_fields_present = False
-                    
+                
                     # Check old format structured fields
                     old_format_fields = [
                         "objective", "patient_profile", "history_of_present_illness",
@@ -4060,7 +6511,7 @@ RULES:
                         if first_concept.get(field):
                             content_length += len(str(first_concept.get(field, "")))
                             structured_fields_present = True
-                    
+                
                     # Check new format structured fields
                     new_format_fields = [
                         "key_concept_summary", "core_pathophysiology", "why_this_case_matters"
@@ -4069,7 +6520,7 @@ RULES:
                         if first_concept.get(field):
                             content_length += len(str(first_concept.get(field, "")))
                             structured_fields_present = True
-                    
+                
                     # Check array fields in new format
                     array_fields = [
                         "learning_objectives", "clinical_reasoning_steps",
@@ -4081,201 +6532,192 @@ RULES:
                             content_length += sum(len(str(item)) for item in first_concept.get(field, []))
                             if len(first_concept.get(field, [])) > 0:
                                 structured_fields_present = True
-                    
+                
                     # Check description if no structured fields or as additional content
                     if description:
                         content_length += len(description)
-                    
+                
                     # Very lenient validation - just check we have some content
                     # For Easy cases, be even more lenient - accept if we have title or any field
                     has_title = bool(first_concept.get("title", "").strip())
-                    
+                
                     # Accept if we have any content at all - be very lenient
                     # No minimum content requirement - accept any content
                     if content_length > 0 or has_title or has_structured_fields:
-                        print(f"✅ Validated content: {content_length} characters (structured fields: {structured_fields_present}, Easy case: {is_easy_case})")
-                        print(f"✅ Final concepts_data length: {len(concepts_data)}")
-                        print(f"✅ Concept title: {first_concept.get('title', 'N/A')}")
-                        
-                        # DETAILED LOGGING: Print all concept fields for debugging
-                        print(f"\n🔍🔍🔍 DETAILED CONCEPT DATA for case_title: '{request.case_title}':")
-                        print(f"📊 Total concepts: {len(concepts_data)}")
-                        for idx, concept in enumerate(concepts_data):
-                            print(f"\n📝 Concept {idx + 1}:")
-                            print(f"   - title: {concept.get('title', 'NO TITLE')[:100]}")
-                            print(f"   - title length: {len(concept.get('title', ''))}")
-                            print(f"   - description: {concept.get('description', 'NO DESCRIPTION')[:200]}")
-                            print(f"   - description length: {len(concept.get('description', ''))}")
-                            print(f"   - objective: {concept.get('objective', 'NO OBJECTIVE')[:200]}")
-                            print(f"   - objective length: {len(concept.get('objective', ''))}")
-                            print(f"   - patient_profile: {concept.get('patient_profile', 'NO PATIENT_PROFILE')[:200]}")
-                            print(f"   - patient_profile length: {len(concept.get('patient_profile', ''))}")
-                            print(f"   - history_of_present_illness: {concept.get('history_of_present_illness', 'NO HISTORY')[:200]}")
-                            print(f"   - history length: {len(concept.get('history_of_present_illness', ''))}")
-                            print(f"   - examination: {concept.get('examination', 'NO EXAMINATION')[:200]}")
-                            print(f"   - examination length: {len(concept.get('examination', ''))}")
-                            print(f"   - final_diagnosis: {concept.get('final_diagnosis', 'NO DIAGNOSIS')[:200]}")
-                            print(f"   - diagnosis length: {len(concept.get('final_diagnosis', ''))}")
-                            print(f"   - case_title: {concept.get('case_title', 'NO CASE_TITLE')}")
-                            print(f"   - Full concept keys: {list(concept.keys())}")
-                        
-                        break  # Success, exit retry loop
+                        llm_logger.info("✅ Validated content: %s characters (structured fields: %s, Easy case: %s)", content_length, structured_fields_present, is_easy_case)
+                        llm_logger.info("✅ Final concepts_data length: %s", len(concepts_data))
+                        llm_logger.info("✅ Concept title: %s", first_concept.get('title', 'N/A'))
+                    
+                        # DETAILED LOGGING: every concept field, only built when DEBUG is enabled for casewise.llm
+                        if llm_logger.isEnabledFor(logging.DEBUG):
+                            llm_logger.debug("🔍🔍🔍 DETAILED CONCEPT DATA for case_title: '%s' (%s concepts)", request.case_title, len(concepts_data))
+                            for idx, concept in enumerate(concepts_data):
+                                fields = {
+                                    field: str(concept.get(field) or "")
+                                    for field in ("title", "description", "objective", "patient_profile",
+                                                  "history_of_present_illness", "examination", "final_diagnosis")
+                                }
+                                llm_logger.debug(
+                                    "📝 Concept %s: case_title=%s, keys=%s, lengths=%s, fields=%s",
+                                    idx + 1, concept.get('case_title', 'NO CASE_TITLE'), list(concept.keys()),
+                                    {field: len(value) for field, value in fields.items()},
+                                    {field: value[:200] for field, value in fields.items()}
+                                )
+                    
+                        return concepts_data
                     else:
-                        print(f"⚠️ WARNING: No content found (content_length: {content_length}), will retry...")
+                        llm_logger.warning("⚠️ WARNING: No content found (content_length: %s), will retry...", content_length)
                         raise ValueError("No content found in response")
-                
-            except (json.JSONDecodeError, ValueError, Exception) as e:
-                last_error = e
-                print(f"❌ ERROR on attempt {retry_count + 1}: {e}")
-                if retry_count < max_retries:
-                    retry_count += 1
-                    # Exponential backoff: 1s, 2s, 4s, 8s, 16s
-                    delay = min(2 ** retry_count, 16)
-                    print(f"🔄 Retrying concept generation... ({retry_count}/{max_retries}) after {delay}s delay")
-                    import time
-                    time.sleep(delay)
-                    continue
-                else:
-                    # All retries failed - raise error instead of using fallback
-                    print(f"❌ All {max_retries + 1} attempts failed. Last error: {last_error}")
-                    raise HTTPException(
-                        status_code=500, 
-                        detail=f"Failed to generate concepts after {max_retries + 1} attempts. Please try again. Error: {str(last_error)}"
-                    )
         
-        # Safety check - ensure concepts_data exists
-        if concepts_data is None:
-            print(f"❌ ERROR: concepts_data is None after retry loop")
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to generate concepts. No data was produced after all retries. Please try again."
-            )
+            try:
+                concepts_data = await CONCEPT_RETRY_POLICY.run(
+                    generate_concepts_attempt,
+                    description="Concept generation"
+                )
+            except RetryExhaustedError as e:
+                # All retries failed - raise error instead of using fallback
+                raise HTTPException(
+                    status_code=500, 
+                    detail=f"Failed to generate concepts after {e.attempts} attempts. Please try again. Error: {str(e.last_error)}"
+                )
         
-        # Ensure we always return a single case as an array
-        if not isinstance(concepts_data, list):
-            concepts_data = [concepts_data]
+            # Safety check - ensure concepts_data exists
+            if concepts_data is None:
+                llm_logger.error("❌ ERROR: concepts_data is None after retry loop")
+                raise HTTPException(
+                    status_code=500,
+                    detail="Failed to generate concepts. No data was produced after all retries. Please try again."
+                )
         
-        # Validate and convert to Concept objects - no fallback
-        if len(concepts_data) == 0:
-            print(f"❌ ERROR: No concepts in response after all retries")
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to generate concepts. No valid content was produced. Please try again."
-            )
+            # Ensure we always return a single case as an array
+            if not isinstance(concepts_data, list):
+                concepts_data = [concepts_data]
         
-        # Convert to Concept objects - take only the first case
-        try:
-            concept_data = concepts_data[0]
+            # Validate and convert to Concept objects - no fallback
+            if len(concepts_data) == 0:
+                llm_logger.error("❌ ERROR: No concepts in response after all retries")
+                raise HTTPException(
+                    status_code=500,
+                    detail="Failed to generate concepts. No valid content was produced. Please try again."
+                )
+        
+            # Convert to Concept objects - take only the first case
+            try:
+                concept_data = concepts_data[0]
             
-            # Ensure required fields exist with defaults
-            if not concept_data.get("title"):
-                concept_data["title"] = concept_data.get("id", "Medical Concept")
-            if not concept_data.get("importance"):
-                concept_data["importance"] = "High"
+                # Ensure required fields exist with defaults
+                if not concept_data.get("title"):
+                    concept_data["title"] = concept_data.get("id", "Medical Concept")
+                if not concept_data.get("importance"):
+                    concept_data["importance"] = "High"
             
-            # Handle different formats: new format (key_concept_summary, learning_objectives) or old format (objective, patient_profile)
-            # Priority: new format first, then old format, then fallback to description
-            if concept_data.get("key_concept_summary") or concept_data.get("learning_objectives"):
-                # New format - build description from new structured fields
-                description_parts = []
-                if concept_data.get("key_concept_summary"):
-                    description_parts.append(f"Key Concept Summary: {concept_data.get('key_concept_summary')}")
-                if concept_data.get("learning_objectives") and isinstance(concept_data.get("learning_objectives"), list):
-                    description_parts.append("\n\nLearning Objectives:")
-                    for obj in concept_data.get("learning_objectives", []):
-                        description_parts.append(f"\n- {obj}")
-                if concept_data.get("core_pathophysiology"):
-                    description_parts.append(f"\n\nCore Pathophysiology: {concept_data.get('core_pathophysiology')}")
-                if concept_data.get("clinical_reasoning_steps") and isinstance(concept_data.get("clinical_reasoning_steps"), list):
-                    description_parts.append("\n\nClinical Reasoning Steps:")
-                    for step in concept_data.get("clinical_reasoning_steps", []):
-                        description_parts.append(f"\n{step}")
-                if concept_data.get("red_flags_and_pitfalls") and isinstance(concept_data.get("red_flags_and_pitfalls"), list):
-                    description_parts.append("\n\nRed Flags and Pitfalls:")
-                    for pitfall in concept_data.get("red_flags_and_pitfalls", []):
-                        description_parts.append(f"\n- {pitfall}")
-                if concept_data.get("differential_diagnosis_framework") and isinstance(concept_data.get("differential_diagnosis_framework"), list):
-                    description_parts.append("\n\nDifferential Diagnosis Framework:")
-                    for dx in concept_data.get("differential_diagnosis_framework", []):
-                        description_parts.append(f"\n{dx}")
-                if concept_data.get("important_labs_imaging_to_know") and isinstance(concept_data.get("important_labs_imaging_to_know"), list):
-                    description_parts.append("\n\nImportant Labs/Imaging to Know:")
-                    for lab in concept_data.get("important_labs_imaging_to_know", []):
-                        description_parts.append(f"\n- {lab}")
-                if concept_data.get("why_this_case_matters"):
-                    description_parts.append(f"\n\nWhy This Case Matters: {concept_data.get('why_this_case_matters')}")
+                # Handle different formats: new format (key_concept_summary, learning_objectives) or old format (objective, patient_profile)
+                # Priority: new format first, then old format, then fallback to description
+                if concept_data.get("key_concept_summary") or concept_data.get("learning_objectives"):
+                    # New format - build description from new structured fields
+                    description_parts = []
+                    if concept_data.get("key_concept_summary"):
+                        description_parts.append(f"Key Concept Summary: {concept_data.get('key_concept_summary')}")
+                    if concept_data.get("learning_objectives") and isinstance(concept_data.get("learning_objectives"), list):
+                        description_parts.append("\n\nLearning Objectives:")
+                        for obj in concept_data.get("learning_objectives", []):
+                            description_parts.append(f"\n- {obj}")
+                    if concept_data.get("core_pathophysiology"):
+                        description_parts.append(f"\n\nCore Pathophysiology: {concept_data.get('core_pathophysiology')}")
+                    if concept_data.get("clinical_reasoning_steps") and isinstance(concept_data.get("clinical_reasoning_steps"), list):
+                        description_parts.append("\n\nClinical Reasoning Steps:")
+                        for step in concept_data.get("clinical_reasoning_steps", []):
+                            description_parts.append(f"\n{step}")
+                    if concept_data.get("red_flags_and_pitfalls") and isinstance(concept_data.get("red_flags_and_pitfalls"), list):
+                        description_parts.append("\n\nRed Flags and Pitfalls:")
+                        for pitfall in concept_data.get("red_flags_and_pitfalls", []):
+                            description_parts.append(f"\n- {pitfall}")
+                    if concept_data.get("differential_diagnosis_framework") and isinstance(concept_data.get("differential_diagnosis_framework"), list):
+                        description_parts.append("\n\nDifferential Diagnosis Framework:")
+                        for dx in concept_data.get("differential_diagnosis_framework", []):
+                            description_parts.append(f"\n{dx}")
+                    if concept_data.get("important_labs_imaging_to_know") and isinstance(concept_data.get("important_labs_imaging_to_know"), list):
+                        description_parts.append("\n\nImportant Labs/Imaging to Know:")
+                        for lab in concept_data.get("important_labs_imaging_to_know", []):
+                            description_parts.append(f"\n- {lab}")
+                    if concept_data.get("why_this_case_matters"):
+                        description_parts.append(f"\n\nWhy This Case Matters: {concept_data.get('why_this_case_matters')}")
                 
-                concept_data["description"] = "".join(description_parts)
-            elif concept_data.get("objective") or concept_data.get("patient_profile"):
-                # Old format - build description from separate fields
-                description_parts = []
-                if concept_data.get("objective"):
-                    description_parts.append(f"Objective: {concept_data.get('objective')}")
-                if concept_data.get("patient_profile") or concept_data.get("history_of_present_illness"):
-                    description_parts.append("\n\nCase Presentation:")
-                    if concept_data.get("patient_profile"):
-                        description_parts.append(f"\nPatient Profile: {concept_data.get('patient_profile')}")
-                    if concept_data.get("history_of_present_illness"):
-                        description_parts.append(f"\nHistory of Present Illness: {concept_data.get('history_of_present_illness')}")
-                    if concept_data.get("past_medical_history"):
-                        description_parts.append(f"\nPast Medical History: {concept_data.get('past_medical_history')}")
-                    if concept_data.get("medications"):
-                        description_parts.append(f"\nMedications: {concept_data.get('medications')}")
-                    if concept_data.get("examination"):
-                        description_parts.append(f"\nExamination: {concept_data.get('examination')}")
-                if concept_data.get("initial_investigations"):
-                    description_parts.append(f"\n\nInitial Investigations: {concept_data.get('initial_investigations')}")
-                if concept_data.get("case_progression"):
-                    description_parts.append(f"\n\nCase Progression/Intervention: {concept_data.get('case_progression')}")
-                if concept_data.get("final_diagnosis"):
-                    description_parts.append(f"\n\nFinal Diagnosis/Learning Anchor: {concept_data.get('final_diagnosis')}")
+                    concept_data["description"] = "".join(description_parts)
+                elif concept_data.get("objective") or concept_data.get("patient_profile"):
+                    # Old format - build description from separate fields
+                    description_parts = []
+                    if concept_data.get("objective"):
+                        description_parts.append(f"Objective: {concept_data.get('objective')}")
+                    if concept_data.get("patient_profile") or concept_data.get("history_of_present_illness"):
+                        description_parts.append("\n\nCase Presentation:")
+                        if concept_data.get("patient_profile"):
+                            description_parts.append(f"\nPatient Profile: {concept_data.get('patient_profile')}")
+                        if concept_data.get("history_of_present_illness"):
+                            description_parts.append(f"\nHistory of Present Illness: {concept_data.get('history_of_present_illness')}")
+                        if concept_data.get("past_medical_history"):
+                            description_parts.append(f"\nPast Medical History: {concept_data.get('past_medical_history')}")
+                        if concept_data.get("medications"):
+                            description_parts.append(f"\nMedications: {concept_data.get('medications')}")
+                        if concept_data.get("examination"):
+                            description_parts.append(f"\nExamination: {concept_data.get('examination')}")
+                    if concept_data.get("initial_investigations"):
+                        description_parts.append(f"\n\nInitial Investigations: {concept_data.get('initial_investigations')}")
+                    if concept_data.get("case_progression"):
+                        description_parts.append(f"\n\nCase Progression/Intervention: {concept_data.get('case_progression')}")
+                    if concept_data.get("final_diagnosis"):
+                        description_parts.append(f"\n\nFinal Diagnosis/Learning Anchor: {concept_data.get('final_diagnosis')}")
                 
-                concept_data["description"] = "".join(description_parts)
-            elif not concept_data.get("description"):
-                # If no description and no structured fields, create a minimal description
-                concept_data["description"] = concept_data.get("title", "Medical concept from document")
-                print(f"⚠️ WARNING: No description field found, using title as description")
+                    concept_data["description"] = "".join(description_parts)
+                elif not concept_data.get("description"):
+                    # If no description and no structured fields, create a minimal description
+                    concept_data["description"] = concept_data.get("title", "Medical concept from document")
+                    llm_logger.warning("⚠️ WARNING: No description field found, using title as description")
             
-            # Ensure case_title is set on the concept for proper storage and retrieval
-            if not concept_data.get("case_title") and request.case_title:
-                concept_data["case_title"] = request.case_title
-                print(f"✅ Set case_title '{request.case_title}' on concept")
+                # Ensure case_title is set on the concept for proper storage and retrieval
+                if not concept_data.get("case_title") and request.case_title:
+                    concept_data["case_title"] = request.case_title
+                    llm_logger.info("✅ Set case_title '%s' on concept", request.case_title)
             
-            concepts = [Concept(**concept_data)]
-            print(f"✅ Successfully created Concept object: {concepts[0].title} for case: {concept_data.get('case_title', 'NO CASE_TITLE')}")
+                concepts = [Concept(**concept_data)]
+                llm_logger.info("✅ Successfully created Concept object: %s for case: %s", concepts[0].title, concept_data.get('case_title', 'NO CASE_TITLE'))
+            except Exception as e:
+                llm_logger.error("❌ ERROR: Failed to create Concept object: %s", e)
+                llm_logger.error("❌ Concept data: %s", concepts_data[0] if concepts_data else 'None')
+                # No fallback - raise error to force retry
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Failed to create concept object from generated data. Please try again. Error: {str(e)}"
+                )
+        
+            await llm_response_cache.set(cache_key, {"concepts": jsonable_encoder(concepts)}, "concepts")
+        
+            return ConceptResponse(
+                document_id=request.document_id,
+                concepts=concepts,
+                generated_at=datetime.utcnow()
+            )
+        
+        except HTTPException:
+            # Re-raise HTTP exceptions (these are intentional errors)
+            raise
         except Exception as e:
-            print(f"❌ ERROR: Failed to create Concept object: {e}")
-            print(f"❌ Concept data: {concepts_data[0] if concepts_data else 'None'}")
-            # No fallback - raise error to force retry
+            llm_logger.exception("❌ CRITICAL ERROR in identify_concepts: %s", e)
+            # No fallback - raise error to force proper generation
             raise HTTPException(
-                status_code=500,
-                detail=f"Failed to create concept object from generated data. Please try again. Error: {str(e)}"
+                status_code=500, 
+                detail=f"Error identifying concepts: {str(e)}. Please try again."
             )
-        
-        return ConceptResponse(
-            document_id=request.document_id,
-            concepts=concepts,
-            generated_at=datetime.utcnow()
-        )
-        
-    except HTTPException:
-        # Re-raise HTTP exceptions (these are intentional errors)
-        raise
-    except Exception as e:
-        print(f"❌ CRITICAL ERROR in identify_concepts: {e}")
-        import traceback
-        print(f"❌ Traceback: {traceback.format_exc()}")
-        # No fallback - raise error to force proper generation
-        raise HTTPException(
-            status_code=500, 
-            detail=f"Error identifying concepts: {str(e)}. Please try again."
-        )
+    
+    # Identical requests arriving while this one runs share its result
+    return await generation_flights.run(cache_key, "concepts", run_generation)
 
 @app.post("/ai/auto-generate", response_model=AutoGenerationResponse)
 async def auto_generate_content(
     request: AutoGenerationRequest,
     current_user: dict = Depends(get_current_user),
-    request_obj: Request = None
+    request_obj: Request = None,
+    mode: GenerationMode = "sync"
 ):
     """Automatically generate all content types from a document - optimized for speed"""
     
@@ -4291,14 +6733,14 @@ async def auto_generate_content(
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     
-    print(f" Auto-generation started for document: {request.document_id}")
+    if mode == "job":
+        return await submit_generation_job("auto_generate", request, current_user)
+    
+    llm_logger.info("Auto-generation started for document: %s", request.document_id)
     
     # Find the document
     try:
-        document = db.documents.find_one({
-            "_id": ObjectId(request.document_id),
-            "uploaded_by": current_user["id"]
-        })
+        document = await document_repository.get_for_user(request.document_id, current_user["id"])
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid document ID")
     
@@ -4306,30 +6748,31 @@ async def auto_generate_content(
         raise HTTPException(status_code=404, detail="Document not found or access denied")
     
     # Check if document has text content
-    if not document.get("content"):
+    if not document.get("text_length"):
         raise HTTPException(status_code=400, detail="Document does not contain readable text content")
     
-    response_data = {
-        "document_id": request.document_id,
-        "generated_at": datetime.utcnow(),
-        "success": True,
-        "message": "Auto-generation completed successfully"
-    }
+    if not llm_gateway:
+        raise HTTPException(status_code=500, detail="OpenAI client not initialized")
     
-    try:
-        # Use OpenAI GPT-4 mini
-        if not openai_client:
-            raise Exception("OpenAI client not initialized")
-        
-        # Generate Cases
-        if request.generate_cases:
-            print(f" Generating {request.num_cases} cases...")
-            try:
-                # Determine difficulty distribution
-                num_cases = request.num_cases
-                if num_cases == 5:
-                    difficulty_distribution = "EXACTLY 1 Moderate case (first), 2 Moderate cases (second and third), and 2 Hard cases (fourth and fifth) in this EXACT order"
-                    difficulty_requirements = """
+    # Sections have no topic to rank by, so they get passages sampled across the whole document
+    document_index = await asyncio.to_thread(load_document_index, document)
+    section_context, title_context = await asyncio.gather(
+        asyncio.to_thread(document_index.context, None, 750),
+        asyncio.to_thread(document_index.context, None, 125)
+    )
+    
+    # Each section generator returns (items, status) where status is "completed" or "fallback";
+    # raising marks the section as failed without affecting the others
+
+    async def generate_cases_section():
+        """Generate case scenarios for the document"""
+        llm_logger.info("Generating %s cases...", request.num_cases)
+        try:
+            # Determine difficulty distribution
+            num_cases = request.num_cases
+            if num_cases == 5:
+                difficulty_distribution = "EXACTLY 1 Moderate case (first), 2 Moderate cases (second and third), and 2 Hard cases (fourth and fifth) in this EXACT order"
+                difficulty_requirements = """
 CRITICAL DIFFICULTY REQUIREMENTS (for 5 cases - MUST FOLLOW THIS EXACT ORDER):
 - Case 1 (FIRST): MUST be "Moderate" - Moderate complexity, some diagnostic challenges, requires intermediate clinical reasoning. Use moderately complex concepts from the document.
 - Case 2 (SECOND): MUST be "Moderate" - Moderate complexity, some diagnostic challenges, requires intermediate clinical reasoning. Use moderately complex concepts from the document.
@@ -4341,14 +6784,14 @@ The case description MUST match the difficulty level:
 - Easy: Clear, straightforward presentation with obvious clinical signs. Simple diagnostic path. Basic pathophysiology. Directly based on document content.
 - Moderate: Some complexity in presentation, requires connecting multiple findings. Moderate diagnostic challenge. Based on document content but requires some reasoning.
 - Hard: Complex, nuanced presentation with subtle findings. Multiple possible diagnoses. Requires advanced reasoning and knowledge integration. Based on complex concepts from document."""
-                else:
-                    difficulty_distribution = f"Distribute difficulty levels appropriately across {num_cases} cases"
-                    difficulty_requirements = "- Assign difficulty levels (Easy, Moderate, Hard) that match the complexity of each case"
-                
-                cases_prompt = f"""You are an expert medical case scenario generator specializing in creating comprehensive, educational medical cases for medical students. Based on the following document content, generate {num_cases} realistic, detailed medical case scenarios that are DIRECTLY RELEVANT to the document content.
+            else:
+                difficulty_distribution = f"Distribute difficulty levels appropriately across {num_cases} cases"
+                difficulty_requirements = "- Assign difficulty levels (Easy, Moderate, Hard) that match the complexity of each case"
+            
+            cases_prompt = f"""You are an expert medical case scenario generator specializing in creating comprehensive, educational medical cases for medical students. Based on the following document content, generate {num_cases} realistic, detailed medical case scenarios that are DIRECTLY RELEVANT to the document content.
 
 Document Content:
-{document['content'][:3000]}
+{section_context}
 
 CRITICAL RELEVANCE REQUIREMENTS:
 - Cases MUST be directly based on the medical concepts, conditions, and information in the document above
@@ -4403,232 +6846,195 @@ CRITICAL FOR 5 CASES:
 - The difficulty level MUST match the complexity of the case description
 - ALL cases MUST be directly relevant to the document content above
 - Use specific medical concepts, conditions, and terminology from the document"""
+            
+            system_message = "You are an expert medical case scenario generator. Always respond with valid JSON format. Each case description must be comprehensive (200-300 words minimum)."
+            if request.num_cases == 5:
+                system_message += " CRITICAL: When generating 5 cases, you MUST create exactly 1 Easy case, 2 Moderate cases, and 2 Hard cases. The case descriptions must match their difficulty levels."
+            
+            cases_response = await llm_gateway.chat_completion(
+                model="gpt-4.1",
+                messages=[
+                    {"role": "system", "content": system_message},
+                    {"role": "user", "content": cases_prompt}
+                ],
+                temperature=0.7,
+                max_tokens=6000
+            )
+            llm_logger.debug("Raw cases response: %s...", cases_response.choices[0].message.content[:500])
+            
+            try:
+                # Clean the response text
+                response_text = cases_response.choices[0].message.content.strip()
                 
-                system_message = "You are an expert medical case scenario generator. Always respond with valid JSON format. Each case description must be comprehensive (200-300 words minimum)."
-                if request.num_cases == 5:
-                    system_message += " CRITICAL: When generating 5 cases, you MUST create exactly 1 Easy case, 2 Moderate cases, and 2 Hard cases. The case descriptions must match their difficulty levels."
+                # Remove markdown formatting if present
+                if response_text.startswith('```json'):
+                    response_text = response_text.replace('```json', '').replace('```', '').strip()
+                elif response_text.startswith('```'):
+                    response_text = response_text.replace('```', '').strip()
                 
-                cases_response = openai_client.chat.completions.create(
-                    model="gpt-4.1",
-                    messages=[
-                        {"role": "system", "content": system_message},
-                        {"role": "user", "content": cases_prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=6000
-                )
-                import json
-                print(f"Raw cases response: {cases_response.choices[0].message.content[:500]}...")
+                # Find JSON array boundaries
+                start_idx = response_text.find('[')
+                end_idx = response_text.rfind(']') + 1
                 
-                try:
-                    # Clean the response text
-                    response_text = cases_response.choices[0].message.content.strip()
+                if start_idx != -1 and end_idx != -1:
+                    json_text = response_text[start_idx:end_idx]
+                    cases_data = json.loads(json_text)
                     
-                    # Remove markdown formatting if present
-                    if response_text.startswith('```json'):
-                        response_text = response_text.replace('```json', '').replace('```', '').strip()
-                    elif response_text.startswith('```'):
-                        response_text = response_text.replace('```', '').strip()
+                    # Ensure we have the right number of cases
+                    if len(cases_data) < request.num_cases:
+                        llm_logger.warning("Warning: Only got %s cases, expected %s", len(cases_data), request.num_cases)
+                        # If we got fewer cases than requested, try to generate more
+                        if len(cases_data) == 0:
+                            raise ValueError("No cases generated")
                     
-                    # Find JSON array boundaries
-                    start_idx = response_text.find('[')
-                    end_idx = response_text.rfind(']') + 1
+                    # Take the requested number of cases, or all available if fewer
+                    cases_to_use = cases_data[:request.num_cases]
                     
-                    if start_idx != -1 and end_idx != -1:
-                        json_text = response_text[start_idx:end_idx]
-                        cases_data = json.loads(json_text)
+                    # Validate and enforce difficulty distribution for 5 cases
+                    if request.num_cases == 5 and len(cases_to_use) == 5:
+                        # Force correct distribution in exact order: Easy, Moderate, Moderate, Hard, Hard
+                        required_distribution = ["Easy", "Moderate", "Moderate", "Hard", "Hard"]
                         
-                        # Ensure we have the right number of cases
-                        if len(cases_data) < request.num_cases:
-                            print(f"Warning: Only got {len(cases_data)} cases, expected {request.num_cases}")
-                            # If we got fewer cases than requested, try to generate more
-                            if len(cases_data) == 0:
-                                raise ValueError("No cases generated")
+                        # Check current distribution
+                        difficulty_counts = {"Easy": 0, "Moderate": 0, "Hard": 0}
+                        for case in cases_to_use:
+                            diff = case.get("difficulty", "Moderate").strip()
+                            # Normalize difficulty
+                            if diff.lower() == "easy":
+                                difficulty_counts["Easy"] += 1
+                            elif diff.lower() == "moderate":
+                                difficulty_counts["Moderate"] += 1
+                            elif diff.lower() == "hard":
+                                difficulty_counts["Hard"] += 1
+                            else:
+                                difficulty_counts["Moderate"] += 1  # Default to Moderate
                         
-                        # Take the requested number of cases, or all available if fewer
-                        cases_to_use = cases_data[:request.num_cases]
+                        llm_logger.info("📊 Difficulty distribution before fix: Easy=%s, Moderate=%s, Hard=%s", difficulty_counts['Easy'], difficulty_counts['Moderate'], difficulty_counts['Hard'])
                         
-                        # Validate and enforce difficulty distribution for 5 cases
-                        if request.num_cases == 5 and len(cases_to_use) == 5:
-                            # Force correct distribution in exact order: Easy, Moderate, Moderate, Hard, Hard
-                            required_distribution = ["Easy", "Moderate", "Moderate", "Hard", "Hard"]
-                            
-                            # Check current distribution
-                            difficulty_counts = {"Easy": 0, "Moderate": 0, "Hard": 0}
-                            for case in cases_to_use:
-                                diff = case.get("difficulty", "Moderate").strip()
-                                # Normalize difficulty
-                                if diff.lower() == "easy":
-                                    difficulty_counts["Easy"] += 1
-                                elif diff.lower() == "moderate":
-                                    difficulty_counts["Moderate"] += 1
-                                elif diff.lower() == "hard":
-                                    difficulty_counts["Hard"] += 1
-                                else:
-                                    difficulty_counts["Moderate"] += 1  # Default to Moderate
-                            
-                            print(f"📊 Difficulty distribution before fix: Easy={difficulty_counts['Easy']}, Moderate={difficulty_counts['Moderate']}, Hard={difficulty_counts['Hard']}")
-                            
-                            # Always enforce correct distribution in order (even if already correct, ensure order is right)
-                            if difficulty_counts["Easy"] != 1 or difficulty_counts["Moderate"] != 2 or difficulty_counts["Hard"] != 2:
-                                print(f"⚠️ WARNING: Difficulty distribution incorrect. Expected: 1 Easy, 2 Moderate, 2 Hard. Got: {difficulty_counts}")
-                            
-                            print(f"🔧 Enforcing correct distribution in order: [Easy, Moderate, Moderate, Hard, Hard]")
-                            
-                            # Force correct distribution in exact order (always, to ensure consistency)
-                            for i, case in enumerate(cases_to_use):
-                                case["difficulty"] = required_distribution[i]
-                                print(f"  Case {i+1}: Set difficulty to {required_distribution[i]}")
-                            
-                            # Verify final distribution
-                            final_counts = {"Easy": 0, "Moderate": 0, "Hard": 0}
-                            for case in cases_to_use:
-                                final_counts[case.get("difficulty", "Moderate")] += 1
-                            print(f"✅ Final difficulty distribution: Easy={final_counts['Easy']}, Moderate={final_counts['Moderate']}, Hard={final_counts['Hard']}")
+                        # Always enforce correct distribution in order (even if already correct, ensure order is right)
+                        if difficulty_counts["Easy"] != 1 or difficulty_counts["Moderate"] != 2 or difficulty_counts["Hard"] != 2:
+                            llm_logger.warning("⚠️ WARNING: Difficulty distribution incorrect. Expected: 1 Easy, 2 Moderate, 2 Hard. Got: %s", difficulty_counts)
                         
-                        response_data["cases"] = [CaseScenario(**case) for case in cases_to_use]
-                        print(f" Generated {len(response_data['cases'])} cases successfully")
-                    else:
-                        raise ValueError("No valid JSON array found in response")
+                        llm_logger.info("🔧 Enforcing correct distribution in order: [Easy, Moderate, Moderate, Hard, Hard]")
                         
-                except json.JSONDecodeError as e:
-                    print(f" Failed to parse cases JSON: {e}")
-                    print(f" Response text: {cases_response.choices[0].message.content[:500]}...")
-                    # Create fallback cases based on document content
-                    fallback_cases = []
-                    doc_content_preview = document.get('content', '')[:500] if document.get('content') else ''
-                    for i in range(min(request.num_cases, 5)):  # Limit fallback to 5 cases
-                        fallback_cases.append({
-                            "title": f"Medical Case {i+1} from {document.get('filename', 'Document')}",
-                            "description": f"""Based on the uploaded document '{document.get('filename', 'Document')}', this case presents a comprehensive medical scenario involving the key concepts discussed in the document. 
+                        # Force correct distribution in exact order (always, to ensure consistency)
+                        for i, case in enumerate(cases_to_use):
+                            case["difficulty"] = required_distribution[i]
+                            llm_logger.debug("Case %s: Set difficulty to %s", i+1, required_distribution[i])
+                        
+                        # Verify final distribution
+                        final_counts = {"Easy": 0, "Moderate": 0, "Hard": 0}
+                        for case in cases_to_use:
+                            final_counts[case.get("difficulty", "Moderate")] += 1
+                        llm_logger.info("✅ Final difficulty distribution: Easy=%s, Moderate=%s, Hard=%s", final_counts['Easy'], final_counts['Moderate'], final_counts['Hard'])
+                    
+                    cases = [CaseScenario(**case) for case in cases_to_use]
+                    llm_logger.info("Generated %s cases successfully", len(cases))
+                    return cases, "completed"
+                else:
+                    raise ValueError("No valid JSON array found in response")
+                    
+            except json.JSONDecodeError as e:
+                llm_logger.error("Failed to parse cases JSON: %s", e)
+                llm_logger.debug("Response text: %s...", cases_response.choices[0].message.content[:500])
+                # Create fallback cases based on document content
+                fallback_cases = []
+                for i in range(min(request.num_cases, 5)):  # Limit fallback to 5 cases
+                    fallback_cases.append({
+                        "title": f"Medical Case {i+1} from {document.get('filename', 'Document')}",
+                        "description": f"""Based on the uploaded document '{document.get('filename', 'Document')}', this case presents a comprehensive medical scenario involving the key concepts discussed in the document. 
 
 The case includes a detailed patient presentation with specific demographic information, presenting complaint, and relevant medical history. The patient's clinical presentation is thoroughly described, including vital signs, physical examination findings, and relevant diagnostic test results that align with the document content.
 
 The case explores important diagnostic considerations, differential diagnosis approaches, and treatment strategies relevant to the medical concepts presented in the document. This scenario is designed to help medical students understand the clinical application of the theoretical knowledge discussed in the source material.""",
-                            "key_points": [
-                                "Key medical concept from document",
-                                "Diagnostic approach based on document",
-                                "Treatment considerations from document",
-                                "Clinical reasoning points",
-                                "Important learning objective",
-                                "Pathophysiology considerations",
-                                "Differential diagnosis approach"
-                            ],
-                            "difficulty": "Moderate"
-                        })
-                    response_data["cases"] = [CaseScenario(**case) for case in fallback_cases]
-                    print(f" Generated {len(response_data['cases'])} fallback cases")
-            except Exception as e:
-                print(f" Case generation failed: {e}")
-                # Create detailed fallback
-                doc_filename = document.get('filename', 'Document')
-                fallback_cases = [{
-                    "title": f"Medical Case from {doc_filename}",
-                    "description": f"""This medical case scenario is based on the uploaded document '{doc_filename}' and presents a comprehensive clinical scenario designed for medical education. 
+                        "key_points": [
+                            "Key medical concept from document",
+                            "Diagnostic approach based on document",
+                            "Treatment considerations from document",
+                            "Clinical reasoning points",
+                            "Important learning objective",
+                            "Pathophysiology considerations",
+                            "Differential diagnosis approach"
+                        ],
+                        "difficulty": "Moderate"
+                    })
+                llm_logger.info("Generated %s fallback cases", len(fallback_cases))
+                return [CaseScenario(**case) for case in fallback_cases], "fallback"
+        except Exception as e:
+            llm_logger.error("Case generation failed: %s", e)
+            # Create detailed fallback
+            doc_filename = document.get('filename', 'Document')
+            fallback_cases = [{
+                "title": f"Medical Case from {doc_filename}",
+                "description": f"""This medical case scenario is based on the uploaded document '{doc_filename}' and presents a comprehensive clinical scenario designed for medical education. 
 
 The case includes a detailed patient presentation with comprehensive demographic information, presenting complaint, and relevant social history that provides important context for understanding the clinical situation. The patient's medical history is thoroughly documented, including past medical conditions, previous surgeries, family history, and any relevant genetic or environmental factors that may influence the current presentation.
 
 Physical examination findings are described in detail, including vital signs, general appearance, and system-by-system examination results with both positive and negative findings that are crucial for differential diagnosis. Diagnostic test results are provided with specific values, reference ranges, and clinical interpretation to help students understand how laboratory and imaging studies contribute to the diagnostic process.""",
-                    "key_points": [
-                        "Document-based learning point 1",
-                        "Document-based learning point 2", 
-                        "Document-based learning point 3",
-                        "Clinical reasoning and diagnostic approach",
-                        "Treatment considerations and management strategies"
-                    ],
-                    "difficulty": "Moderate"
-                }]
-                response_data["cases"] = [CaseScenario(**case) for case in fallback_cases]  
-        
-        # Generate MCQs
-        if request.generate_mcqs:
-            print(f" Generating {request.num_mcqs} MCQs...")
-            try:
-                mcq_prompt = f"""Generate {request.num_mcqs} MCQ questions from this content:
+                "key_points": [
+                    "Document-based learning point 1",
+                    "Document-based learning point 2", 
+                    "Document-based learning point 3",
+                    "Clinical reasoning and diagnostic approach",
+                    "Treatment considerations and management strategies"
+                ],
+                "difficulty": "Moderate"
+            }]
+            return [CaseScenario(**case) for case in fallback_cases], "fallback"
+    
+    async def generate_mcqs_section():
+        """Generate MCQ questions for the document"""
+        llm_logger.info("Generating %s MCQs...", request.num_mcqs)
+        try:
+            mcq_prompt = f"""Generate {request.num_mcqs} MCQ questions from this content:
 
-{document['content'][:500]}
+{title_context}
 
 Return JSON array:
 [{{"id": "mcq_1", "question": "Medical question?", "options": [{{"id": "A", "text": "Option A", "is_correct": false}}, {{"id": "B", "text": "Correct answer", "is_correct": true}}, {{"id": "C", "text": "Option C", "is_correct": false}}, {{"id": "D", "text": "Option D", "is_correct": false}}], "explanation": "Brief explanation", "difficulty": "Easy|Moderate|Hard"}}]
 
 Generate exactly {request.num_mcqs} questions."""
+            
+            mcq_response = await llm_gateway.chat_completion(
+                model="gpt-4.1",
+                messages=[
+                    {"role": "system", "content": "You are an expert medical educator creating MCQ questions. Always respond with valid JSON format."},
+                    {"role": "user", "content": mcq_prompt}
+                ],
+                temperature=0.7,
+                max_tokens=3000
+            )
+            llm_logger.debug("Raw MCQ response: %s...", mcq_response.choices[0].message.content[:500])
+            
+            try:
+                # Clean the response text
+                response_text = mcq_response.choices[0].message.content.strip()
                 
-                mcq_response = openai_client.chat.completions.create(
-                    model="gpt-4.1",
-                    messages=[
-                        {"role": "system", "content": "You are an expert medical educator creating MCQ questions. Always respond with valid JSON format."},
-                        {"role": "user", "content": mcq_prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=3000
-                )
-                print(f"Raw MCQ response: {mcq_response.choices[0].message.content[:500]}...")
+                # Remove markdown formatting if present
+                if response_text.startswith('```json'):
+                    response_text = response_text.replace('```json', '').replace('```', '').strip()
+                elif response_text.startswith('```'):
+                    response_text = response_text.replace('```', '').strip()
                 
-                try:
-                    # Clean the response text
-                    response_text = mcq_response.choices[0].message.content.strip()
-                    
-                    # Remove markdown formatting if present
-                    if response_text.startswith('```json'):
-                        response_text = response_text.replace('```json', '').replace('```', '').strip()
-                    elif response_text.startswith('```'):
-                        response_text = response_text.replace('```', '').strip()
+                # Find JSON array boundaries
+                start_idx = response_text.find('[')
+                end_idx = response_text.rfind(']') + 1
+                
+                if start_idx != -1 and end_idx != -1:
+                    json_text = response_text[start_idx:end_idx]
+                    mcq_data = json.loads(json_text)
                     
-                    # Find JSON array boundaries
-                    start_idx = response_text.find('[')
-                    end_idx = response_text.rfind(']') + 1
-                    
-                    if start_idx != -1 and end_idx != -1:
-                        json_text = response_text[start_idx:end_idx]
-                        mcq_data = json.loads(json_text)
-                        
-                        # Ensure we have the right number of MCQs
-                        if len(mcq_data) < request.num_mcqs:
-                            print(f"Warning: Only got {len(mcq_data)} MCQs, expected {request.num_mcqs}")
-                            # If we got fewer MCQs than requested, try to generate more
-                            if len(mcq_data) == 0:
-                                raise ValueError("No MCQs generated")
-                        
-                        # Take the requested number of MCQs, or all available if fewer
-                        mcqs_to_use = mcq_data[:request.num_mcqs]
-                        questions = []
-                        for mcq in mcqs_to_use:
-                            options = [MCQOption(**option) for option in mcq["options"]]
-                            question = MCQQuestion(
-                                id=mcq["id"],
-                                question=mcq["question"],
-                                options=options,
-                                explanation=mcq["explanation"],
-                                difficulty=mcq["difficulty"]
-                            )
-                            questions.append(question)
-                        response_data["mcqs"] = questions
-                        print(f" Generated {len(response_data['mcqs'])} MCQs successfully")
-                    else:
-                        raise ValueError("No valid JSON array found in response")
-                        
-                except json.JSONDecodeError as e:
-                    print(f" Failed to parse MCQs JSON: {e}")
-                    print(f" Response text: {mcq_response.choices[0].message.content[:500]}...")
-                    # Create fallback MCQs based on document content
-                    fallback_mcqs = []
-                    for i in range(min(request.num_mcqs, 5)):  # Limit fallback to 5 MCQs
-                        fallback_mcqs.append({
-                            "id": f"mcq_{i+1}",
-                            "question": f"Based on the document '{document.get('filename', 'Document')}', which of the following is most accurate?",
-                            "options": [
-                                {"id": "A", "text": "Option A based on document content", "is_correct": False},
-                                {"id": "B", "text": "Option B based on document content", "is_correct": True},
-                                {"id": "C", "text": "Option C based on document content", "is_correct": False},
-                                {"id": "D", "text": "Option D based on document content", "is_correct": False},
-                                {"id": "E", "text": "Option E based on document content", "is_correct": False}
-                            ],
-                            "explanation": f"This question is based on the key concepts discussed in the uploaded document '{document.get('filename', 'Document')}'.",
-                            "difficulty": "Moderate"
-                        })
+                    # Ensure we have the right number of MCQs
+                    if len(mcq_data) < request.num_mcqs:
+                        llm_logger.warning("Warning: Only got %s MCQs, expected %s", len(mcq_data), request.num_mcqs)
+                        # If we got fewer MCQs than requested, try to generate more
+                        if len(mcq_data) == 0:
+                            raise ValueError("No MCQs generated")
                     
+                    # Take the requested number of MCQs, or all available if fewer
+                    mcqs_to_use = mcq_data[:request.num_mcqs]
                     questions = []
-                    for mcq in fallback_mcqs:
+                    for mcq in mcqs_to_use:
                         options = [MCQOption(**option) for option in mcq["options"]]
                         question = MCQQuestion(
                             id=mcq["id"],
@@ -4638,49 +7044,80 @@ Generate exactly {request.num_mcqs} questions."""
                             difficulty=mcq["difficulty"]
                         )
                         questions.append(question)
-                    response_data["mcqs"] = questions
-                    print(f" Generated {len(response_data['mcqs'])} fallback MCQs")
-            except Exception as e:
-                print(f" MCQ generation failed: {e}")
-                # Create minimal fallback
-                fallback_mcq = {
-                    "id": "mcq_1",
-                    "question": f"Based on the document '{document.get('filename', 'Document')}', which statement is correct?",
-                    "options": [
-                        {"id": "A", "text": "Option A", "is_correct": False},
-                        {"id": "B", "text": "Option B", "is_correct": True},
-                        {"id": "C", "text": "Option C", "is_correct": False},
-                        {"id": "D", "text": "Option D", "is_correct": False},
-                        {"id": "E", "text": "Option E", "is_correct": False}
-                    ],
-                    "explanation": f"This question is based on the document content.",
-                    "difficulty": "Moderate"
-                }
-                options = [MCQOption(**option) for option in fallback_mcq["options"]]
-                question = MCQQuestion(
-                    id=fallback_mcq["id"],
-                    question=fallback_mcq["question"],
-                    options=options,
-                    explanation=fallback_mcq["explanation"],
-                    difficulty=fallback_mcq["difficulty"]
-                )
-                response_data["mcqs"] = [question]
-        
-        # Generate Concepts
-        if request.generate_concepts:
-            print(f" Generating {request.num_concepts} concepts...")
-            # Retry logic for concept generation - force real generation, no fallbacks
-            max_retries = 5
-            retry_count = 0
-            concepts_data = None
-            last_error = None
-            
-            while retry_count <= max_retries:
-                try:
-                    concepts_prompt = f"""Identify {request.num_concepts} key medical concepts from this content. The concepts MUST be DIRECTLY RELEVANT to the document content below.
+                    llm_logger.info("Generated %s MCQs successfully", len(questions))
+                    return questions, "completed"
+                else:
+                    raise ValueError("No valid JSON array found in response")
+                    
+            except json.JSONDecodeError as e:
+                llm_logger.error("Failed to parse MCQs JSON: %s", e)
+                llm_logger.debug("Response text: %s...", mcq_response.choices[0].message.content[:500])
+                # Create fallback MCQs based on document content
+                fallback_mcqs = []
+                for i in range(min(request.num_mcqs, 5)):  # Limit fallback to 5 MCQs
+                    fallback_mcqs.append({
+                        "id": f"mcq_{i+1}",
+                        "question": f"Based on the document '{document.get('filename', 'Document')}', which of the following is most accurate?",
+                        "options": [
+                            {"id": "A", "text": "Option A based on document content", "is_correct": False},
+                            {"id": "B", "text": "Option B based on document content", "is_correct": True},
+                            {"id": "C", "text": "Option C based on document content", "is_correct": False},
+                            {"id": "D", "text": "Option D based on document content", "is_correct": False},
+                            {"id": "E", "text": "Option E based on document content", "is_correct": False}
+                        ],
+                        "explanation": f"This question is based on the key concepts discussed in the uploaded document '{document.get('filename', 'Document')}'.",
+                        "difficulty": "Moderate"
+                    })
+                
+                questions = []
+                for mcq in fallback_mcqs:
+                    options = [MCQOption(**option) for option in mcq["options"]]
+                    question = MCQQuestion(
+                        id=mcq["id"],
+                        question=mcq["question"],
+                        options=options,
+                        explanation=mcq["explanation"],
+                        difficulty=mcq["difficulty"]
+                    )
+                    questions.append(question)
+                llm_logger.info("Generated %s fallback MCQs", len(questions))
+                return questions, "fallback"
+        except Exception as e:
+            llm_logger.error("MCQ generation failed: %s", e)
+            # Create minimal fallback
+            fallback_mcq = {
+                "id": "mcq_1",
+                "question": f"Based on the document '{document.get('filename', 'Document')}', which statement is correct?",
+                "options": [
+                    {"id": "A", "text": "Option A", "is_correct": False},
+                    {"id": "B", "text": "Option B", "is_correct": True},
+                    {"id": "C", "text": "Option C", "is_correct": False},
+                    {"id": "D", "text": "Option D", "is_correct": False},
+                    {"id": "E", "text": "Option E", "is_correct": False}
+                ],
+                "explanation": f"This question is based on the document content.",
+                "difficulty": "Moderate"
+            }
+            options = [MCQOption(**option) for option in fallback_mcq["options"]]
+            question = MCQQuestion(
+                id=fallback_mcq["id"],
+                question=fallback_mcq["question"],
+                options=options,
+                explanation=fallback_mcq["explanation"],
+                difficulty=fallback_mcq["difficulty"]
+            )
+            return [question], "fallback"
+    
+    async def generate_concepts_section():
+        """Identify key concepts - no fallback, a failure is reported for this section only"""
+        llm_logger.info("Generating %s concepts...", request.num_concepts)
+        # Retry logic for concept generation - force real generation, no fallbacks
+        async def generate_concepts_attempt():
+            """Run one generation attempt; raising ValueError marks the output as unusable"""
+            concepts_prompt = f"""Identify {request.num_concepts} key medical concepts from this content. The concepts MUST be DIRECTLY RELEVANT to the document content below.
 
 Document Content:
-{document['content'][:3000]}
+{section_context}
 
 CRITICAL REQUIREMENTS - 100% ACCURACY MANDATORY:
 - ACCURACY IS PARAMOUNT: All medical information, facts, terminology, and clinical details MUST be 100% accurate and directly derived from the document content
@@ -4695,99 +7132,82 @@ Return JSON array:
 [{{"id": "concept_1", "title": "Specific Medical Concept from Document", "description": "Detailed concept description based on document content (minimum 100 characters)", "importance": "High|Medium|Low"}}]
 
 Identify exactly {request.num_concepts} concepts that are directly relevant to the document content."""
-                    
-                    concepts_response = openai_client.chat.completions.create(
-                        model="gpt-4.1",
-                        messages=[
-                            {"role": "system", "content": "You are an expert medical educator identifying key concepts. Always respond with valid JSON array format. Concepts MUST be directly relevant to the document content provided. CRITICAL: Ensure 100% accuracy - all medical information must be factually correct and directly derived from the document. Do not generate generic or placeholder content."},
-                            {"role": "user", "content": concepts_prompt}
-                        ],
-                        temperature=0.4,  # Very low temperature for maximum accuracy and consistency
-                        max_tokens=3000
-                    )
-                    print(f"🔄 Attempt {retry_count + 1} of {max_retries + 1} to generate concepts...")
-                    print(f"Raw concepts response: {concepts_response.choices[0].message.content[:500]}...")
-                    
-                    # Clean the response text
-                    response_text = concepts_response.choices[0].message.content.strip()
-                    
-                    # Remove markdown formatting if present
-                    if response_text.startswith('```json'):
-                        response_text = response_text.replace('```json', '').replace('```', '').strip()
-                    elif response_text.startswith('```'):
-                        response_text = response_text.replace('```', '').strip()
-                    
-                    # Find JSON array boundaries
-                    start_idx = response_text.find('[')
-                    end_idx = response_text.rfind(']') + 1
-                    
-                    if start_idx != -1 and end_idx != -1:
-                        json_text = response_text[start_idx:end_idx]
-                        concepts_data = json.loads(json_text)
-                        
-                        # Validate content - check for real content, not placeholders
-                        has_valid_content = False
-                        for concept in concepts_data:
-                            desc = concept.get("description", "")
-                            title = concept.get("title", "")
-                            # Check for placeholder text
-                            if any(placeholder in desc.lower() or placeholder in title.lower() 
-                                   for placeholder in ["[text]", "[patient", "[medical", "placeholder", "example"]):
-                                raise ValueError("Generated content contains placeholders")
-                            # Check minimum length
-                            if len(desc) >= 100 and len(title) >= 10:
-                                has_valid_content = True
-                        
-                        if not has_valid_content:
-                            raise ValueError("Generated concepts lack sufficient detail")
-                        
-                        # Ensure we have the right number of concepts
-                        if len(concepts_data) < request.num_concepts:
-                            print(f"Warning: Only got {len(concepts_data)} concepts, expected {request.num_concepts}")
-                            if len(concepts_data) == 0:
-                                raise ValueError("No concepts generated")
-                        
-                        # Take the requested number of concepts, or all available if fewer
-                        concepts_to_use = concepts_data[:request.num_concepts]
-                        response_data["concepts"] = [Concept(**concept) for concept in concepts_to_use]
-                        print(f"✅ Generated {len(response_data['concepts'])} concepts successfully")
-                        break  # Success, exit retry loop
-                    else:
-                        raise ValueError("No valid JSON array found in response")
-                        
-                except (json.JSONDecodeError, ValueError, Exception) as e:
-                    last_error = e
-                    print(f"❌ ERROR on attempt {retry_count + 1}: {e}")
-                    if retry_count < max_retries:
-                        retry_count += 1
-                        # Exponential backoff: 1s, 2s, 4s, 8s, 16s
-                        delay = min(2 ** retry_count, 16)
-                        print(f"🔄 Retrying concept generation... ({retry_count}/{max_retries}) after {delay}s delay")
-                        import time
-                        time.sleep(delay)
-                        continue
-                    else:
-                        # All retries failed - raise error instead of using fallback
-                        print(f"❌ All {max_retries + 1} attempts failed. Last error: {last_error}")
-                        raise HTTPException(
-                            status_code=500, 
-                            detail=f"Failed to generate concepts after {max_retries + 1} attempts. Please try again. Error: {str(last_error)}"
-                        )
             
-            # If we get here without concepts_data, something went wrong
-            if not concepts_data:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to generate concepts. No valid content was produced. Please try again."
-                )
+            concepts_response = await llm_gateway.chat_completion(
+                model="gpt-4.1",
+                retry_policy=NO_RETRY_POLICY,  # CONCEPT_RETRY_POLICY owns retries here
+                messages=[
+                    {"role": "system", "content": "You are an expert medical educator identifying key concepts. Always respond with valid JSON array format. Concepts MUST be directly relevant to the document content provided. CRITICAL: Ensure 100% accuracy - all medical information must be factually correct and directly derived from the document. Do not generate generic or placeholder content."},
+                    {"role": "user", "content": concepts_prompt}
+                ],
+                temperature=0.4,  # Very low temperature for maximum accuracy and consistency
+                max_tokens=3000
+            )
+            llm_logger.debug("Raw concepts response: %s...", concepts_response.choices[0].message.content[:500])
+            
+            # Clean the response text
+            response_text = (concepts_response.choices[0].message.content or "").strip()
+            
+            # Remove markdown formatting if present
+            if response_text.startswith('```json'):
+                response_text = response_text.replace('```json', '').replace('```', '').strip()
+            elif response_text.startswith('```'):
+                response_text = response_text.replace('```', '').strip()
+            
+            # Find JSON array boundaries
+            start_idx = response_text.find('[')
+            end_idx = response_text.rfind(']') + 1
+            
+            if start_idx != -1 and end_idx != -1:
+                json_text = response_text[start_idx:end_idx]
+                concepts_data = json.loads(json_text)
+                
+                # Validate content - check for real content, not placeholders
+                has_valid_content = False
+                for concept in concepts_data:
+                    desc = concept.get("description", "")
+                    title = concept.get("title", "")
+                    # Check for placeholder text
+                    if any(placeholder in desc.lower() or placeholder in title.lower() 
+                           for placeholder in ["[text]", "[patient", "[medical", "placeholder", "example"]):
+                        raise ValueError("Generated content contains placeholders")
+                    # Check minimum length
+                    if len(desc) >= 100 and len(title) >= 10:
+                        has_valid_content = True
+                
+                if not has_valid_content:
+                    raise ValueError("Generated concepts lack sufficient detail")
+                
+                # Ensure we have the right number of concepts
+                if len(concepts_data) < request.num_concepts:
+                    llm_logger.warning("Warning: Only got %s concepts, expected %s", len(concepts_data), request.num_concepts)
+                    if len(concepts_data) == 0:
+                        raise ValueError("No concepts generated")
+                
+                # Take the requested number of concepts, or all available if fewer
+                concepts_to_use = concepts_data[:request.num_concepts]
+                return [Concept(**concept) for concept in concepts_to_use]
+            else:
+                raise ValueError("No valid JSON array found in response")
         
-        # Generate Case Titles
-        if request.generate_titles:
-            print(f" Generating {request.num_titles} case titles...")
-            try:
-                titles_prompt = f"""Generate {request.num_titles} case titles from this document:
+        try:
+            concepts = await CONCEPT_RETRY_POLICY.run(
+                generate_concepts_attempt,
+                description="Concept generation"
+            )
+        except RetryExhaustedError as e:
+            # All retries failed - fail this section instead of using fallback
+            raise Exception(f"Failed to generate concepts after {e.attempts} attempts. Error: {str(e.last_error)}")
+        llm_logger.info("✅ Generated %s concepts successfully", len(concepts))
+        return concepts, "completed"
+    
+    async def generate_titles_section():
+        """Generate case titles for the document"""
+        llm_logger.info("Generating %s case titles...", request.num_titles)
+        try:
+            titles_prompt = f"""Generate {request.num_titles} case titles from this document:
 
-{document['content'][:500]}
+{title_context}
 
 Return JSON array only:
 [
@@ -4798,81 +7218,165 @@ Return JSON array only:
         "difficulty": "Moderate"
     }}
 ]"""
+            
+            titles_response = await llm_gateway.chat_completion(
+                model="gpt-4.1",
+                messages=[
+                    {"role": "system", "content": "You are an expert medical case generator. Always respond with valid JSON format."},
+                    {"role": "user", "content": titles_prompt}
+                ],
+                temperature=0.7,
+                max_tokens=2000
+            )
+            llm_logger.debug("Raw titles response: %s...", titles_response.choices[0].message.content[:500])
+            
+            try:
+                # Clean the response text
+                response_text = titles_response.choices[0].message.content.strip()
                 
-                titles_response = openai_client.chat.completions.create(
-                    model="gpt-4.1",
-                    messages=[
-                        {"role": "system", "content": "You are an expert medical case generator. Always respond with valid JSON format."},
-                        {"role": "user", "content": titles_prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=2000
-                )
-                print(f"Raw titles response: {titles_response.choices[0].message.content[:500]}...")
+                # Remove markdown formatting if present
+                if response_text.startswith('```json'):
+                    response_text = response_text.replace('```json', '').replace('```', '').strip()
+                elif response_text.startswith('```'):
+                    response_text = response_text.replace('```', '').strip()
                 
-                try:
-                    # Clean the response text
-                    response_text = titles_response.choices[0].message.content.strip()
+                # Find JSON array boundaries
+                start_idx = response_text.find('[')
+                end_idx = response_text.rfind(']') + 1
+                
+                if start_idx != -1 and end_idx != -1:
+                    json_text = response_text[start_idx:end_idx]
+                    titles_data = json.loads(json_text)
                     
-                    # Remove markdown formatting if present
-                    if response_text.startswith('```json'):
-                        response_text = response_text.replace('```json', '').replace('```', '').strip()
-                    elif response_text.startswith('```'):
-                        response_text = response_text.replace('```', '').strip()
+                    # Ensure we have the right number of titles
+                    if len(titles_data) < request.num_titles:
+                        llm_logger.warning("Warning: Only got %s titles, expected %s", len(titles_data), request.num_titles)
                     
-                    # Find JSON array boundaries
-                    start_idx = response_text.find('[')
-                    end_idx = response_text.rfind(']') + 1
+                    titles = [CaseTitle(**title) for title in titles_data[:request.num_titles]]
+                    llm_logger.info("Generated %s case titles successfully", len(titles))
+                    return titles, "completed"
+                else:
+                    raise ValueError("No valid JSON array found in response")
                     
-                    if start_idx != -1 and end_idx != -1:
-                        json_text = response_text[start_idx:end_idx]
-                        titles_data = json.loads(json_text)
-                        
-                        # Ensure we have the right number of titles
-                        if len(titles_data) < request.num_titles:
-                            print(f"Warning: Only got {len(titles_data)} titles, expected {request.num_titles}")
-                        
-                        response_data["titles"] = [CaseTitle(**title) for title in titles_data[:request.num_titles]]
-                        print(f" Generated {len(response_data['titles'])} case titles successfully")
-                    else:
-                        raise ValueError("No valid JSON array found in response")
-                        
-                except json.JSONDecodeError as e:
-                    print(f" Failed to parse titles JSON: {e}")
-                    print(f" Response text: {titles_response.choices[0].message.content[:500]}...")
-                    # Create fallback titles based on document content
-                    fallback_titles = []
-                    for i in range(min(request.num_titles, 5)):  # Limit fallback to 5 titles
-                        fallback_titles.append({
-                            "id": f"case_{i+1}",
-                            "title": f"Medical Case {i+1} from {document.get('filename', 'Document')}",
-                            "description": f"This case is based on the medical content discussed in the uploaded document '{document.get('filename', 'Document')}' and presents a realistic clinical scenario for learning.",
-                            "difficulty": "Moderate"
-                        })
-                    response_data["titles"] = [CaseTitle(**title) for title in fallback_titles]
-                    print(f" Generated {len(response_data['titles'])} fallback case titles")
-            except Exception as e:
-                print(f" Title generation failed: {e}")
-                # Create minimal fallback
-                fallback_title = {
-                    "id": "case_1",
-                    "title": f"Case from {document.get('filename', 'Document')}",
-                    "description": f"Medical case based on the uploaded document content.",
-                    "difficulty": "Moderate"
-                }
-                response_data["titles"] = [CaseTitle(**fallback_title)]
-        
-        print(f" Auto-generation completed successfully!")
-        return AutoGenerationResponse(**response_data)
-        
-    except Exception as e:
-        print(f" Auto-generation error: {str(e)}")
-        return AutoGenerationResponse(
-            document_id=request.document_id,
-            generated_at=datetime.utcnow(),
-            success=False,
-            message=f"Auto-generation failed: {str(e)}"
+            except json.JSONDecodeError as e:
+                llm_logger.error("Failed to parse titles JSON: %s", e)
+                llm_logger.debug("Response text: %s...", titles_response.choices[0].message.content[:500])
+                # Create fallback titles based on document content
+                fallback_titles = []
+                for i in range(min(request.num_titles, 5)):  # Limit fallback to 5 titles
+                    fallback_titles.append({
+                        "id": f"case_{i+1}",
+                        "title": f"Medical Case {i+1} from {document.get('filename', 'Document')}",
+                        "description": f"This case is based on the medical content discussed in the uploaded document '{document.get('filename', 'Document')}' and presents a realistic clinical scenario for learning.",
+                        "difficulty": "Moderate"
+                    })
+                llm_logger.info("Generated %s fallback case titles", len(fallback_titles))
+                return [CaseTitle(**title) for title in fallback_titles], "fallback"
+        except Exception as e:
+            llm_logger.error("Title generation failed: %s", e)
+            # Create minimal fallback
+            fallback_title = {
+                "id": "case_1",
+                "title": f"Case from {document.get('filename', 'Document')}",
+                "description": f"Medical case based on the uploaded document content.",
+                "difficulty": "Moderate"
+            }
+            return [CaseTitle(**fallback_title)], "fallback"
+    
+    sections = [
+        (name, generate)
+        for name, enabled, generate in (
+            ("cases", request.generate_cases, generate_cases_section),
+            ("mcqs", request.generate_mcqs, generate_mcqs_section),
+            ("concepts", request.generate_concepts, generate_concepts_section),
+            ("titles", request.generate_titles, generate_titles_section),
+        )
+        if enabled
+    ]
+    
+    # Sections are independent, so run them concurrently under a per-request cap
+    section_slots = asyncio.Semaphore(AUTO_GENERATE_MAX_CONCURRENCY)
+    
+    async def run_section(name, generate):
+        async with section_slots:
+            llm_logger.info("Section '%s' started", name)
+            await generation_jobs.report_progress(**{name: "running"})
+            try:
+                items, status = await generate()
+            except Exception:
+                await generation_jobs.report_progress(**{name: "failed"})
+                raise
+            await generation_jobs.report_progress(**{name: status})
+            return items, status
+    
+    results = await asyncio.gather(
+        *(run_section(name, generate) for name, generate in sections),
+        return_exceptions=True
+    )
+    
+    response_data = {
+        "document_id": request.document_id,
+        "generated_at": datetime.utcnow(),
+        "section_status": {},
+        "section_errors": {}
+    }
+    for (name, _), result in zip(sections, results):
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception):
+                raise result
+            llm_logger.error("Section '%s' failed: %s", name, result)
+            response_data["section_status"][name] = "failed"
+            response_data["section_errors"][name] = str(result)
+        else:
+            response_data[name], response_data["section_status"][name] = result
+    
+    failed_sections = [name for name, status in response_data["section_status"].items() if status == "failed"]
+    if not failed_sections:
+        response_data["success"] = True
+        response_data["message"] = "Auto-generation completed successfully"
+    elif len(failed_sections) < len(sections):
+        response_data["success"] = True
+        response_data["message"] = f"Auto-generation completed with failed sections: {', '.join(failed_sections)}"
+    else:
+        response_data["success"] = False
+        response_data["message"] = "Auto-generation failed: " + "; ".join(
+            f"{name}: {response_data['section_errors'][name]}" for name in failed_sections
         )
+    
+    llm_logger.info("Auto-generation finished: %s", response_data['section_status'])
+    return AutoGenerationResponse(**response_data)
+
+generation_jobs.register("auto_generate", AutoGenerationRequest, auto_generate_content)
+generation_jobs.register("identify_concepts", ConceptRequest, identify_concepts)
+generation_jobs.register("generate_case_titles", CaseTitleRequest, generate_case_titles)
+
+@app.get("/jobs/{job_id}", response_model=GenerationJobResponse)
+async def get_generation_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Get the status, progress and result of a background generation job"""
+    try:
+        job = await generation_job_repository.find_one({
+            "_id": ObjectId(job_id),
+            "user_id": current_user["id"]
+        })
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid job ID")
+    
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return GenerationJobResponse(
+        job_id=str(job["_id"]),
+        kind=job["kind"],
+        status=job["status"],
+        progress=job.get("progress") or {},
+        result=job.get("result"),
+        error=job.get("error"),
+        attempts=job.get("attempts", 0),
+        created_at=job["created_at"],
+        started_at=job.get("started_at"),
+        completed_at=job.get("completed_at")
+    )
+
 
 @app.post("/ai/quick-generate")
 async def quick_generate_content(
@@ -4884,14 +7388,11 @@ async def quick_generate_content(
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     
-    print(f" Quick generation started for document: {request.document_id}")
+    llm_logger.info("Quick generation started for document: %s", request.document_id)
     
     # Find the document
     try:
-        document = db.documents.find_one({
-            "_id": ObjectId(request.document_id),
-            "uploaded_by": current_user["id"]
-        })
+        document = await document_repository.get_for_user(request.document_id, current_user["id"])
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid document ID")
     
@@ -4899,22 +7400,22 @@ async def quick_generate_content(
         raise HTTPException(status_code=404, detail="Document not found or access denied")
     
     # Check if document has text content
-    if not document.get("content"):
+    if not document.get("text_length"):
         raise HTTPException(status_code=400, detail="Document does not contain readable text content")
     
     try:
         # Use OpenAI GPT-4 mini
-        if not openai_client:
+        if not llm_gateway:
             raise Exception("OpenAI client not initialized")
         
         # Generate only MCQs first (most important for user experience)
         mcqs = []
         if request.generate_mcqs:
-            print(f" Quick generating {request.num_mcqs} MCQs...")
+            llm_logger.info("Quick generating %s MCQs...", request.num_mcqs)
             try:
                 mcq_prompt = f"""Generate {request.num_mcqs} MCQ questions from this document:
 
-{document['content'][:500]}
+{await select_document_context(document, None, 125)}
 
 Return JSON array only:
 [
@@ -4933,7 +7434,7 @@ Return JSON array only:
     }}
 ]"""
                 
-                mcq_response = openai_client.chat.completions.create(
+                mcq_response = await llm_gateway.chat_completion(
                     model="gpt-4.1",
                     messages=[
                         {"role": "system", "content": "You are an expert medical educator creating MCQ questions. Always respond with valid JSON format."},
@@ -4942,7 +7443,7 @@ Return JSON array only:
                     temperature=0.7,
                     max_tokens=2000
                 )
-                print(f"Quick MCQ response: {mcq_response.choices[0].message.content[:200]}...")
+                llm_logger.debug("Quick MCQ response: %s...", mcq_response.choices[0].message.content[:200])
                 
                 try:
                     # Clean the response text
@@ -4973,12 +7474,12 @@ Return JSON array only:
                                 difficulty=mcq["difficulty"]
                             )
                             mcqs.append(question)
-                        print(f" Quick generated {len(mcqs)} MCQs successfully")
+                        llm_logger.info("Quick generated %s MCQs successfully", len(mcqs))
                     else:
                         raise ValueError("No valid JSON array found in response")
                         
                 except json.JSONDecodeError as e:
-                    print(f" Quick MCQ JSON parsing failed: {e}")
+                    llm_logger.error("Quick MCQ JSON parsing failed: %s", e)
                     # Create fallback MCQs
                     for i in range(min(request.num_mcqs, 3)):
                         fallback_mcq = {
@@ -5003,9 +7504,9 @@ Return JSON array only:
                             difficulty=fallback_mcq["difficulty"]
                         )
                         mcqs.append(question)
-                    print(f" Quick generated {len(mcqs)} fallback MCQs")
+                    llm_logger.info("Quick generated %s fallback MCQs", len(mcqs))
             except Exception as e:
-                print(f" Quick MCQ generation failed: {e}")
+                llm_logger.error("Quick MCQ generation failed: %s", e)
         
         # Return quick response with MCQs
         return {
@@ -5018,7 +7519,7 @@ Return JSON array only:
         }
         
     except Exception as e:
-        print(f" Quick generation error: {str(e)}")
+        llm_logger.error("Quick generation error: %s", str(e))
         return {
             "document_id": request.document_id,
             "generated_at": datetime.utcnow(),
@@ -5106,85 +7607,51 @@ class GeneratedConcept(BaseModel):
     importance: str
     created_at: datetime
 
-@app.post("/ai/chat", response_model=ChatResponse)
-async def chat_with_ai(
-    request: ChatRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Chat with AI about uploaded documents"""
-    
-    print(f"CHAT ENDPOINT CALLED")
-    print(f"User: {current_user.get('email', 'unknown')}")
-    print(f"Message: {request.message}")
-    print(f"Document ID: {request.document_id}")
-    
-    if not OPENAI_API_KEY:
-        print("ERROR: OPENAI_API_KEY not configured")
-        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-    
+async def build_ai_chat_messages(request: ChatRequest, current_user: dict) -> List[dict]:
+    """Build the OpenAI messages for a /ai/chat request (explore case or general mode)"""
     # If document_id is provided, get the document context
     document_context = ""
     if request.document_id:
         try:
-            document = db.documents.find_one({
-                "_id": ObjectId(request.document_id),
-                "uploaded_by": current_user["id"]
-            })
-            if document and document.get("content"):
-                document_context = f"\n\nDocument Context:\n{document['content'][:500]}"  # Limit context
+            document = await document_repository.get_for_user(request.document_id, current_user["id"])
+            if document and document.get("text_length"):
+                document_context = f"\n\nDocument Context:\n{await select_document_context(document, request.message, 125)}"
         except Exception:
             pass  # Continue without document context if there's an error
     
-    try:
-        print("AI: Initializing OpenAI client...")
-        # Use OpenAI GPT-4 mini
-        if not openai_client:
-            raise Exception("OpenAI client not initialized")
-        
-        print("AI: Creating prompt...")
-        
-        # Check if this is an explore cases request (when case_title is present in request)
-        # For explore cases, use conversational format with full case details
-        case_title = request.case_title
-        case_difficulty = None
-        case_key_concept = None
-        case_description = None
-        
-        if case_title:
-            # Fetch full case details to make the prompt unique to this specific case
-            try:
-                doc_id_str = str(document["_id"]) if document else None
-                case_doc = None
-                if doc_id_str:
-                    case_doc = db.generated_cases.find_one({
-                        "title": case_title,
-                        "document_id": doc_id_str
-                    })
-                if not case_doc:
-                    case_doc = db.generated_cases.find_one({
-                        "title": case_title
-                    })
-                
-                if case_doc:
-                    case_difficulty = case_doc.get("difficulty", "Moderate")
-                    case_key_concept = ""
-                    if case_doc.get("key_points") and len(case_doc.get("key_points", [])) > 0:
-                        case_key_concept = case_doc.get("key_points", [""])[0]
-                    case_description = case_doc.get("description", "")
-            except Exception as e:
-                print(f"⚠️ Warning: Could not fetch case details: {e}")
-                # Continue with just case_title if fetch fails
+    # Check if this is an explore cases request (when case_title is present in request)
+    # For explore cases, use conversational format with full case details
+    case_title = request.case_title
+    case_difficulty = None
+    case_key_concept = None
+    case_description = None
+    
+    if case_title:
+        # Fetch full case details to make the prompt unique to this specific case
+        try:
+            doc_id_str = str(document["_id"]) if document else None
+            case_doc = await generated_case_repository.find_by_title(case_title, doc_id_str)
             
-            # Use default values if case details not found
-            if not case_difficulty:
-                case_difficulty = "Moderate"
-            if not case_key_concept:
+            if case_doc:
+                case_difficulty = case_doc.get("difficulty", "Moderate")
                 case_key_concept = ""
-            if not case_description:
-                case_description = ""
-            
-            # Explore Cases Mode: Conversational format with case-specific context
-            explore_case_system_prompt = f"""
+                if case_doc.get("key_points") and len(case_doc.get("key_points", [])) > 0:
+                    case_key_concept = case_doc.get("key_points", [""])[0]
+                case_description = case_doc.get("description", "")
+        except Exception as e:
+            llm_logger.warning("⚠️ Warning: Could not fetch case details: %s", e)
+            # Continue with just case_title if fetch fails
+        
+        # Use default values if case details not found
+        if not case_difficulty:
+            case_difficulty = "Moderate"
+        if not case_key_concept:
+            case_key_concept = ""
+        if not case_description:
+            case_description = ""
+        
+        # Explore Cases Mode: Conversational format with case-specific context
+        explore_case_system_prompt = f"""
 You are an expert Medical Educator having a natural, back‑and‑forth conversation with a medical student about a clinical case.
 
 ==============================
@@ -5233,12 +7700,12 @@ Student Question → {request.message}
 
 {document_context}
 """
-            
-            system_prompt = explore_case_system_prompt
-            system_role = "You are an expert Medical Educator having a natural, back-and-forth conversation with a medical student about a clinical case. Respond in flowing paragraphs without bullet points or structured formatting - just like a natural conversation."
-        else:
-            # General chat mode: standard medical assistant
-            system_prompt = f"""Medical AI assistant. Provide concise, accurate answers.
+        
+        system_prompt = explore_case_system_prompt
+        system_role = "You are an expert Medical Educator having a natural, back-and-forth conversation with a medical student about a clinical case. Respond in flowing paragraphs without bullet points or structured formatting - just like a natural conversation."
+    else:
+        # General chat mode: standard medical assistant
+        system_prompt = f"""Medical AI assistant. Provide concise, accurate answers.
 
 Question: {request.message}
 {document_context}
@@ -5249,40 +7716,94 @@ Instructions:
 - Focus on key points: diagnosis, treatment, clinical significance
 - Use bullet points for clarity
 - Be precise, avoid unnecessary detail"""
-            
-            system_role = "Medical AI assistant. Provide concise, accurate answers."
         
-        print("AI: Generating response from OpenAI...")
+        system_role = "Medical AI assistant. Provide concise, accurate answers."
+    
+    return [
+        {"role": "system", "content": system_role},
+        {"role": "user", "content": system_prompt}
+    ]
+
+@app.post("/ai/chat", response_model=ChatResponse)
+async def chat_with_ai(
+    request: ChatRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Chat with AI about uploaded documents"""
+    
+    llm_logger.debug("CHAT ENDPOINT CALLED - user: %s, document: %s, message: %s", current_user.get('email', 'unknown'), request.document_id, request.message)
+    
+    if not OPENAI_API_KEY:
+        llm_logger.error("ERROR: OPENAI_API_KEY not configured")
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    
+    try:
+        llm_logger.debug("AI: Initializing OpenAI client...")
+        # Use OpenAI GPT-4 mini
+        if not llm_gateway:
+            raise Exception("OpenAI client not initialized")
+        
+        llm_logger.debug("AI: Creating prompt...")
+        messages = await build_ai_chat_messages(request, current_user)
+        
+        llm_logger.debug("AI: Generating response from OpenAI...")
         # Generate response from OpenAI
-        response = openai_client.chat.completions.create(
+        response = await llm_gateway.chat_completion(
             model="gpt-4.1",
-            messages=[
-                {"role": "system", "content": system_role},
-                {"role": "user", "content": system_prompt}
-            ],
+            messages=messages,
             temperature=0.5,
             max_tokens=800,
             timeout=60
         )
         
-        print("SUCCESS: Response generated successfully")
+        llm_logger.debug("SUCCESS: Response generated successfully")
         return ChatResponse(
             response=response.choices[0].message.content,
             timestamp=datetime.now()
         )
         
     except Exception as e:
-        print(f"ERROR: Error in chat endpoint: {str(e)}")
-        print(f"ERROR: Error type: {type(e).__name__}")
-        import traceback
-        print(f"ERROR: Traceback: {traceback.format_exc()}")
+        llm_logger.exception("ERROR: Error in chat endpoint (%s): %s", type(e).__name__, e)
         raise HTTPException(status_code=500, detail=f"Error generating AI response: {str(e)}")
 
-def generate_chat_name(document_id: Optional[str] = None) -> str:
+@app.post("/ai/chat/stream")
+async def stream_chat_with_ai(
+    request: ChatRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Chat with AI about uploaded documents, streaming the answer as server-sent events"""
+    
+    if not OPENAI_API_KEY or not llm_gateway:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    
+    messages = await build_ai_chat_messages(request, current_user)
+    
+    async def event_stream():
+        parts = []
+        try:
+            async for token in llm_gateway.stream_chat_completion(
+                model="gpt-4.1",
+                messages=messages,
+                temperature=0.5,
+                max_tokens=800,
+                timeout=60
+            ):
+                parts.append(token)
+                yield format_sse("token", {"content": token})
+        except Exception as e:
+            llm_logger.error("❌ AI chat stream failed: %s", e)
+            yield format_sse("error", {"detail": f"Error generating AI response: {str(e)}"})
+            return
+        
+        yield format_sse("done", {"response": "".join(parts), "timestamp": datetime.now()})
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+async def generate_chat_name(document_id: Optional[str] = None) -> str:
     """Generate a dynamic chat name"""
     if document_id:
         try:
-            document = db.documents.find_one({"_id": ObjectId(document_id)})
+            document = await document_repository.get_by_id(document_id, {"filename": 1})
             if document:
                 # Use document filename as base for chat name
                 filename = document.get("filename", "Document")
@@ -5293,7 +7814,7 @@ def generate_chat_name(document_id: Optional[str] = None) -> str:
                     name_without_ext = name_without_ext[:30] + "..."
                 return name_without_ext
         except Exception as e:
-            print(f"Error generating chat name from document: {e}")
+            llm_logger.error("Error generating chat name from document: %s", e)
             pass
     
     # Generate timestamp-based name
@@ -5308,14 +7829,11 @@ async def create_chat(
     """Create a new chat session"""
     
     try:
-        print(f"CREATE CHAT ENDPOINT CALLED")
-        print(f"Request: {request}")
-        print(f"Document ID: {request.document_id}")
-        print(f"Current user: {current_user.get('id', 'No user ID')}")
+        logger.debug("CREATE CHAT ENDPOINT CALLED - user: %s, request: %s", current_user.get('id', 'No user ID'), request)
         
         # Generate chat name if not provided
-        chat_name = request.name or generate_chat_name(request.document_id)
-        print(f"Generated chat name: {chat_name}")
+        chat_name = request.name or await generate_chat_name(request.document_id)
+        logger.debug("Generated chat name: %s", chat_name)
         
         # Get document information if document_id is provided
         document_filename = None
@@ -5323,16 +7841,13 @@ async def create_chat(
         
         if request.document_id:
             try:
-                document = db.documents.find_one({
-                    "_id": ObjectId(request.document_id),
-                    "uploaded_by": current_user["id"]
-                })
+                document = await document_repository.get_for_user(request.document_id, current_user["id"])
                 if document:
                     document_filename = document.get("filename", "Unknown Document")
                     # Store first 200 characters as preview
-                    document_content_preview = document.get("content", "")[:200] + "..." if len(document.get("content", "")) > 200 else document.get("content", "")
+                    document_content_preview = await document_text_preview(document, 200)
             except Exception as e:
-                print(f"Error fetching document info: {e}")
+                logger.error("Error fetching document info: %s", e)
         
         # Create chat session
         chat_doc = {
@@ -5350,42 +7865,34 @@ async def create_chat(
             "parent_chat_id": request.parent_chat_id
         }
         
-        print(f"Chat document to insert: {chat_doc}")
-        result = db.chats.insert_one(chat_doc)
-        print(f"Chat created with ID: {result.inserted_id}")
+        logger.debug("Chat document to insert: %s", chat_doc)
+        chat_id = await chat_repository.create(chat_doc)
+        await record_user_activity(current_user["id"], chat_count=1)
+        logger.debug("Chat created with ID: %s", chat_id)
         
-        chat_doc["id"] = str(result.inserted_id)
+        chat_doc["id"] = chat_id
         del chat_doc["_id"]
         
-        print(f"Returning chat: {chat_doc}")
+        logger.debug("Returning chat: %s", chat_doc)
         return chat_doc
         
     except Exception as e:
-        print(f"ERROR: Error creating chat: {str(e)}")
-        print(f"ERROR: Error type: {type(e).__name__}")
-        import traceback
-        print(f"ERROR: Traceback: {traceback.format_exc()}")
+        logger.exception("ERROR: Error creating chat (%s): %s", type(e).__name__, e)
         raise HTTPException(status_code=500, detail=f"Error creating chat: {str(e)}")
 
 @app.get("/chats", response_model=List[ChatSession])
 async def get_user_chats(current_user: dict = Depends(get_current_user)):
     """Get all chat sessions for the current user"""
     
-    print(f"🔍 GET_CHATS: User ID: {current_user.get('id', 'No ID')}")
-    print(f"🔍 GET_CHATS: User email: {current_user.get('email', 'No email')}")
+    logger.debug("🔍 GET_CHATS: User ID: %s", current_user.get('id', 'No ID'))
     
-    chats = list(db.chats.find(
-        {"user_id": current_user["id"]}
-    ).sort("updated_at", -1))
-    
-    print(f"🔍 GET_CHATS: Found {len(chats)} chats in database")
+    chats = await chat_repository.list_for_user(current_user["id"])
     
     for chat in chats:
         chat["id"] = str(chat["_id"])
         del chat["_id"]
-        print(f"🔍 GET_CHATS: Chat {chat['id']} - {chat.get('name', 'No name')}")
     
-    print(f"🔍 GET_CHATS: Returning {len(chats)} chats")
+    logger.debug("🔍 GET_CHATS: Returning %s chats", len(chats))
     return chats
 
 @app.get("/chats/{chat_id}", response_model=ChatSession)
@@ -5396,10 +7903,7 @@ async def get_chat(
     """Get a specific chat session"""
     
     try:
-        chat = db.chats.find_one({
-            "_id": ObjectId(chat_id),
-            "user_id": current_user["id"]
-        })
+        chat = await chat_repository.get_for_user(chat_id, current_user["id"])
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid chat ID")
     
@@ -5421,12 +7925,9 @@ async def delete_chat(
     try:
         # Verify chat belongs to user
         try:
-            chat = db.chats.find_one({
-                "_id": ObjectId(chat_id),
-                "user_id": current_user["id"]
-            })
+            chat = await chat_repository.get_for_user(chat_id, current_user["id"])
         except Exception as e:
-            print(f"❌ Error finding chat: {e}")
+            logger.error("❌ Error finding chat: %s", e)
             raise HTTPException(status_code=400, detail="Invalid chat ID")
         
         if not chat:
@@ -5434,76 +7935,40 @@ async def delete_chat(
         
         # Delete chat and all its associated data
         try:
-            db.chats.delete_one({"_id": ObjectId(chat_id)})
-            db.chat_messages.delete_many({"chat_id": chat_id})
+            await chat_repository.delete(chat_id)
+            await chat_message_repository.delete_for_chat(chat_id)
+            await user_stats_repository.adjust(
+                current_user["id"], chat_count=-1, message_count=-chat.get("message_count", 0)
+            )
             
             # Delete all generated content for this chat
-            db.generated_cases.delete_many({"chat_id": chat_id})
-            db.generated_mcqs.delete_many({"chat_id": chat_id})
-            db.generated_concepts.delete_many({"chat_id": chat_id})
+            await generated_case_repository.delete_for_chat(chat_id)
+            await generated_mcq_repository.delete_for_chat(chat_id)
+            await generated_concept_repository.delete_for_chat(chat_id)
             
-            print(f"✅ Deleted chat {chat_id} and all associated content")
+            logger.info("✅ Deleted chat %s and all associated content", chat_id)
             return {"message": "Chat deleted successfully"}
         except Exception as e:
-            print(f"❌ Error deleting chat data: {e}")
+            logger.error("❌ Error deleting chat data: %s", e)
             raise HTTPException(status_code=500, detail=f"Error deleting chat: {str(e)}")
             
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Unexpected error in delete_chat: {e}")
+        logger.error("❌ Unexpected error in delete_chat: %s", e)
         raise HTTPException(status_code=500, detail=f"Error deleting chat: {str(e)}")
 
-@app.post("/chats/{chat_id}/messages", response_model=ChatMessage, status_code=status.HTTP_201_CREATED)
-async def send_chat_message(
-    chat_id: str,
-    request: ChatRequest,
-    current_user: dict = Depends(get_current_user),
-    request_obj: Request = None
-):
-    """Send a message in a specific chat session"""
-    
-    # Rate limiting check
-    if request_obj:
-        client_ip = request_obj.client.host
-        if not rate_limiter.is_allowed(client_ip):
-            raise HTTPException(
-                status_code=429, 
-                detail="Rate limit exceeded. Please wait before making another request."
-            )
-    
-    # Verify chat belongs to user
-    try:
-        chat = db.chats.find_one({
-            "_id": ObjectId(chat_id),
-            "user_id": current_user["id"]
-        })
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid chat ID")
-    
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    
-        # Get AI response using existing chat endpoint logic
-        if not OPENAI_API_KEY:
-            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-    
-    if not OPENAI_API_KEY or not openai_client:
-        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-    
+async def build_chat_session_messages(chat_id: str, chat: dict, request: ChatRequest, current_user: dict):
+    """Build the OpenAI messages for a chat session turn; returns (messages, max_tokens, document_id)"""
     # Document context (for general chat mode)
     document_context = ""
     document_id = request.document_id or chat.get("document_id")
     if document_id:
         try:
-            doc_obj_id = ObjectId(document_id)
-            document = db.documents.find_one({
-                "_id": doc_obj_id,
-                "uploaded_by": current_user["id"]
-            })
-            if document and document.get("content"):
+            document = await document_repository.get_for_user(document_id, current_user["id"])
+            if document and document.get("text_length"):
                 # Keep this short – it's just background, not to be restated verbatim
-                document_context = document["content"][:1000]
+                document_context = await select_document_context(document, request.message, 250)
         except Exception:
             # If document fetch fails, we just skip context – no hard failure
             document_context = ""
@@ -5516,18 +7981,8 @@ async def send_chat_message(
     
     if case_title:
         try:
-            # Try to match by (title + document_id) first
-            query = {"title": case_title}
-            if document_id:
-                # NOTE: depending on how you store document_id in generated_cases,
-                # you may need ObjectId(document_id) instead of plain string.
-                query["document_id"] = document_id
-            
-            case_doc = db.generated_cases.find_one(query)
-            
-            # Fallback – just by title if doc-specific lookup fails
-            if not case_doc:
-                case_doc = db.generated_cases.find_one({"title": case_title})
+            # Match by (title + document_id) first, falling back to the title alone
+            case_doc = await generated_case_repository.find_by_title(case_title, document_id)
             
             if case_doc:
                 case_difficulty = case_doc.get("difficulty", "Moderate")
@@ -5538,7 +7993,7 @@ async def send_chat_message(
                     case_key_concept = case_doc["key_points"][0]
                 case_description = case_doc.get("description", "")
         except Exception as e:
-            print(f"⚠️ Warning: Could not fetch case details: {e}")
+            llm_logger.warning("⚠️ Warning: Could not fetch case details: %s", e)
         
         # Defaults if anything missing
         if not case_difficulty:
@@ -5672,9 +8127,7 @@ that helps them reason through THIS case.
         messages.append({"role": "system", "content": explore_case_system_prompt})
         
         # (Optional) include conversation history so it feels truly back‑and‑forth
-        recent_messages = list(
-            db.chat_messages.find({"chat_id": chat_id}).sort("timestamp", -1).limit(6)
-        )
+        recent_messages = await chat_message_repository.recent_for_chat(chat_id, 6)
         for m in reversed(recent_messages):
             messages.append({"role": "user", "content": m["message"]})
             messages.append({"role": "assistant", "content": m["response"]})
@@ -5699,9 +8152,74 @@ that helps them reason through THIS case.
         
         max_tokens = 600
     
+    return messages, max_tokens, document_id
+
+async def save_chat_message(chat_id: str, user_id: str, message: str, ai_response: str, document_id: Optional[str]) -> dict:
+    """Store a question/answer pair and bump the chat's and the user's message counts"""
+    message_doc = {
+        "chat_id": chat_id,
+        "message": message,
+        "response": ai_response,
+        "document_id": document_id,
+        "timestamp": datetime.utcnow()
+    }
+    
+    message_doc["id"] = await chat_message_repository.create(message_doc)
+    
+    # Update chat meta
+    await chat_repository.record_message(chat_id)
+    await record_user_activity(user_id, message_count=1)
+    
+    message_doc.pop("_id", None)
+    
+    return message_doc
+
+def format_sse(event: str, data: dict) -> str:
+    """Encode one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+# Disable proxy buffering so tokens reach the browser as they are produced
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+@app.post("/chats/{chat_id}/messages", response_model=ChatMessage, status_code=status.HTTP_201_CREATED)
+async def send_chat_message(
+    chat_id: str,
+    request: ChatRequest,
+    current_user: dict = Depends(get_current_user),
+    request_obj: Request = None
+):
+    """Send a message in a specific chat session"""
+    
+    # Rate limiting check
+    if request_obj:
+        client_ip = request_obj.client.host
+        if not rate_limiter.is_allowed(client_ip):
+            raise HTTPException(
+                status_code=429, 
+                detail="Rate limit exceeded. Please wait before making another request."
+            )
+    
+    # Verify chat belongs to user
+    try:
+        chat = await chat_repository.get_for_user(chat_id, current_user["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid chat ID")
+    
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+        # Get AI response using existing chat endpoint logic
+        if not OPENAI_API_KEY:
+            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    
+    if not OPENAI_API_KEY or not llm_gateway:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    
+    messages, max_tokens, document_id = await build_chat_session_messages(chat_id, chat, request, current_user)
+    
     # Call OpenAI
     try:
-        response = openai_client.chat.completions.create(
+        response = await llm_gateway.chat_completion(
             model="gpt-4o-mini",
             messages=messages,
             temperature=0.5,
@@ -5713,30 +8231,71 @@ that helps them reason through THIS case.
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating AI response: {str(e)}")
     
-    # Save message to DB
-    message_doc = {
-        "chat_id": chat_id,
-        "message": request.message,
-        "response": ai_response,
-        "document_id": document_id,
-        "timestamp": datetime.utcnow()
-    }
+    return await save_chat_message(chat_id, current_user["id"], request.message, ai_response, document_id)
+
+@app.post("/chats/{chat_id}/messages/stream")
+async def stream_chat_message(
+    chat_id: str,
+    request: ChatRequest,
+    current_user: dict = Depends(get_current_user),
+    request_obj: Request = None
+):
+    """Send a message in a chat session and stream the answer as server-sent events.
+
+    Emits `token` events with content deltas, then a `done` event carrying the
+    stored message once it has been saved, or an `error` event.
+    """
     
-    result = db.chat_messages.insert_one(message_doc)
+    # Rate limiting check
+    if request_obj:
+        client_ip = request_obj.client.host
+        if not rate_limiter.is_allowed(client_ip):
+            raise HTTPException(
+                status_code=429, 
+                detail="Rate limit exceeded. Please wait before making another request."
+            )
     
-    # Update chat meta
-    db.chats.update_one(
-        {"_id": ObjectId(chat_id)},
-        {
-            "$inc": {"message_count": 1},
-            "$set": {"updated_at": datetime.utcnow()}
-        }
-    )
+    # Verify chat belongs to user
+    try:
+        chat = await chat_repository.get_for_user(chat_id, current_user["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid chat ID")
     
-    message_doc["id"] = str(result.inserted_id)
-    message_doc.pop("_id", None)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
     
-    return message_doc
+    if not OPENAI_API_KEY or not llm_gateway:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    
+    messages, max_tokens, document_id = await build_chat_session_messages(chat_id, chat, request, current_user)
+    
+    async def event_stream():
+        parts = []
+        try:
+            async for token in llm_gateway.stream_chat_completion(
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=0.5,
+                max_tokens=max_tokens,
+                timeout=60
+            ):
+                parts.append(token)
+                yield format_sse("token", {"content": token})
+        except Exception as e:
+            llm_logger.error("❌ Chat stream failed for chat %s: %s", chat_id, e)
+            yield format_sse("error", {"detail": f"Error generating AI response: {str(e)}"})
+            return
+        
+        # Persist only once the model has finished the answer
+        try:
+            message_doc = await save_chat_message(chat_id, current_user["id"], request.message, "".join(parts), document_id)
+        except Exception as e:
+            logger.error("❌ Could not save streamed message for chat %s: %s", chat_id, e)
+            yield format_sse("error", {"detail": f"Error saving chat message: {str(e)}"})
+            return
+        yield format_sse("done", message_doc)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 @app.put("/chats/{chat_id}/document", response_model=ChatSession)
 async def update_chat_document(
@@ -5748,19 +8307,13 @@ async def update_chat_document(
     
     try:
         # Verify chat belongs to user
-        chat = db.chats.find_one({
-            "_id": ObjectId(chat_id),
-            "user_id": current_user["id"]
-        })
+        chat = await chat_repository.get_for_user(chat_id, current_user["id"])
         
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
         
         # Get document information
-        document = db.documents.find_one({
-            "_id": ObjectId(document_id),
-            "uploaded_by": current_user["id"]
-        })
+        document = await document_repository.get_for_user(document_id, current_user["id"])
         
         if not document:
             raise HTTPException(status_code=404, detail="Document not found")
@@ -5772,29 +8325,26 @@ async def update_chat_document(
         update_data = {
             "document_id": document_id,
             "document_filename": document_filename,
-            "document_content_preview": document.get("content", "")[:200] + "..." if len(document.get("content", "")) > 200 else document.get("content", ""),
+            "document_content_preview": await document_text_preview(document, 200),
             "name": chat_name,  # Update chat name to match document filename
             "updated_at": datetime.now()
         }
         
-        result = db.chats.update_one(
-            {"_id": ObjectId(chat_id)},
-            {"$set": update_data}
-        )
+        result = await chat_repository.update_fields(chat_id, update_data)
         
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Failed to update chat")
         
         # Return updated chat
-        updated_chat = db.chats.find_one({"_id": ObjectId(chat_id)})
+        updated_chat = await chat_repository.get_by_id(chat_id)
         updated_chat["id"] = str(updated_chat["_id"])
         del updated_chat["_id"]
         
-        print(f"✅ Chat {chat_id} updated with document {document_id}")
+        logger.info("✅ Chat %s updated with document %s", chat_id, document_id)
         return updated_chat
         
     except Exception as e:
-        print(f"❌ Error updating chat with document: {e}")
+        logger.error("❌ Error updating chat with document: %s", e)
         raise HTTPException(status_code=500, detail=f"Error updating chat: {str(e)}")
 
 @app.get("/chats/{chat_id}/messages", response_model=List[ChatMessage])
@@ -5806,19 +8356,14 @@ async def get_chat_messages(
     
     # Verify chat belongs to user
     try:
-        chat = db.chats.find_one({
-            "_id": ObjectId(chat_id),
-            "user_id": current_user["id"]
-        })
+        chat = await chat_repository.get_for_user(chat_id, current_user["id"])
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid chat ID")
     
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    messages = list(db.chat_messages.find(
-        {"chat_id": chat_id}
-    ).sort("timestamp", 1))
+    messages = await chat_message_repository.list_for_chat(chat_id)
     
     for message in messages:
         message["id"] = str(message["_id"])
@@ -5836,10 +8381,7 @@ async def save_generated_content(
     
     try:
         # Verify chat belongs to user
-        chat = db.chats.find_one({
-            "_id": ObjectId(chat_id),
-            "user_id": current_user["id"]
-        })
+        chat = await chat_repository.get_for_user(chat_id, current_user["id"])
         
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
@@ -5860,7 +8402,7 @@ async def save_generated_content(
                     "difficulty": case["difficulty"],
                     "created_at": datetime.now()
                 }
-                db.generated_cases.insert_one(case_doc)
+                await generated_case_repository.create(case_doc)
         
         # Save MCQs
         if content.get("mcqs"):
@@ -5875,18 +8417,15 @@ async def save_generated_content(
                     "difficulty": mcq["difficulty"],
                     "created_at": datetime.now()
                 }
-                db.generated_mcqs.insert_one(mcq_doc)
+                await generated_mcq_repository.create(mcq_doc)
         
         # Save concepts - delete old concepts for this case_title first to prevent duplicates
         if content.get("concepts"):
             case_title = content.get("case_title")
             if case_title:
                 # Delete existing concepts for this case_title to prevent duplicates
-                delete_result = db.generated_concepts.delete_many({
-                    "chat_id": chat_id,
-                    "case_title": case_title
-                })
-                print(f"🗑️ Deleted {delete_result.deleted_count} old concepts for case_title: '{case_title}'")
+                delete_result = await generated_concept_repository.delete_for_case(chat_id, case_title)
+                logger.info("🗑️ Deleted %s old concepts for case_title: '%s'", delete_result.deleted_count, case_title)
             
             for concept in content["concepts"]:
                 concept_doc = {
@@ -5919,14 +8458,14 @@ async def save_generated_content(
                     "why_this_case_matters": concept.get("why_this_case_matters"),
                     "created_at": datetime.now()
                 }
-                db.generated_concepts.insert_one(concept_doc)
-            print(f"✅ Saved {len(content['concepts'])} concepts for case_title: '{case_title}'")
+                await generated_concept_repository.create(concept_doc)
+            logger.info("✅ Saved %s concepts for case_title: '%s'", len(content['concepts']), case_title)
         
-        print(f"✅ Saved generated content for chat {chat_id}")
+        logger.info("✅ Saved generated content for chat %s", chat_id)
         return {"message": "Content saved successfully"}
         
     except Exception as e:
-        print(f"❌ Error saving generated content: {e}")
+        logger.error("❌ Error saving generated content: %s", e)
         raise HTTPException(status_code=500, detail=f"Error saving content: {str(e)}")
 
 @app.get("/chats/{chat_id}/content")
@@ -5938,33 +8477,33 @@ async def get_generated_content(
     
     try:
         # Verify chat belongs to user
-        chat = db.chats.find_one({
-            "_id": ObjectId(chat_id),
-            "user_id": current_user["id"]
-        })
+        chat = await chat_repository.get_for_user(chat_id, current_user["id"])
         
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
         
+        cases, mcqs, concepts = await asyncio.gather(
+            generated_case_repository.list_for_chat(chat_id),
+            generated_mcq_repository.list_for_chat(chat_id),
+            generated_concept_repository.list_for_chat(chat_id)
+        )
+        
         # Get cases
-        cases = list(db.generated_cases.find({"chat_id": chat_id}))
         for case in cases:
             case["id"] = str(case["_id"])
             del case["_id"]
         
         # Get MCQs
-        mcqs = list(db.generated_mcqs.find({"chat_id": chat_id}))
         for mcq in mcqs:
             mcq["id"] = str(mcq["_id"])
             del mcq["_id"]
         
         # Get concepts
-        concepts = list(db.generated_concepts.find({"chat_id": chat_id}))
         for concept in concepts:
             concept["id"] = str(concept["_id"])
             del concept["_id"]
         
-        print(f"✅ Retrieved content for chat {chat_id}: {len(cases)} cases, {len(mcqs)} MCQs, {len(concepts)} concepts")
+        logger.debug("✅ Retrieved content for chat %s: %s cases, %s MCQs, %s concepts", chat_id, len(cases), len(mcqs), len(concepts))
         
         return {
             "cases": cases,
@@ -5973,7 +8512,7 @@ async def get_generated_content(
         }
         
     except Exception as e:
-        print(f"❌ Error retrieving generated content: {e}")
+        logger.error("❌ Error retrieving generated content: %s", e)
         raise HTTPException(status_code=500, detail=f"Error retrieving content: {str(e)}")
 
 @app.post("/chats/context", response_model=ChatSession, status_code=status.HTTP_201_CREATED)
@@ -5984,32 +8523,25 @@ async def get_or_create_context_chat(
     """Get or create a context-specific chat (case/concept) - Medical AI Casewise"""
     
     try:
-        print(f"CONTEXT CHAT: Request: {request}")
-        print(f"CONTEXT CHAT: User: {current_user.get('id')}")
+        logger.debug("CONTEXT CHAT: User: %s, request: %s", current_user.get('id'), request)
         
         # Look for existing context chat
-        query = {
-            "user_id": current_user["id"],
-            "document_id": request.document_id
-        }
-        
-        if request.case_title:
-            query["case_title"] = request.case_title
-        if request.concept_title:
-            query["concept_title"] = request.concept_title
-        if request.parent_chat_id:
-            query["parent_chat_id"] = request.parent_chat_id
-        
-        existing_chat = db.chats.find_one(query)
+        existing_chat = await chat_repository.find_context_chat(
+            current_user["id"],
+            request.document_id,
+            case_title=request.case_title,
+            concept_title=request.concept_title,
+            parent_chat_id=request.parent_chat_id
+        )
         
         if existing_chat:
-            print(f"CONTEXT CHAT: Found existing chat: {existing_chat['_id']}")
+            logger.debug("CONTEXT CHAT: Found existing chat: %s", existing_chat['_id'])
             existing_chat["id"] = str(existing_chat["_id"])
             del existing_chat["_id"]
             return existing_chat
         
         # Create new context chat
-        print(f"CONTEXT CHAT: Creating new context chat")
+        logger.debug("CONTEXT CHAT: Creating new context chat")
         
         # Generate context-specific name
         context_name = ""
@@ -6025,15 +8557,12 @@ async def get_or_create_context_chat(
         document_content_preview = None
         if request.document_id:
             try:
-                document = db.documents.find_one({
-                    "_id": ObjectId(request.document_id),
-                    "uploaded_by": current_user["id"]
-                })
+                document = await document_repository.get_for_user(request.document_id, current_user["id"])
                 if document:
                     document_filename = document.get("filename", "Unknown Document")
-                    document_content_preview = document.get("content", "")[:200] + "..." if len(document.get("content", "")) > 200 else document.get("content", "")
+                    document_content_preview = await document_text_preview(document, 200)
             except Exception as e:
-                print(f"Error fetching document info: {e}")
+                logger.error("Error fetching document info: %s", e)
         
         # Create context chat
         chat_doc = {
@@ -6050,15 +8579,15 @@ async def get_or_create_context_chat(
             "parent_chat_id": request.parent_chat_id
         }
         
-        result = db.chats.insert_one(chat_doc)
-        chat_doc["id"] = str(result.inserted_id)
+        chat_doc["id"] = await chat_repository.create(chat_doc)
         del chat_doc["_id"]
+        await record_user_activity(current_user["id"], chat_count=1)
         
-        print(f"CONTEXT CHAT: Created new chat: {chat_doc['id']}")
+        logger.debug("CONTEXT CHAT: Created new chat: %s", chat_doc['id'])
         return chat_doc
         
     except Exception as e:
-        print(f"❌ Error creating context chat: {e}")
+        logger.error("❌ Error creating context chat: %s", e)
         raise HTTPException(status_code=500, detail=f"Error creating context chat: {str(e)}")
 
 
@@ -6083,7 +8612,7 @@ async def generate_dynamic_hint(
     Generate a dynamic hint for an MCQ question based on user attempts and context.
     """
     try:
-        if not openai_client:
+        if not llm_gateway:
             raise HTTPException(status_code=500, detail="OpenAI client not initialized")
         
         # Get document context if available
@@ -6120,7 +8649,7 @@ Requirements:
 Generate only the hint text, no additional formatting."""
 
         # Generate response from OpenAI
-        response = openai_client.chat.completions.create(
+        response = await llm_gateway.chat_completion(
             model="gpt-4.1",
             messages=[
                 {"role": "system", "content": "You are a medical educator. Provide helpful, educational hints."},
@@ -6139,7 +8668,7 @@ Generate only the hint text, no additional formatting."""
         )
         
     except Exception as e:
-        print(f"Dynamic hint generation error: {e}")
+        llm_logger.error("Dynamic hint generation error: %s", e)
         # Fallback hint
         fallback_hints = [
             "Consider the key medical concepts mentioned in the question.",
@@ -6181,10 +8710,13 @@ def root():
             "/ai/generate-case-titles",
             "/ai/generate-mcqs",
             "/ai/identify-concepts",
+            "/jobs/{job_id}",
             "/ai/chat",
+            "/ai/chat/stream",
             "/chats",
             "/chats/{chat_id}",
-            "/chats/{chat_id}/messages"
+            "/chats/{chat_id}/messages",
+            "/chats/{chat_id}/messages/stream"
         ]
     }
 
@@ -224,6 +224,21 @@ export interface AutoGenerationResponse {
   generated_at: string;
   success: boolean;
   message: string;
+  section_status?: Record<string, "completed" | "fallback" | "failed">;
+  section_errors?: Record<string, string>;
+}
+
+export interface GenerationJob {
+  job_id: string;
+  kind: string;
+  status: "queued" | "running" | "completed" | "failed";
+  progress: Record<string, any>;
+  result?: any;
+  error?: { status_code: number; detail: string };
+  attempts: number;
+  created_at: string;
+  started_at?: string;
+  completed_at?: string;
 }
 
 export interface UserAnalytics {
@@ -238,6 +253,23 @@ export interface UserAnalytics {
   lastActiveDate: string;
 }
 
+export interface MCQTrendPoint {
+  periodStart: string;
+  attempts: number;
+  questionsAttempted: number;
+  questionsCorrect: number;
+  accuracy: number | null;
+}
+
+export interface MCQTrends {
+  granularity: "day" | "week";
+  periods: MCQTrendPoint[];
+  attempts: number;
+  accuracy: number | null;
+  scorePercentiles: Record<string, number>;
+  difficultyAccuracy: Record<string, number | null>;
+}
+
 class ApiService {
   private async fetchWithTimeout(
     input: RequestInfo | URL,
@@ -1224,6 +1256,53 @@ class ApiService {
     });
   }
 
+  // Streams the answer via server-sent events; onToken receives each content delta
+  async streamChatMessageToSession(
+    chatId: string,
+    message: string,
+    onToken: (token: string) => void,
+    documentId?: string,
+    caseTitle?: string
+  ): Promise<ChatMessage> {
+    const response = await fetch(`${API_BASE_URL}/chats/${chatId}/messages/stream`, {
+      method: "POST",
+      headers: this.getHeaders(),
+      mode: "cors",
+      credentials: "include",
+      body: JSON.stringify({
+        message,
+        document_id: documentId,
+        case_title: caseTitle,
+      }),
+    });
+    if (!response.ok || !response.body) {
+      return this.handleResponse<ChatMessage>(response);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary = buffer.indexOf("\n\n");
+      while (boundary !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        boundary = buffer.indexOf("\n\n");
+
+        const event = rawEvent.match(/^event: (.*)$/m)?.[1];
+        const data = JSON.parse(rawEvent.match(/^data: (.*)$/m)?.[1] ?? "{}");
+        if (event === "token") onToken(data.content);
+        else if (event === "done") return data as ChatMessage;
+        else if (event === "error") throw new Error(data.detail);
+      }
+    }
+    throw new Error("Chat stream ended unexpectedly");
+  }
+
   async getChatMessages(chatId: string): Promise<ChatMessage[]> {
     console.log("🌐 API: Getting chat messages for chat:", chatId);
     console.log("🌐 API: Chat ID type:", typeof chatId);
@@ -1392,6 +1471,16 @@ class ApiService {
     });
   }
 
+  async getGenerationJob(jobId: string): Promise<GenerationJob> {
+    const response = await fetch(`${API_BASE_URL}/jobs/${jobId}`, {
+      method: "GET",
+      headers: this.getHeaders(),
+      mode: "cors",
+      credentials: "include",
+    });
+    return this.handleResponse<GenerationJob>(response);
+  }
+
   async quickGenerateContent(request: AutoGenerationRequest): Promise<any> {
     // Use fetchWithFallback for automatic failover and timeout handling
     const response = await this.fetchWithFallback(
@@ -1437,6 +1526,30 @@ class ApiService {
     }
     return this.handleResponse<UserAnalytics>(response);
   }
+
+  async getMCQTrends(
+    granularity: "day" | "week" = "week",
+    periods: number = 12
+  ): Promise<MCQTrends> {
+    const params = new URLSearchParams({
+      granularity,
+      periods: String(periods),
+    });
+    const response = await fetch(
+      `${API_BASE_URL}/analytics/mcq-trends?${params}`,
+      {
+        method: "GET",
+        headers: this.getHeaders(),
+        mode: "cors",
+        credentials: "include",
+      }
+    );
+
+    if (!response.ok) {
+      throw new Error(`Failed to get MCQ trends: ${response.statusText}`);
+    }
+    return this.handleResponse<MCQTrends>(response);
+  }
 }
 
 export const apiService = new ApiService();